@@ -400,6 +400,25 @@ class D2RAttentionEventSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'd2r_session', 'user', 'created_at']
 
 
+class AttentionEventBulkItemSerializer(serializers.Serializer):
+    """Item de ingesta masiva: los ids se validan en bloque en la vista, sin un query por evento."""
+    session_id = serializers.IntegerField()
+    user_id = serializers.IntegerField()
+    timestamp = serializers.DateTimeField()
+    value = serializers.FloatField()
+    label = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    data = serializers.JSONField(required=False, default=dict)
+
+
+class D2RAttentionEventBulkItemSerializer(serializers.Serializer):
+    d2r_session_id = serializers.IntegerField()
+    user_id = serializers.IntegerField()
+    timestamp = serializers.DateTimeField()
+    value = serializers.FloatField()
+    label = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    data = serializers.JSONField(required=False, default=dict)
+
+
 class ContentViewSerializer(serializers.ModelSerializer):
     session = SessionSerializer(read_only=True)
     session_id = serializers.PrimaryKeyRelatedField(queryset=Session.objects.all(), source='session', write_only=True)
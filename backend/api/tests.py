@@ -1,3 +1,64 @@
 from django.test import TestCase
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from .models import AttentionEvent, Course, D2RAttentionEvent, D2RSession, Session, User
+
+
+class BulkIngestTests(TestCase):
+    """Ingesta masiva: los items invalidos se rechazan uno por uno y el resto se guarda."""
+
+    def setUp(self):
+        self.student = User.objects.create_user("alumno", password="x", role=User.ROLE_STUDENT)
+        self.other = User.objects.create_user("otro", password="x", role=User.ROLE_STUDENT)
+        teacher = User.objects.create_user("profe", password="x", role=User.ROLE_TEACHER)
+        course = Course.objects.create(title="Curso", owner=teacher)
+        self.session = Session.objects.create(course=course, student=self.student)
+        self.d2r_session = D2RSession.objects.create(user=self.student)
+        self.client = APIClient()
+        self.client.force_authenticate(self.student)
+
+    def event(self, **fields):
+        return {"user_id": self.student.id, "timestamp": "2026-01-01T00:00:00Z", "value": 0.8, **fields}
+
+    def test_attention_bulk_rejects_only_invalid_items(self):
+        payload = [
+            self.event(session_id=self.session.id, value=0.2),
+            self.event(session_id=999999),
+            self.event(session_id=self.session.id, user_id=self.other.id),
+            {"session_id": self.session.id},
+            self.event(session_id=self.session.id, value=0.6),
+        ]
+        res = self.client.post("/api/attention-events/bulk/", payload, format="json")
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.data["created"], 2)
+        self.assertEqual([(r["index"], r["status"]) for r in res.data["rejected"]], [(1, 400), (2, 403), (3, 400)])
+        self.assertEqual(AttentionEvent.objects.count(), 2)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.frame_count, 2)
+        self.assertAlmostEqual(self.session.mean_attention, 0.4)
+        self.assertAlmostEqual(self.session.low_attention_ratio, 0.5)
+        self.assertEqual(self.session.last_score, 0.6)
+
+    def test_d2r_bulk_all_rejected_returns_per_item_results(self):
+        foreign = D2RSession.objects.create(user=self.other)
+        payload = [self.event(d2r_session_id=foreign.id), self.event(d2r_session_id=999999)]
+        res = self.client.post("/api/d2r-attention-events/bulk/", payload, format="json")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["created"], 0)
+        self.assertEqual([r["status"] for r in res.data["rejected"]], [403, 403])
+        self.assertFalse(D2RAttentionEvent.objects.exists())
+
+    def test_d2r_bulk_accumulates_across_batches(self):
+        for value in (0.2, 1.0):
+            res = self.client.post(
+                "/api/d2r-attention-events/bulk/", [self.event(d2r_session_id=self.d2r_session.id, value=value)],
+                format="json",
+            )
+            self.assertEqual(res.status_code, 201)
+        self.d2r_session.refresh_from_db()
+        self.assertEqual(self.d2r_session.frame_count, 2)
+        self.assertAlmostEqual(self.d2r_session.mean_attention, 0.6)
+
+    def test_bulk_requires_non_empty_list(self):
+        res = self.client.post("/api/attention-events/bulk/", {}, format="json")
+        self.assertEqual(res.status_code, 400)
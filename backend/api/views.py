@@ -1,11 +1,11 @@
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.db.models.functions import TruncMonth
 from django.utils import timezone
 from rest_framework import viewsets, permissions, mixins, status
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.decorators import action
@@ -60,6 +60,8 @@ from .serializers import (
     AttentionEventSerializer,
     D2RSessionSerializer,
     D2RAttentionEventSerializer,
+    AttentionEventBulkItemSerializer,
+    D2RAttentionEventBulkItemSerializer,
     ContentViewSerializer,
     D2RResultSerializer,
     QuizAttemptSerializer,
@@ -646,6 +648,113 @@ class EnrollmentViewSet(viewsets.ModelViewSet):
                 logger.warning("No se pudo enviar mailgun de inscripción a %s: %s", user.email, exc)
 
 
+def _update_attention_aggregates(session, values):
+    """Actualiza las metricas agregadas de una Session/D2RSession con los valores nuevos, en orden."""
+    if not values:
+        return
+    frames = session.frame_count or 0
+    new_count = frames + len(values)
+    new_mean = ((session.mean_attention or 0) * frames + sum(values)) / new_count
+    low_prev = (session.low_attention_ratio or 0) * frames
+    new_low = sum(1 for value in values if value < 0.4)
+    new_low_ratio = (low_prev + new_low) / new_count
+
+    session.frame_count = new_count
+    session.mean_attention = new_mean
+    session.low_attention_ratio = new_low_ratio
+    session.last_score = values[-1]
+    session.attention_score = values[-1]
+    session.save(update_fields=[
+        'frame_count', 'mean_attention', 'low_attention_ratio', 'last_score', 'attention_score'
+    ])
+
+
+def _bulk_ingest(request, item_serializer_class, parent_model, parent_key, event_model, check_item):
+    """
+    Ingesta masiva por item: los eventos invalidos se rechazan uno por uno (indice, status
+    y motivo) y el resto se inserta, asi el emisor descarta solo esos en lugar de
+    reintentar o perder el lote entero. Las sesiones se leen con select_for_update dentro
+    de la transaccion: dos lotes concurrentes de la misma sesion no pisan sus agregados.
+    `check_item(item, parent, is_staff_role)` devuelve (status, detalle) si el item no vale.
+    """
+    data = request.data
+    if not isinstance(data, list) or not data:
+        raise ValidationError({"detail": "Se espera una lista no vacia de eventos."})
+    user = request.user
+    is_staff_role = user.role in [User.ROLE_TEACHER, User.ROLE_ADMIN]
+    rejected = []
+    items = []
+    for index, raw in enumerate(data):
+        serializer = item_serializer_class(data=raw)
+        if serializer.is_valid():
+            items.append((index, serializer.validated_data))
+        else:
+            rejected.append({"index": index, "status": status.HTTP_400_BAD_REQUEST, "detail": serializer.errors})
+
+    user_ids = {item['user_id'] for _, item in items}
+    existing_users = set(User.objects.filter(id__in=user_ids).values_list('id', flat=True))
+    accepted = []
+    with transaction.atomic():
+        # orden fijo de bloqueo para que dos lotes no se bloqueen mutuamente
+        parents = {
+            parent.pk: parent
+            for parent in parent_model.objects.select_for_update()
+            .filter(pk__in={item[parent_key] for _, item in items})
+            .order_by('pk')
+        }
+        for index, item in items:
+            if item['user_id'] not in existing_users:
+                error = (status.HTTP_400_BAD_REQUEST, f"Usuario {item['user_id']} no existe.")
+            elif not is_staff_role and item['user_id'] != user.id:
+                error = (status.HTTP_403_FORBIDDEN, "No puedes registrar eventos para otros usuarios.")
+            else:
+                error = check_item(item, parents.get(item[parent_key]), is_staff_role)
+            if error:
+                rejected.append({"index": index, "status": error[0], "detail": error[1]})
+            else:
+                accepted.append(item)
+
+        event_model.objects.bulk_create([
+            event_model(
+                user_id=item['user_id'],
+                timestamp=item['timestamp'],
+                value=item['value'],
+                label=item['label'],
+                data=item['data'],
+                **{parent_key: item[parent_key]},
+            )
+            for item in accepted
+        ])
+        for parent_id, values in _values_by_key(accepted, parent_key).items():
+            _update_attention_aggregates(parents[parent_id], values)
+    rejected.sort(key=lambda entry: entry["index"])
+    return Response(
+        {"created": len(accepted), "rejected": rejected},
+        status=status.HTTP_201_CREATED if accepted else status.HTTP_200_OK,
+    )
+
+
+def _check_attention_item(item, session, is_staff_role):
+    if session is None:
+        return status.HTTP_400_BAD_REQUEST, f"Sesion {item['session_id']} no existe."
+    if item['user_id'] != session.student_id and not is_staff_role:
+        return status.HTTP_403_FORBIDDEN, "El evento debe corresponder al estudiante de la sesión."
+    return None
+
+
+def _check_d2r_item(item, d2r_session, is_staff_role):
+    if d2r_session is None or d2r_session.user_id != item['user_id']:
+        return status.HTTP_403_FORBIDDEN, "El evento debe corresponder a la sesion del estudiante."
+    return None
+
+
+def _values_by_key(items, key):
+    grouped = {}
+    for item in items:
+        grouped.setdefault(item[key], []).append(item['value'])
+    return grouped
+
+
 class SessionViewSet(viewsets.ModelViewSet):
     serializer_class = SessionSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -689,21 +798,18 @@ class AttentionEventViewSet(viewsets.ModelViewSet):
 
         # Actualizar métricas agregadas de la sesión
         if session:
-            frames = session.frame_count or 0
-            new_count = frames + 1
-            new_mean = ((session.mean_attention or 0) * frames + event.value) / new_count
-            low_prev = (session.low_attention_ratio or 0) * frames
-            is_low = 1 if event.value < 0.4 else 0
-            new_low_ratio = (low_prev + is_low) / new_count
-
-            session.frame_count = new_count
-            session.mean_attention = new_mean
-            session.low_attention_ratio = new_low_ratio
-            session.last_score = event.value
-            session.attention_score = event.value
-            session.save(update_fields=[
-                'frame_count', 'mean_attention', 'low_attention_ratio', 'last_score', 'attention_score'
-            ])
+            _update_attention_aggregates(session, [event.value])
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """
+        Ingesta masiva (p. ej. desde el outbox del servicio ML): inserta con bulk_create,
+        actualiza el agregado de cada sesion una sola vez por lote y devuelve los items
+        rechazados con su indice y status (201 si se creo al menos uno).
+        """
+        return _bulk_ingest(
+            request, AttentionEventBulkItemSerializer, Session, 'session_id', AttentionEvent, _check_attention_item
+        )
 
 
 class MeView(APIView):
@@ -805,22 +911,15 @@ class D2RAttentionEventViewSet(viewsets.ModelViewSet):
         if not d2r_session or d2r_session.user_id != target_user.id:
             raise PermissionDenied("El evento debe corresponder a la sesion del estudiante.")
         event = serializer.save()
-
-        frames = d2r_session.frame_count or 0
-        new_count = frames + 1
-        new_mean = ((d2r_session.mean_attention or 0) * frames + event.value) / new_count
-        low_prev = (d2r_session.low_attention_ratio or 0) * frames
-        is_low = 1 if event.value < 0.4 else 0
-        new_low_ratio = (low_prev + is_low) / new_count
-
-        d2r_session.frame_count = new_count
-        d2r_session.mean_attention = new_mean
-        d2r_session.low_attention_ratio = new_low_ratio
-        d2r_session.last_score = event.value
-        d2r_session.attention_score = event.value
-        d2r_session.save(update_fields=[
-            'frame_count', 'mean_attention', 'low_attention_ratio', 'last_score', 'attention_score'
-        ])
+        _update_attention_aggregates(d2r_session, [event.value])
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request):
+        """Ingesta masiva de eventos D2R; mismas reglas que el alta individual, rechazos por item."""
+        return _bulk_ingest(
+            request, D2RAttentionEventBulkItemSerializer, D2RSession, 'd2r_session_id', D2RAttentionEvent,
+            _check_d2r_item,
+        )
 
 
 class D2RResultViewSet(viewsets.ModelViewSet):
@@ -36,7 +36,12 @@ export async function POST(req: Request) {
     }
 
     const formData = await req.formData();
-    const target = `${ML_SERVICE_URL}/analyze/frame`;
+    // Si el navegador ya calculo los landmarks (Face Mesh en cliente) se envian sin imagen
+    const target = `${ML_SERVICE_URL}${formData.has("landmarks") ? "/analyze/landmarks" : "/analyze/frame"}`;
+    if (formData.has("landmarks")) {
+      formData.set("file", formData.get("landmarks") as Blob, "landmarks.bin");
+      formData.delete("landmarks");
+    }
     
     console.log("[attention-proxy] ✅ Enviando frame a ML Service", {
       url: target,
@@ -53,6 +58,23 @@ export async function POST(req: Request) {
 
     const data = await res.json().catch(() => ({}));
 
+    // 409: frame reemplazado por uno mas nuevo de la sesion; 429: ML Service sobrecargado
+    if (res.status === 409 || res.status === 429) {
+      console.warn("[attention-proxy] ⚠️ Frame descartado por el ML Service", {
+        status: res.status,
+        retryAfter: res.headers.get("Retry-After"),
+      });
+      return NextResponse.json(
+        {
+          ok: false,
+          skipped: true,
+          detail: data.detail || "Frame descartado",
+          retry_after: Number(res.headers.get("Retry-After")) || undefined,
+        },
+        { status: 200 }
+      );
+    }
+
     if (!res.ok) {
       console.error("[attention-proxy] ❌ ML Service error", {
         status: res.status,
@@ -0,0 +1,92 @@
+"""
+Benchmark del reenvio de eventos al backend: cliente nuevo por frame vs cliente persistente.
+Levanta un backend stub local (o usa --url) y mide la latencia de cada POST.
+Ejecutar: python ml/bench_backend_forwarding.py --requests 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+stub = FastAPI()
+
+
+@stub.post("/api/attention-events/")
+@stub.post("/api/d2r-attention-events/")
+async def accept_event():
+    return {"ok": True}
+
+
+def sample_payload(i: int) -> dict:
+    return {
+        "session_id": 1,
+        "user_id": 1,
+        "value": 0.5,
+        "label": "attention_score",
+        "data": {"seq": i},
+    }
+
+
+async def bench_new_client(url: str, n: int) -> list:
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        async with httpx.AsyncClient(timeout=10) as client:
+            await client.post(url, json=sample_payload(i))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def bench_shared_client(url: str, n: int) -> list:
+    import ml_service
+
+    latencies = []
+    async with ml_service.create_backend_client() as client:
+        for i in range(n):
+            start = time.perf_counter()
+            await client.post(url, json=sample_payload(i))
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list) -> None:
+    ordered = sorted(latencies)
+    p95 = ordered[int(0.95 * (len(ordered) - 1))]
+    print(
+        f"{name:<16} n={len(ordered)} mean={statistics.mean(ordered):.2f}ms "
+        f"p50={statistics.median(ordered):.2f}ms p95={p95:.2f}ms"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--url", type=str, default="", help="Backend real; si se omite se usa un stub local")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        url = f"{args.url.rstrip('/')}/api/attention-events/"
+    else:
+        server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=args.port, log_level="warning"))
+        asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+        url = f"http://127.0.0.1:{args.port}/api/attention-events/"
+
+    print(f"Backend: {url}")
+    report("antes (nuevo)", await bench_new_client(url, args.requests))
+    report("despues (pool)", await bench_shared_client(url, args.requests))
+
+    if server is not None:
+        server.should_exit = True
+        await asyncio.sleep(0.2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
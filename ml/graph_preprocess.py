@@ -0,0 +1,57 @@
+"""
+Preprocesado de frames dentro del grafo exportado.
+
+Los modelos reciben los crops tal como salen del recorte del servicio (RGB uint8,
+N,H,W,C) y hacen la conversion a float en [0, 1] y el cambio a N,C,H,W como primeras
+operaciones del grafo ONNX. Asi el servicio no convierte ni copia cada frame en Python
+y entrenamiento y servicio comparten exactamente el mismo preprocesado.
+"""
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+import onnxruntime as ort
+import torch
+import torch.nn as nn
+
+
+class FramePreprocess(nn.Module):
+    """uint8 (N, H, W, C) -> float32 (N, C, H, W) en [0, 1]. Sin parametros: los .pth previos siguen cargando."""
+
+    def forward(self, x):
+        # permutacion explicita y sin indices negativos: el exportador TorchScript los
+        # copia tal cual al Transpose y ONNX Runtime rechaza el modelo al cargarlo
+        return x.float().mul(1.0 / 255.0).permute(0, 3, 1, 2)
+
+
+def uint8_frames(*shape: int, device=None) -> torch.Tensor:
+    """Entrada dummy para exportar: crops uint8 con la forma dada (..., H, W, C)."""
+    return torch.zeros(shape, dtype=torch.uint8, device=device)
+
+
+def sample_frames(*shape: int, device=None) -> torch.Tensor:
+    """Crops uint8 aleatorios para comparar el grafo exportado con el modelo."""
+    return torch.randint(0, 256, shape, dtype=torch.uint8, device=device)
+
+
+def check_onnx_export(
+    module: nn.Module,
+    inputs: Union[torch.Tensor, Tuple[torch.Tensor, ...]],
+    path: Union[str, Path],
+    atol: float = 1e-4,
+) -> float:
+    """
+    Carga el grafo exportado en ONNX Runtime y compara su salida con la del modelo en
+    eager sobre las mismas entradas; devuelve el error maximo y falla si supera `atol`.
+    """
+    inputs = inputs if isinstance(inputs, tuple) else (inputs,)
+    session = ort.InferenceSession(str(path), providers=["CPUExecutionProvider"])
+    feeds = {arg.name: x.detach().cpu().numpy() for arg, x in zip(session.get_inputs(), inputs)}
+    onnx_out = session.run(None, feeds)[0]
+    module.eval()
+    with torch.no_grad():
+        eager_out = module(*inputs).detach().cpu().numpy()
+    err = float(np.max(np.abs(onnx_out.reshape(eager_out.shape) - eager_out))) if eager_out.size else 0.0
+    if not err <= atol:
+        raise RuntimeError(f"{path}: la salida ONNX difiere de la del modelo (max_abs_err={err:.6f})")
+    return err
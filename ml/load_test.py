@@ -0,0 +1,259 @@
+"""
+Prueba de carga de ml_service: N alumnos concurrentes enviando frames a /analyze/frame.
+Levanta un backend stub local que acepta los eventos y, salvo que se pase --url,
+arranca ml_service como subproceso apuntando a ese stub para medir su RSS.
+Reporta throughput, latencias p50/p95/p99, tasa de error y RSS del servicio.
+Ejecutar: python ml/load_test.py --students 30 --fps 2 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+import cv2
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+
+ML_DIR = Path(__file__).resolve().parent
+
+stub = FastAPI()
+stub_events = Counter()
+
+
+@stub.post("/api/attention-events/")
+@stub.post("/api/d2r-attention-events/")
+async def accept_event():
+    stub_events["events"] += 1
+    return {"ok": True}
+
+
+@stub.post("/api/attention-events/bulk/")
+@stub.post("/api/d2r-attention-events/bulk/")
+async def accept_bulk(request: Request):
+    stub_events["events"] += len(await request.json())
+    stub_events["bulk_posts"] += 1
+    return {"created": 0}
+
+
+def load_frames(image_path: str, variants: int) -> list:
+    """
+    Frames JPEG de prueba; con variants > 1 se agrega ruido leve para que los bytes (y el
+    decode) cambien. El ruido promedia casi cero en la miniatura del gate (diferencia
+    media muy por debajo de FRAME_REUSE_THRESHOLD), asi que no evita la reutilizacion:
+    para eso start_service apaga el gate (FRAME_REUSE_THRESHOLD=0).
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise SystemExit(f"No se pudo leer la imagen: {image_path}")
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(max(variants, 1)):
+        frame = image
+        if i > 0:
+            noise = rng.integers(-12, 13, size=image.shape, dtype=np.int16)
+            frame = np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+        frames.append(buf.tobytes())
+    return frames
+
+
+def read_rss_mb(pid: int) -> float:
+    """RSS del proceso y sus hijos (workers del pool en modo process), leyendo /proc."""
+    total_kb = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total_kb / 1024
+
+
+async def student(client: httpx.AsyncClient, url: str, idx: int, args, frames: list, results: list, deadline: float):
+    interval = 1.0 / args.fps
+    # desfase inicial para no sincronizar todos los envios
+    await asyncio.sleep((idx % 10) * interval / 10)
+    seq = 0
+    form = {
+        "session_id": str(args.session_base + idx),
+        "user_id": str(args.session_base + idx),
+        "test_name": args.test_name,
+    }
+    if args.test_name.upper() == "D2R":
+        form = {**form, "d2r_session_id": form.pop("session_id")}
+    while time.perf_counter() < deadline:
+        tick = time.perf_counter()
+        frame = frames[seq % len(frames)]
+        try:
+            resp = await client.post(url, files={"file": ("frame.jpg", frame, "image/jpeg")}, data=form)
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        results.append((status, (time.perf_counter() - tick) * 1000))
+        seq += 1
+        await asyncio.sleep(max(interval - (time.perf_counter() - tick), 0))
+
+
+async def sample_rss(pid: int, samples: list, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        samples.append(read_rss_mb(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def build_report(results: list, elapsed: float, rss: list, args) -> dict:
+    latencies = sorted(ms for status, ms in results if status == 200)
+    statuses = Counter(str(status) for status, _ in results)
+    errors = len(results) - len(latencies)
+    return {
+        "students": args.students,
+        "fps_per_student": args.fps,
+        "duration_s": round(elapsed, 2),
+        "requests": len(results),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "statuses": dict(statuses),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies), 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(latencies[-1], 2) if latencies else 0.0,
+        },
+        "rss_mb": {
+            "start": round(rss[0], 1) if rss else None,
+            "peak": round(max(rss), 1) if rss else None,
+            "end": round(rss[-1], 1) if rss else None,
+        },
+        "backend_events": stub_events["events"],
+        "backend_bulk_posts": stub_events["bulk_posts"],
+    }
+
+
+def start_service(args, backend_url: str) -> subprocess.Popen:
+    env = {**os.environ, "BACKEND_URL": backend_url, "BACKEND_TOKEN": os.environ.get("BACKEND_TOKEN", "loadtest")}
+    if args.variants > 1:
+        # se mide el camino completo de cada frame; --variants 1 mide el de reutilizacion
+        env["FRAME_REUSE_THRESHOLD"] = "0"
+    cmd = [sys.executable, "-m", "uvicorn", "ml_service:app", "--host", "127.0.0.1", "--port", str(args.service_port),
+           "--log-level", "warning"]
+    return subprocess.Popen(cmd, cwd=ML_DIR, env=env)
+
+
+async def wait_ready(url: str, timeout_s: float) -> None:
+    deadline = time.perf_counter() + timeout_s
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.perf_counter() < deadline:
+            try:
+                if (await client.get(f"{url}/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise SystemExit(f"ml_service no respondio en {timeout_s}s: {url}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--fps", type=float, default=2.0, help="Frames por segundo por alumno (el frontend envia 2)")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--image", type=str, default=str(ML_DIR / "test_image_sent.jpg"))
+    parser.add_argument("--variants", type=int, default=8, help="Frames distintos por alumno (1 = siempre el mismo, con reutilizacion)")
+    parser.add_argument("--test-name", type=str, default="COURSE")
+    parser.add_argument("--session-base", type=int, default=100000)
+    parser.add_argument("--url", type=str, default="", help="ml_service ya levantado; si se omite se arranca uno")
+    parser.add_argument("--pid", type=int, default=0, help="PID del servicio para medir RSS cuando se usa --url")
+    parser.add_argument("--service-port", type=int, default=9100)
+    parser.add_argument("--backend-port", type=int, default=8766)
+    parser.add_argument("--json", type=str, default="", help="Guardar el reporte en este archivo")
+    args = parser.parse_args()
+
+    server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=args.backend_port, log_level="warning"))
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    backend_url = f"http://127.0.0.1:{args.backend_port}"
+
+    proc = None
+    pid = args.pid
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        proc = start_service(args, backend_url)
+        pid = proc.pid
+        base_url = f"http://127.0.0.1:{args.service_port}"
+    try:
+        await wait_ready(base_url, 120)
+        frames = load_frames(args.image, args.variants)
+        print(f"ml_service: {base_url}  backend stub: {backend_url}")
+        print(f"{args.students} alumnos x {args.fps} fps durante {args.duration}s, frame={len(frames[0])} bytes")
+
+        results: list = []
+        rss: list = []
+        stop = asyncio.Event()
+        rss_task = asyncio.create_task(sample_rss(pid, rss, stop)) if pid else None
+        limits = httpx.Limits(max_connections=args.students, max_keepalive_connections=args.students)
+        async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+            start = time.perf_counter()
+            deadline = start + args.duration
+            await asyncio.gather(*[
+                student(client, f"{base_url}/analyze/frame", i, args, frames, results, deadline)
+                for i in range(args.students)
+            ])
+            elapsed = time.perf_counter() - start
+        # dar tiempo al outbox para vaciar los eventos pendientes
+        await asyncio.sleep(1.0)
+        stop.set()
+        if rss_task is not None:
+            await rss_task
+
+        report = build_report(results, elapsed, rss, args)
+        lat = report["latency_ms"]
+        print(
+            f"requests={report['requests']} throughput={report['throughput_rps']} req/s "
+            f"errores={report['error_rate'] * 100:.2f}% {report['statuses']}"
+        )
+        print(f"latencia ms: mean={lat['mean']} p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+        if report["rss_mb"]["peak"] is not None:
+            r = report["rss_mb"]
+            print(f"RSS MB: inicio={r['start']} pico={r['peak']} final={r['end']}")
+        print(f"eventos recibidos por el backend stub: {report['backend_events']}")
+        if args.json:
+            Path(args.json).write_text(json.dumps(report, indent=2))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        server.should_exit = True
+        await asyncio.sleep(0.2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,34 +1,166 @@
 import os
 import sys
+import copy
+import json
+import math
+import struct
+import time
+import asyncio
+import heapq
+import hmac
+import itertools
 import subprocess
-from threading import Thread
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from threading import Thread, Lock, local
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from collections import deque, defaultdict
 from pathlib import Path
 
 import cv2
 import numpy as np
 import httpx
-import mediapipe as mp
 import onnxruntime as ort
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import Depends, FastAPI, UploadFile, File, Form, Header, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, model_validator
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError, model_validator
 import uvicorn
 
+from metrics import MetricsRegistry, SampledLogger
+from model_registry import ModelBundle, ModelRegistry
+from optimize_onnx import VARIANTS as ONNX_VARIANTS, session_options, variant_path
+from session_state import LocalSessionSweeper, create_session_store
+from shard_engine import ShardError, ShardedEngine, serve_shard
+
 
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://backend:8000")
 BACKEND_TOKEN = os.environ.get("BACKEND_TOKEN", "")
+# Cliente HTTP persistente hacia el backend (keep-alive, HTTP/2 si h2 esta instalado)
+BACKEND_HTTP2 = os.environ.get("BACKEND_HTTP2", "1") == "1"
+BACKEND_TIMEOUT = float(os.environ.get("BACKEND_TIMEOUT", "10"))
+BACKEND_MAX_CONNECTIONS = int(os.environ.get("BACKEND_MAX_CONNECTIONS", "100"))
+BACKEND_MAX_KEEPALIVE = int(os.environ.get("BACKEND_MAX_KEEPALIVE", "20"))
+# WebSocket /ws/stream: validar el token del alumno contra el backend (/api/me/) al conectar
+WS_AUTH_REQUIRED = os.environ.get("WS_AUTH_REQUIRED", "1") == "1"
+WS_MAX_MESSAGE_BYTES = int(os.environ.get("WS_MAX_MESSAGE_BYTES", str(2 * 1024 * 1024)))
+# Outbox: los eventos de /analyze/frame se envian en segundo plano y por lotes
+OUTBOX_ENABLED = os.environ.get("OUTBOX_ENABLED", "1") == "1"
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_FLUSH_MS = float(os.environ.get("OUTBOX_FLUSH_MS", "200"))
+OUTBOX_MAX_EVENTS = int(os.environ.get("OUTBOX_MAX_EVENTS", "10000"))
+# Reintentos de errores transitorios: backoff exponencial entre lotes fallidos (tope en ms) y
+# descarte de un evento cuando lleva mas de OUTBOX_MAX_RETRY_S fallando, no por cantidad de intentos
+OUTBOX_RETRY_BACKOFF_MAX_MS = float(os.environ.get("OUTBOX_RETRY_BACKOFF_MAX_MS", "30000"))
+OUTBOX_MAX_RETRY_S = float(os.environ.get("OUTBOX_MAX_RETRY_S", "300"))
+# 1: cada lote va a /api/<eventos>/bulk/ en un solo POST; 0: un POST por evento
+OUTBOX_BULK = os.environ.get("OUTBOX_BULK", "1") == "1"
 SEQUENCE_LENGTH = int(os.environ.get("SEQUENCE_LENGTH", "16"))
+# Constantes de tiempo (s) de las medias moviles exponenciales del payload `temporal`
+TEMPORAL_EMA_S = tuple(
+    float(x) for x in os.environ.get("TEMPORAL_EMA_S", "2,8,60").split(",") if x.strip()
+)
 MODEL_PATH = os.environ.get("MODEL_PATH", "checkpoints/cnn_lstm.onnx")
+# Modelo partido: encoder por frame + cabeza secuencial sobre embeddings
+ENCODER_MODEL_PATH = os.environ.get("ENCODER_MODEL_PATH", MODEL_PATH.replace(".onnx", "_encoder.onnx"))
+HEAD_MODEL_PATH = os.environ.get("HEAD_MODEL_PATH", MODEL_PATH.replace(".onnx", "_head.onnx"))
 MODEL_IMG_SIZE = int(os.environ.get("MODEL_IMG_SIZE", "224"))
+# Variante ONNX a servir (fp32 | opt | int8, generadas por optimize_onnx.py) y opciones de runtime
+ONNX_VARIANT = os.environ.get("ONNX_VARIANT", "fp32")
+ORT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", "0"))  # 0 = default de ORT
+ORT_INTER_OP_THREADS = int(os.environ.get("ORT_INTER_OP_THREADS", "0"))
+ORT_GRAPH_OPT_LEVEL = os.environ.get("ORT_GRAPH_OPT_LEVEL", "all")  # disable | basic | extended | all
+# Registro de versiones del modelo: recarga en caliente cuando el entrenamiento reescribe MODEL_PATH
+MODEL_VERSIONS_DIR = os.environ.get("MODEL_VERSIONS_DIR", os.path.join(os.path.dirname(MODEL_PATH) or ".", "versions"))
+MODEL_WATCH = os.environ.get("MODEL_WATCH", "1") == "1"
+MODEL_POLL_S = float(os.environ.get("MODEL_POLL_S", "10"))
+MODEL_KEEP_VERSIONS = int(os.environ.get("MODEL_KEEP_VERSIONS", "3"))
+MODEL_STABLE_S = float(os.environ.get("MODEL_STABLE_S", "5"))  # antiguedad minima de los archivos antes de registrarlos
 TRAIN_ON_START = os.environ.get("TRAIN_ON_START", "0") == "1"
 TRAINING_SCRIPT = os.environ.get("TRAINING_SCRIPT", "train_model.py")
+# Pool de CPU para decode/deteccion/modelo (thread|process), o workers con sesiones particionadas (sharded)
+ML_WORKER_MODE = os.environ.get("ML_WORKER_MODE", "thread").lower()
+ML_WORKERS = int(os.environ.get("ML_WORKERS", str(os.cpu_count() or 1)))
+ML_MAX_QUEUE = int(os.environ.get("ML_MAX_QUEUE", str(ML_WORKERS * 4)))
+# Sobrecarga: 429 si la espera estimada para un frame nuevo supera este limite (0 = solo ML_MAX_QUEUE)
+ADMISSION_MAX_WAIT_MS = float(os.environ.get("ADMISSION_MAX_WAIT_MS", "2000"))
+# Prioridades: los frames de curso solo usan esta fraccion de ML_MAX_QUEUE / ADMISSION_MAX_WAIT_MS
+# (se descartan antes que los de D2R) y los de D2R con poco time_left se atienden primero
+ADMISSION_COURSE_SHARE = float(os.environ.get("ADMISSION_COURSE_SHARE", "0.5"))
+PRIORITY_URGENT_S = float(os.environ.get("PRIORITY_URGENT_S", "5"))
+# Modo sharded: ranuras de memoria compartida por worker para pasar los frames sin serializarlos
+SHARD_SLOTS = int(os.environ.get("SHARD_SLOTS", "8"))
+SHARD_SLOT_BYTES = int(os.environ.get("SHARD_SLOT_BYTES", str(WS_MAX_MESSAGE_BYTES)))
+# Estado por sesion: expulsion por inactividad y presupuesto global de memoria de buffers
+SESSION_IDLE_TTL_S = float(os.environ.get("SESSION_IDLE_TTL_S", "300"))
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get("SESSION_MEMORY_BUDGET_MB", "512"))
+# Backend de estado por sesion: memory (un worker), shm (varios workers, un host), redis (varias replicas)
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+# Afinidad de sesion: en modo process los frames de una sesion caen en cualquier proceso del
+# pool, y con shm/redis en cualquier worker de uvicorn o replica; el estado de detector por
+# sesion quedaria repartido, obsoleto y fuera del alcance de la expulsion
+STICKY_SESSIONS = ML_WORKER_MODE != "process" and SESSION_STORE == "memory"
+SESSION_FRAME_BYTES = int(os.environ.get("SESSION_FRAME_BYTES", str(MODEL_IMG_SIZE * MODEL_IMG_SIZE * 3)))
+# Tracking de ROI: detectar sobre el bbox previo expandido en vez del frame completo
+# (solo con afinidad de sesion: en modo process o con SESSION_STORE shm/redis la ROI guardada
+# por otro proceso, worker o replica estaria obsoleta)
+ROI_TRACKING = os.environ.get("ROI_TRACKING", "1") == "1" and STICKY_SESSIONS
+ROI_EXPAND = float(os.environ.get("ROI_EXPAND", "2.0"))
+ROI_MIN_SIZE = int(os.environ.get("ROI_MIN_SIZE", "160"))
+# Decode reducido (IMREAD_REDUCED_COLOR_2/4/8) cuando el frame es mas grande de lo necesario
+DECODE_REDUCED = os.environ.get("DECODE_REDUCED", "1") == "1"
+DECODE_MIN_WIDTH = int(os.environ.get("DECODE_MIN_WIDTH", "480"))
+MODEL_CROP_MIN_SIDE = int(os.environ.get("MODEL_CROP_MIN_SIDE", str(MODEL_IMG_SIZE // 2)))
+# Reutilizar el resultado previo si el frame casi no cambio (diferencia media de miniaturas en gris, 0-255)
+FRAME_REUSE_THRESHOLD = float(os.environ.get("FRAME_REUSE_THRESHOLD", "2.0"))
+FRAME_REUSE_MAX = int(os.environ.get("FRAME_REUSE_MAX", "15"))
+# Fallback Haar: ancho de deteccion y frecuencia maxima de la pasada fina
+HAAR_DETECT_WIDTH = int(os.environ.get("HAAR_DETECT_WIDTH", "320"))
+HAAR_FINE_EVERY = int(os.environ.get("HAAR_FINE_EVERY", "10"))
+# Micro-batching de inferencia CNN-LSTM entre sesiones
+INFER_MAX_BATCH = int(os.environ.get("INFER_MAX_BATCH", "16"))
+INFER_MAX_WAIT_MS = float(os.environ.get("INFER_MAX_WAIT_MS", "5"))
+# Instancias de FaceMesh por proceso (en modo process cada worker tiene las suyas)
+FACE_MESH_POOL_SIZE = int(
+    os.environ.get("FACE_MESH_POOL_SIZE", str(ML_WORKERS if ML_WORKER_MODE not in ("process", "sharded") else 1))
+)
+
+# Fraccion de frames que se registran como log estructurado (los errores siempre)
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
 
 app = FastAPI(title="ML Attention Service", version="0.1.0")
 
+# Metricas expuestas en /metrics (formato Prometheus)
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "ml_stage_duration_seconds", "Duracion de cada etapa del analisis de un frame", ["stage"]
+)
+FRAMES_TOTAL = metrics.counter("ml_frames_total", "Frames analizados", ["kind", "face"])
+FRAMES_REUSED_TOTAL = metrics.counter("ml_frames_reused_total", "Frames que reutilizaron el analisis del anterior")
+MODEL_RUNS_TOTAL = metrics.counter("ml_model_runs_total", "Frames con score del modelo CNN-LSTM", ["source"])
+FRAMES_REJECTED_TOTAL = metrics.counter("ml_frames_rejected_total", "Frames rechazados", ["reason"])
+FORWARD_FAILURES_TOTAL = metrics.counter(
+    "ml_backend_forward_failures_total", "Eventos que no se pudieron reenviar al backend", ["reason"]
+)
+ACTIVE_SESSIONS = metrics.gauge("ml_active_sessions", "Sesiones con estado temporal en memoria")
+SESSION_BUFFER_BYTES = metrics.gauge("ml_session_buffer_bytes", "Memoria de buffers por sesion")
+CPU_POOL_IN_FLIGHT = metrics.gauge("ml_cpu_pool_in_flight", "Frames en el pool CPU")
+ADMISSION_IN_FLIGHT = metrics.gauge("ml_admission_in_flight", "Frames admitidos (en proceso o en espera)")
+ADMISSION_EXPECTED_WAIT = metrics.gauge(
+    "ml_admission_expected_wait_seconds", "Espera estimada para un frame nuevo"
+)
+ADMISSION_QUEUED = metrics.gauge("ml_admission_queued", "Frames admitidos esperando turno", ["priority"])
+ADMISSION_SHED_TOTAL = metrics.counter(
+    "ml_admission_shed_total", "Frames descartados por carga (429) segun prioridad", ["priority"]
+)
+ADMISSION_WAIT_SECONDS = metrics.histogram(
+    "ml_admission_wait_seconds", "Espera hasta el turno en el pool segun prioridad", ["priority"]
+)
+OUTBOX_PENDING = metrics.gauge("ml_outbox_pending", "Eventos pendientes en el outbox")
+frame_log = SampledLogger(LOG_SAMPLE_RATE)
+
 allowed_origins = [origin.strip() for origin in os.environ.get("CORS_ORIGINS", "").split(",") if origin.strip()]
 if not allowed_origins:
     allowed_origins = ["*"]
@@ -41,58 +173,205 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-try:
-    mp_face_mesh = mp.solutions.face_mesh
-except AttributeError:
+def _load_mp_face_mesh():
+    """Importa MediaPipe solo al inicializar (el import tarda y no hace falta para /health)."""
     try:
-        from mediapipe.python import solutions as mp_solutions
-        mp_face_mesh = mp_solutions.face_mesh
-    except Exception:
-        mp_face_mesh = None
-
-if mp_face_mesh is not None:
-    face_mesh = mp_face_mesh.FaceMesh(
-        max_num_faces=1,
-        refine_landmarks=True,
-        min_detection_confidence=0.5,
-        min_tracking_confidence=0.5,
-    )
-    print("✅ [INIT] MediaPipe FaceMesh initialized successfully")
-else:
-    face_mesh = None
-    print("⚠️  [INIT] MediaPipe FaceMesh initialization FAILED - face_mesh=None")
+        import mediapipe as mp
+    except ImportError:
+        return None
+    try:
+        return mp.solutions.face_mesh
+    except AttributeError:
+        try:
+            from mediapipe.python import solutions as mp_solutions
+            return mp_solutions.face_mesh
+        except Exception:
+            return None
+
 
-# Fallback: Haar cascade face detector (lighter, more portable)
+class FaceMeshPool:
+    """
+    Pool de grafos FaceMesh con afinidad por sesion.
+    Cada session_key queda asignada siempre a la misma instancia (la menos
+    cargada al momento de verla por primera vez), asi el tracking de MediaPipe
+    sigue al mismo rostro entre frames y no se mezcla con otras sesiones.
+    Cada instancia tiene su lock porque el grafo no es thread-safe.
+    """
+
+    def __init__(self, size: int, mp_face_mesh):
+        self.instances = [
+            mp_face_mesh.FaceMesh(
+                max_num_faces=1,
+                refine_landmarks=True,
+                min_detection_confidence=0.5,
+                min_tracking_confidence=0.5,
+            )
+            for _ in range(max(size, 1))
+        ]
+        self._locks = [Lock() for _ in self.instances]
+        self._sessions_per_instance = [0] * len(self.instances)
+        self._assignments: Dict[int, int] = {}
+        self._assign_lock = Lock()
+
+    def _index_for(self, session_key: Optional[int]) -> int:
+        if session_key is None:
+            return 0
+        with self._assign_lock:
+            idx = self._assignments.get(session_key)
+            if idx is None:
+                idx = min(range(len(self.instances)), key=lambda i: self._sessions_per_instance[i])
+                self._assignments[session_key] = idx
+                self._sessions_per_instance[idx] += 1
+            return idx
+
+    def process(self, rgb: np.ndarray, session_key: Optional[int] = None):
+        idx = self._index_for(session_key)
+        with self._locks[idx]:
+            return self.instances[idx].process(rgb)
+
+    def warmup(self, rgb: np.ndarray) -> None:
+        """Una inferencia por instancia, cada una bajo su lock, para inicializar todos los grafos."""
+        for instance, lock in zip(self.instances, self._locks):
+            with lock:
+                instance.process(rgb)
+
+    def release(self, session_key: int) -> None:
+        with self._assign_lock:
+            idx = self._assignments.pop(session_key, None)
+            if idx is not None:
+                self._sessions_per_instance[idx] -= 1
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "size": len(self.instances),
+            "sessions_per_instance": list(self._sessions_per_instance),
+        }
+
+
+# Detectores: se crean en initialize_runtime (en segundo plano al arrancar, o en
+# el initializer de cada worker del pool), no al importar el modulo.
+face_mesh = None
 cascade = None
 eye_cascade = None
-try:
-    cascade_path = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-    cascade = cv2.CascadeClassifier(cascade_path)
-    if cascade.empty():
-        cascade = None
-        print(f"⚠️  [INIT] Haar cascade exists but failed to load: {cascade_path}")
+HAAR_FACE_XML = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+HAAR_EYE_XML = cv2.data.haarcascades + "haarcascade_eye.xml"
+
+
+def init_face_mesh() -> None:
+    global face_mesh
+    mp_face_mesh = _load_mp_face_mesh()
+    if mp_face_mesh is not None:
+        face_mesh = FaceMeshPool(FACE_MESH_POOL_SIZE, mp_face_mesh)
+        print(f"✅ [INIT] MediaPipe FaceMesh initialized successfully (pool={FACE_MESH_POOL_SIZE})")
     else:
-        print(f"✅ [INIT] Haar cascade loaded from: {cascade_path}")
-        
-    # Load eye cascade for attention scoring (when MediaPipe unavailable)
-    eye_cascade_path = cv2.data.haarcascades + "haarcascade_eye.xml"
-    eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
-    if eye_cascade.empty():
+        face_mesh = None
+        print("⚠️  [INIT] MediaPipe FaceMesh initialization FAILED - face_mesh=None")
+
+
+def init_haar_cascades() -> None:
+    # Fallback: Haar cascade face detector (lighter, more portable)
+    global cascade, eye_cascade
+    try:
+        cascade_path = HAAR_FACE_XML
+        cascade = cv2.CascadeClassifier(cascade_path)
+        if cascade.empty():
+            cascade = None
+            print(f"⚠️  [INIT] Haar cascade exists but failed to load: {cascade_path}")
+        else:
+            print(f"✅ [INIT] Haar cascade loaded from: {cascade_path}")
+
+        # Load eye cascade for attention scoring (when MediaPipe unavailable)
+        eye_cascade_path = HAAR_EYE_XML
+        eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
+        if eye_cascade.empty():
+            eye_cascade = None
+        else:
+            print(f"✅ [INIT] Eye cascade loaded")
+    except Exception as e:
+        cascade = None
         eye_cascade = None
-    else:
-        print(f"✅ [INIT] Eye cascade loaded")
-except Exception as e:
-    cascade = None
-    eye_cascade = None
-    print(f"⚠️  [INIT] Haar cascade initialization error: {e}")
-session_sequences: Dict[int, deque] = defaultdict(lambda: deque(maxlen=SEQUENCE_LENGTH))
-session_frame_buffers: Dict[int, deque] = defaultdict(lambda: deque(maxlen=SEQUENCE_LENGTH))
+        print(f"⚠️  [INIT] Haar cascade initialization error: {e}")
+
+
+class _ThreadCascades(local):
+    """detectMultiScale no es seguro si dos hilos comparten el clasificador: uno por hilo."""
+
+    face = None
+    eye = None
+
+
+_thread_cascades = _ThreadCascades()
+
+
+def haar_cascades() -> tuple:
+    """
+    (rostro, ojos) del hilo actual, cargados la primera vez que el hilo los usa. Los
+    globales `cascade` / `eye_cascade` solo indican si cargaron en initialize_runtime.
+    """
+    tc = _thread_cascades
+    if tc.face is None and cascade is not None:
+        tc.face = cv2.CascadeClassifier(HAAR_FACE_XML)
+    if tc.eye is None and eye_cascade is not None:
+        tc.eye = cv2.CascadeClassifier(HAAR_EYE_XML)
+    return tc.face, tc.eye
+
+
+def _release_detector_state(session_key: int) -> None:
+    if face_mesh is not None:
+        face_mesh.release(session_key)
+    face_roi_tracker.forget(session_key)
+    haar_detector.forget(session_key)
+    frame_change_gate.forget(session_key)
+    last_model_scores.pop(session_key, None)
+    local_sessions.forget(session_key)
+
+
+session_store = create_session_store(
+    SESSION_STORE,
+    SEQUENCE_LENGTH,
+    SESSION_IDLE_TTL_S,
+    SESSION_MEMORY_BUDGET_MB,
+    frame_bytes=SESSION_FRAME_BYTES,
+    on_evict=_release_detector_state,
+    horizons=TEMPORAL_EMA_S,
+)
+# on_evict solo corre en el proceso que expulsa la sesion (y nunca con la expiracion por TTL
+# de redis): cada proceso (principal, workers del pool, shards) libera por su cuenta el
+# estado de detector de las sesiones que no ve hace SESSION_IDLE_TTL_S
+local_sessions = LocalSessionSweeper(SESSION_IDLE_TTL_S, _release_detector_state)
+
+
+def evict_idle_sessions() -> int:
+    return session_store.evict_idle() + local_sessions.sweep()
+
+
+async def call_session_store(fn, *args):
+    """Los backends remotos (redis) hacen I/O: se ejecutan fuera del event loop."""
+    if session_store.remote:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+def resolve_model_variant(path: str) -> str:
+    """Ruta de la variante ONNX_VARIANT de `path`; si no existe (o fue descartada al validar) usa fp32."""
+    if ONNX_VARIANT not in ONNX_VARIANTS:
+        return path
+    candidate = variant_path(path, ONNX_VARIANT)
+    return candidate.as_posix() if candidate.exists() else path
+
+
+def create_ort_session(path: str) -> ort.InferenceSession:
+    opts = session_options(ORT_INTRA_OP_THREADS, ORT_INTER_OP_THREADS, ORT_GRAPH_OPT_LEVEL)
+    return ort.InferenceSession(resolve_model_variant(path), opts, providers=["CPUExecutionProvider"])
+
 
-# Cargar modelo ONNX (opcional, fallback si no existe)
-try:
-    ort_session = ort.InferenceSession(MODEL_PATH, providers=["CPUExecutionProvider"])
-except Exception:
-    ort_session = None
+def split_model_loaded() -> bool:
+    # con encoder + cabeza cada frame se codifica una sola vez y el buffer
+    # de sesion guarda embeddings en lugar de crops 3x224x224
+    return model_registry.active.split
+
+
+def sequence_model_loaded() -> bool:
+    return model_registry.active.loaded
 
 
 def _start_background_training() -> None:
@@ -109,7 +388,404 @@ def _start_background_training() -> None:
     Thread(target=_run, daemon=True).start()
 
 
-_start_background_training()
+class CpuWorkerPool:
+    """
+    Pool acotado para el trabajo CPU-bound (decode, FaceMesh/Haar, ONNX).
+    El handler hace await sobre el pool y el event loop queda libre para
+    uploads, /health y reenvio al backend. Si hay mas de `max_queue` tareas
+    en vuelo se rechaza el frame en vez de encolarlo indefinidamente.
+    """
+
+    def __init__(self, mode: str, workers: int, max_queue: int):
+        self.mode = mode if mode in ("thread", "process") else "thread"
+        self.workers = max(workers, 1)
+        self.max_queue = max(max_queue, self.workers)
+        self.in_flight = 0
+        self._executor = None
+
+    def start(self) -> None:
+        if self._executor is not None:
+            return
+        if self.mode == "process":
+            # spawn: cada proceso importa ml_service e inicializa sus propios detectores/modelo
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_pool_worker,
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ml-cpu")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, fn, *args):
+        if self.in_flight >= self.max_queue:
+            FRAMES_REJECTED_TOTAL.inc(reason="saturated")
+            raise HTTPException(status_code=429, detail="ML service saturado, reintente", headers={"Retry-After": "1"})
+        self.start()
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def warm(self) -> int:
+        """Arranca todos los procesos del pool (cada uno corre su initializer); devuelve cuantos respondieron."""
+        self.start()
+        if self.mode != "process":
+            return self.workers
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*[
+            loop.run_in_executor(self._executor, _pool_worker_ready, 0.2) for _ in range(self.workers)
+        ])
+        return len(set(pids))
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+        }
+
+
+PRIORITY_D2R_URGENT, PRIORITY_D2R, PRIORITY_COURSE = range(3)
+PRIORITY_NAMES = ("d2r_urgent", "d2r", "course")
+
+
+def frame_priority(test_name: str, d2r_session_id: Optional[int], time_left: float) -> Tuple[int, float]:
+    """(clase, desempate): D2R antes que curso y, dentro de D2R, primero la fase con menos tiempo restante."""
+    normalized_test = (test_name or "").upper()
+    if normalized_test == "D2R" or (normalized_test == "" and d2r_session_id is not None):
+        time_left = max(float(time_left or 0.0), 0.0)
+        return (PRIORITY_D2R_URGENT if time_left <= PRIORITY_URGENT_S else PRIORITY_D2R, time_left)
+    return (PRIORITY_COURSE, 0.0)
+
+
+class _AdmissionTicket:
+    """Frame admitido que espera turno; `reason` queda con el motivo si se descarta."""
+
+    __slots__ = ("priority", "seq", "future", "reason")
+
+    def __init__(self, priority: Tuple[int, float], seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.future: Optional[asyncio.Future] = None
+        self.reason: Optional[str] = None
+
+    def __lt__(self, other: "_AdmissionTicket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def granted(self) -> bool:
+        future = self.future
+        return future is not None and future.done() and not future.cancelled() and future.result()
+
+
+class _AdmissionSlot:
+    """Sesion con un frame en curso (esperando el pool o en proceso); `waiting` es el frame que sigue."""
+
+    __slots__ = ("waiting",)
+
+    def __init__(self):
+        self.waiting: Optional[_AdmissionTicket] = None
+
+
+class FrameAdmission:
+    """
+    Control de admision y planificacion por prioridad de frames antes del pool CPU.
+
+    - Por sesion, el ultimo frame gana: a lo sumo uno en curso y uno en espera;
+      un frame nuevo reemplaza al que espera, que responde 409 de inmediato (el
+      score de atencion solo necesita el frame mas reciente).
+    - Turnos: como mucho `workers` frames en el pool; el resto espera en un heap
+      ordenado por prioridad (D2R con poco time_left, D2R, curso) y no por llegada.
+    - Sobrecarga: si hay `max_in_flight` frames admitidos o la espera estimada
+      (frames por delante x tiempo medio de analisis / workers) supera `max_wait_s`,
+      responde 429 con Retry-After sin encolar. Los frames de curso tienen solo
+      `course_share` de ambos limites, y un frame de D2R que encuentra la cola
+      llena desplaza al ultimo de curso en espera (que responde 429), asi bajo
+      carga se recorta primero el muestreo de los cursos.
+    """
+
+    def __init__(self, workers: int, max_in_flight: int, max_wait_s: float, course_share: float = 1.0):
+        self.workers = max(workers, 1)
+        self.max_in_flight = max(max_in_flight, self.workers)
+        self.max_wait_s = max_wait_s
+        self.course_share = min(max(course_share, 0.0), 1.0)
+        self.running = 0
+        self.queued = [0] * len(PRIORITY_NAMES)  # admitidos que todavia no entraron al pool
+        self.service_s = 0.0  # media movil del tiempo de analisis de un frame en el pool
+        self.superseded = 0
+        self.preempted = 0
+        self.shed = [0] * len(PRIORITY_NAMES)
+        self._slots: Dict[int, _AdmissionSlot] = {}
+        self._ready: List[_AdmissionTicket] = []  # heap de frames con turno de sesion esperando el pool
+        self._seq = itertools.count()
+
+    @property
+    def in_flight(self) -> int:
+        return self.running + sum(self.queued)
+
+    def expected_wait(self, cls: int = PRIORITY_COURSE) -> float:
+        """Espera estimada para un frame nuevo de clase `cls` (solo cuentan los de igual o mayor prioridad)."""
+        ahead = self.running + sum(self.queued[: cls + 1])
+        return ahead * self.service_s / self.workers
+
+    def observe(self, seconds: float) -> None:
+        self.service_s = seconds if self.service_s == 0.0 else 0.9 * self.service_s + 0.1 * seconds
+
+    def _check_overload(self, cls: int) -> None:
+        share = self.course_share if cls == PRIORITY_COURSE else 1.0
+        full = self.in_flight >= max(int(self.max_in_flight * share), 1)
+        if full and cls != PRIORITY_COURSE and self._preempt():
+            full = False
+        wait = self.expected_wait(cls)
+        if full or (self.max_wait_s > 0 and wait > self.max_wait_s * share):
+            self.shed[cls] += 1
+            FRAMES_REJECTED_TOTAL.inc(reason="overload")
+            ADMISSION_SHED_TOTAL.inc(priority=PRIORITY_NAMES[cls])
+            raise HTTPException(
+                status_code=429,
+                detail="ML service sobrecargado, reintente",
+                headers={"Retry-After": str(max(1, math.ceil(wait)))},
+            )
+
+    def _preempt(self) -> bool:
+        """Descarta el ultimo frame de curso que espera el pool para hacerle lugar a uno de D2R."""
+        victims = [t for t in self._ready if t.priority[0] == PRIORITY_COURSE and not t.future.done()]
+        if not victims:
+            return False
+        victim = max(victims)
+        self._ready.remove(victim)
+        heapq.heapify(self._ready)
+        self.preempted += 1
+        self.shed[PRIORITY_COURSE] += 1
+        FRAMES_REJECTED_TOTAL.inc(reason="preempted")
+        ADMISSION_SHED_TOTAL.inc(priority=PRIORITY_NAMES[PRIORITY_COURSE])
+        self._reject(victim, "preempted")
+        return True
+
+    def _reject(self, ticket: _AdmissionTicket, reason: str) -> None:
+        # la contabilidad la hace quien descarta, asi los contadores no quedan desfasados
+        # hasta que la corrutina del frame vuelva a correr
+        self.queued[ticket.priority[0]] -= 1
+        ticket.reason = reason
+        ticket.future.set_result(False)
+
+    def _rejection(self, ticket: _AdmissionTicket) -> HTTPException:
+        if ticket.reason == "superseded":
+            return HTTPException(status_code=409, detail="Frame reemplazado por uno mas reciente de la sesion")
+        wait = self.expected_wait(ticket.priority[0])
+        return HTTPException(
+            status_code=429,
+            detail="ML service sobrecargado, frame desplazado por uno prioritario",
+            headers={"Retry-After": str(max(1, math.ceil(wait)))},
+        )
+
+    def _release_session(self, session_key: int, slot: _AdmissionSlot) -> None:
+        waiter = slot.waiting
+        slot.waiting = None
+        if waiter is not None and not waiter.future.done():
+            # el turno de la sesion pasa directo al frame en espera, sin liberar el slot
+            waiter.future.set_result(True)
+        else:
+            self._slots.pop(session_key, None)
+
+    def _dispatch(self) -> None:
+        """Da turno en el pool a los frames de mayor prioridad mientras haya workers libres."""
+        while self.running < self.workers and self._ready:
+            ticket = heapq.heappop(self._ready)
+            if ticket.future.done():
+                continue  # cancelado: su corrutina descuenta el frame
+            self.queued[ticket.priority[0]] -= 1
+            self.running += 1
+            ticket.future.set_result(True)
+
+    def _release_worker(self) -> None:
+        self.running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, session_key: int, priority: Tuple[int, float] = (PRIORITY_COURSE, 0.0)):
+        cls = priority[0]
+        slot = self._slots.get(session_key)
+        if slot is not None and slot.waiting is not None and not slot.waiting.future.done():
+            self.superseded += 1
+            FRAMES_REJECTED_TOTAL.inc(reason="superseded")
+            self._reject(slot.waiting, "superseded")
+        else:
+            self._check_overload(cls)
+        ticket = _AdmissionTicket(priority, next(self._seq))
+        self.queued[cls] += 1
+        loop = asyncio.get_running_loop()
+
+        # 1) turno de la sesion
+        if slot is None:
+            slot = self._slots[session_key] = _AdmissionSlot()
+        else:
+            ticket.future = loop.create_future()
+            slot.waiting = ticket
+            try:
+                turn = await ticket.future
+            except asyncio.CancelledError:
+                # cliente desconectado mientras esperaba
+                if ticket.granted():
+                    self.queued[cls] -= 1
+                    self._release_session(session_key, slot)
+                elif ticket.reason is None:
+                    if slot.waiting is ticket:
+                        slot.waiting = None
+                    self.queued[cls] -= 1
+                raise
+            if not turn:
+                raise self._rejection(ticket)
+
+        # 2) turno en el pool, por prioridad (si hay un worker libre se resuelve sin esperar)
+        ticket.future = loop.create_future()
+        heapq.heappush(self._ready, ticket)
+        self._dispatch()
+        try:
+            turn = await ticket.future
+        except asyncio.CancelledError:
+            if ticket.granted():
+                self._release_worker()
+            elif ticket.reason is None:
+                if ticket in self._ready:
+                    self._ready.remove(ticket)
+                    heapq.heapify(self._ready)
+                self.queued[cls] -= 1
+            self._release_session(session_key, slot)
+            raise
+        if not turn:
+            self._release_session(session_key, slot)
+            raise self._rejection(ticket)
+        try:
+            yield
+        finally:
+            self._release_worker()
+            self._release_session(session_key, slot)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "running": self.running,
+            "workers": self.workers,
+            "queued": dict(zip(PRIORITY_NAMES, self.queued)),
+            "sessions": len(self._slots),
+            "waiting": sum(1 for slot in self._slots.values() if slot.waiting is not None),
+            "service_ms": round(self.service_s * 1000, 2),
+            "expected_wait_ms": {
+                name: round(self.expected_wait(cls) * 1000, 2) for cls, name in enumerate(PRIORITY_NAMES)
+            },
+            "max_wait_ms": round(self.max_wait_s * 1000, 2),
+            "course_share": self.course_share,
+            "superseded": self.superseded,
+            "preempted": self.preempted,
+            "shed": dict(zip(PRIORITY_NAMES, self.shed)),
+        }
+
+
+cpu_pool = CpuWorkerPool(ML_WORKER_MODE, ML_WORKERS, ML_MAX_QUEUE)
+frame_admission = FrameAdmission(ML_WORKERS, ML_MAX_QUEUE, ADMISSION_MAX_WAIT_MS / 1000, ADMISSION_COURSE_SHARE)
+backend_client: Optional[httpx.AsyncClient] = None
+background_tasks: List[asyncio.Task] = []
+
+
+async def _evict_idle_sessions_loop() -> None:
+    interval = max(min(SESSION_IDLE_TTL_S / 4, 60.0), 1.0)
+    while True:
+        await asyncio.sleep(interval)
+        evicted = await call_session_store(evict_idle_sessions)
+        if evicted:
+            print(f"[sessions] {evicted} sesiones inactivas liberadas")
+
+
+def create_backend_client() -> httpx.AsyncClient:
+    """Un solo cliente por proceso: reutiliza conexiones TCP/TLS al backend entre frames."""
+    http2 = BACKEND_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            http2 = False
+    headers = {"Authorization": f"Bearer {BACKEND_TOKEN}"} if BACKEND_TOKEN else {}
+    return httpx.AsyncClient(
+        timeout=BACKEND_TIMEOUT,
+        headers=headers,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=BACKEND_MAX_CONNECTIONS,
+            max_keepalive_connections=BACKEND_MAX_KEEPALIVE,
+        ),
+    )
+
+
+# Fases de arranque: el proceso acepta conexiones enseguida (/health) y /ready
+# pasa a 200 recien cuando detectores, modelo y workers estan calientes.
+startup_state: Dict[str, Any] = {"ready": False, "phase": "starting", "timings_ms": {}, "error": None}
+
+
+async def _startup_sequence() -> None:
+    started = time.perf_counter()
+    try:
+        startup_state["phase"] = "initializing"
+        # en modo process/sharded los detectores viven en los workers; aca solo hace falta el modelo
+        detectors = cpu_pool.mode != "process" and shard_engine is None
+        timings = await asyncio.to_thread(initialize_runtime, detectors)
+        startup_state["timings_ms"].update(timings)
+        if cpu_pool.mode == "process" or shard_engine is not None:
+            startup_state["phase"] = "warming_workers"
+            t0 = time.perf_counter()
+            if shard_engine is not None:
+                startup_state["workers_ready"] = await shard_engine.start()
+                if not startup_state["workers_ready"]:
+                    raise RuntimeError("Ningun worker sharded termino de inicializarse")
+            else:
+                startup_state["workers_ready"] = await cpu_pool.warm()
+            startup_state["timings_ms"]["workers"] = round((time.perf_counter() - t0) * 1000, 1)
+        startup_state["timings_ms"]["total"] = round((time.perf_counter() - started) * 1000, 1)
+        startup_state["phase"] = "ready"
+        startup_state["ready"] = True
+        print(f"✅ [INIT] Servicio listo en {startup_state['timings_ms']['total']} ms: {startup_state['timings_ms']}")
+    except Exception as e:
+        startup_state["phase"] = "failed"
+        startup_state["error"] = str(e)
+        frame_log.error("startup_failed", error=str(e))
+
+
+@app.on_event("startup")
+async def on_startup():
+    global backend_client
+    cpu_pool.start()
+    backend_client = create_backend_client()
+    event_outbox.start()
+    inference_batcher.start()
+    background_tasks.append(asyncio.create_task(_startup_sequence()))
+    if shard_engine is None:
+        # en modo sharded cada worker libera sus propias sesiones (on_idle de serve_shard)
+        background_tasks.append(asyncio.create_task(_evict_idle_sessions_loop()))
+    _start_background_training()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    global backend_client
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await inference_batcher.stop()
+    cpu_pool.shutdown()
+    if shard_engine is not None:
+        await asyncio.to_thread(shard_engine.shutdown)
+    await event_outbox.stop()
+    if backend_client is not None:
+        await backend_client.aclose()
+        backend_client = None
 
 
 class AttentionEventPayload(BaseModel):
@@ -128,37 +804,221 @@ class AttentionEventPayload(BaseModel):
         return self
 
 
-def compute_attention_score(image: np.ndarray) -> Dict[str, Any]:
+class FaceRoiTracker:
+    """
+    Region de interes por sesion: el bbox del ultimo rostro expandido `expand` veces.
+    La ROI solo se recentra cuando el rostro se acerca a su borde, asi entre frames
+    casi quietos el detector recibe siempre el mismo recorte (y FaceMesh puede seguir
+    trackeando). Se guarda normalizada a [0, 1] para no depender de la escala de
+    decode del frame. Es estado del detector del proceso duenio de la sesion y se
+    libera con ella (on_evict); sin afinidad de sesion (modo process, SESSION_STORE
+    shm/redis) el tracking queda desactivado.
+    """
+
+    def __init__(self, expand: float, min_size: int):
+        self.expand = max(expand, 1.0)
+        self.min_size = min_size
+        self._rois: Dict[int, tuple] = {}  # session -> (x0, y0, x1, y1, ancho del rostro), normalizados
+        self._lock = Lock()
+
+    def get(self, session_key: Optional[int], frame_shape) -> Optional[tuple]:
+        if session_key is None:
+            return None
+        roi = self._rois.get(session_key)
+        if roi is None:
+            return None
+        h, w = frame_shape[:2]
+        return (int(roi[0] * w), int(roi[1] * h), int(roi[2] * w), int(roi[3] * h))
+
+    def face_width_fraction(self, session_key: Optional[int]) -> Optional[float]:
+        roi = self._rois.get(session_key) if session_key is not None else None
+        return roi[4] if roi is not None else None
+
+    def update(self, session_key: Optional[int], bbox, frame_shape) -> None:
+        if session_key is None:
+            return
+        h, w = frame_shape[:2]
+        bx0, by0, bx1, by1 = bbox[0] / w, bbox[1] / h, bbox[2] / w, bbox[3] / h
+        current = self._rois.get(session_key)
+        if current is not None:
+            rx0, ry0, rx1, ry1, _ = current
+            margin_x = 0.1 * (rx1 - rx0)
+            margin_y = 0.1 * (ry1 - ry0)
+            if bx0 >= rx0 + margin_x and by0 >= ry0 + margin_y and bx1 <= rx1 - margin_x and by1 <= ry1 - margin_y:
+                with self._lock:
+                    self._rois[session_key] = (rx0, ry0, rx1, ry1, bx1 - bx0)
+                return
+        cx, cy = (bx0 + bx1) / 2.0, (by0 + by1) / 2.0
+        half_w = max((bx1 - bx0) * self.expand, self.min_size / w) / 2.0
+        half_h = max((by1 - by0) * self.expand, self.min_size / h) / 2.0
+        roi = (
+            max(cx - half_w, 0.0),
+            max(cy - half_h, 0.0),
+            min(cx + half_w, 1.0),
+            min(cy + half_h, 1.0),
+            bx1 - bx0,
+        )
+        with self._lock:
+            self._rois[session_key] = roi
+
+    def forget(self, session_key: Optional[int]) -> None:
+        with self._lock:
+            self._rois.pop(session_key, None)
+
+
+face_roi_tracker = FaceRoiTracker(ROI_EXPAND, ROI_MIN_SIZE)
+
+
+class FrameBuffers(local):
+    """
+    Buffers uint8 de trabajo por hilo para las conversiones intermedias de cada frame
+    (RGB para FaceMesh, gris y reduccion para Haar, miniatura del gate, crop del modelo
+    antes de pasarlo a RGB): se reutilizan mientras la forma no cambie en vez de reservar
+    arrays nuevos por frame. Solo para resultados que no salen de la funcion que los pide.
+    """
+
+    def get(self, name: str, shape: tuple) -> np.ndarray:
+        buf = self.__dict__.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.uint8)
+            setattr(self, name, buf)
+        return buf
+
+
+frame_buffers = FrameBuffers()
+
+
+HAAR_PARAMS = [
+    (1.1, 5, (60, 60)),
+    (1.05, 4, (48, 48)),
+    (1.03, 3, (32, 32)),
+]
+
+
+class HaarFaceDetector:
+    """
+    Fallback Haar sobre el gris reducido a `detect_width`, con el set de parametros
+    que funciono la ultima vez en la sesion. Si falla se prueba el siguiente set de la
+    escalera (0 -> 1 -> fino) en el mismo frame; al fino solo se escala como mucho cada
+    `fine_every` frames, y ningun set mas caro queda fijo: tras `fine_every` frames se
+    vuelve a probar uno mas barato. Un frame sin rostro cuesta un escaneo (dos cuando
+    toca la pasada fina) y no tres.
+    Con `per_session=False` (sesiones sin afinidad) la memoria es una sola por proceso.
+    """
+
+    def __init__(self, detect_width: int, fine_every: int, per_session: bool = True):
+        self.detect_width = detect_width
+        self.fine_every = max(fine_every, 1)
+        self.per_session = per_session
+        # session -> (indice de params, frames desde que se escalo al fino, frames con ese indice)
+        self._memory: Dict[Optional[int], Tuple[int, int, int]] = {}
+        self._lock = Lock()
+
+    def _run(self, small: np.ndarray, scale: float, idx: int):
+        scale_factor, min_neighbors, min_size = HAAR_PARAMS[idx]
+        min_side = max(int(min_size[0] * scale), 20)
+        faces = haar_cascades()[0].detectMultiScale(
+            small, scaleFactor=scale_factor, minNeighbors=min_neighbors, minSize=(min_side, min_side)
+        )
+        if len(faces) == 0:
+            return None
+        x, y, w, h = faces[0]
+        return (int(x / scale), int(y / scale), int(w / scale), int(h / scale))
+
+    def detect(self, gray: np.ndarray, session_key: Optional[int] = None):
+        h, w = gray.shape[:2]
+        scale = min(1.0, self.detect_width / float(max(h, w)))
+        if scale == 1.0:
+            small = gray
+        else:
+            size = (int(w * scale), int(h * scale))
+            small = cv2.resize(gray, size, dst=frame_buffers.get("haar_small", size[::-1]), interpolation=cv2.INTER_AREA)
+        if not self.per_session:
+            session_key = None
+        with self._lock:
+            start, since_fine, held = self._memory.get(session_key, (0, self.fine_every, 0))
+        fine_idx = len(HAAR_PARAMS) - 1
+
+        idx = start
+        if idx > 0 and held >= self.fine_every:
+            idx -= 1
+            held = 0
+        detected = self._run(small, scale, idx)
+        if detected is None and idx < fine_idx and (idx + 1 < fine_idx or since_fine >= self.fine_every):
+            idx += 1
+            if idx == fine_idx:
+                since_fine = 0
+            detected = self._run(small, scale, idx)
+        # tras un fallo se sigue desde el set intermedio: al fino solo se llega escalando
+        remembered = idx if detected is not None else min(idx, fine_idx - 1)
+        held = held + 1 if remembered == start else 1
+        with self._lock:
+            self._memory[session_key] = (remembered, since_fine + 1, held)
+        return detected, (HAAR_PARAMS[idx] if detected is not None else None)
+
+    def forget(self, session_key: Optional[int]) -> None:
+        with self._lock:
+            self._memory.pop(session_key, None)
+
+
+# sin afinidad de sesion la memoria por sesion quedaria en procesos que nunca la liberan
+haar_detector = HaarFaceDetector(HAAR_DETECT_WIDTH, HAAR_FINE_EVERY, per_session=STICKY_SESSIONS)
+
+
+def compute_attention_score(image: np.ndarray, session_key: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Score por frame con tracking de ROI: si la sesion tiene un rostro reciente se
+    detecta solo sobre la ROI (bbox previo expandido) y se vuelve a buscar en el
+    frame completo solo cuando el rostro se pierde.
+    """
+    frame_area = float(image.shape[0] * image.shape[1])
+    roi = face_roi_tracker.get(session_key, image.shape) if ROI_TRACKING else None
+    if roi is not None:
+        rx0, ry0, rx1, ry1 = roi
+        result = score_face(image[ry0:ry1, rx0:rx1], session_key, frame_area=frame_area, log_miss=False)
+        data = result.get("data", {})
+        if data.get("face", False):
+            bx0, by0, bx1, by1 = data["bbox"]
+            data["bbox"] = [bx0 + rx0, by0 + ry0, bx1 + rx0, by1 + ry0]
+            data["roi"] = [rx0, ry0, rx1, ry1]
+            face_roi_tracker.update(session_key, data["bbox"], image.shape)
+            return result
+    result = score_face(image, session_key, frame_area=frame_area)
+    if ROI_TRACKING:
+        if result.get("data", {}).get("face", False):
+            face_roi_tracker.update(session_key, result["data"]["bbox"], image.shape)
+        else:
+            face_roi_tracker.forget(session_key)
+    return result
+
+
+def score_face(
+    image: np.ndarray,
+    session_key: Optional[int] = None,
+    frame_area: Optional[float] = None,
+    log_miss: bool = True,
+) -> Dict[str, Any]:
     """
     Heurística inicial usando MediaPipe Face Mesh + Iris para microgestos y gaze.
     Devuelve score en [0,1] basado en:
     - Presencia de rostro
     - Apertura de ojos (EAR)
     - Desviación del gaze (iris) respecto al centro
+    `image` puede ser un recorte (ROI); `frame_area` es el area del frame completo
+    para que el area relativa del rostro no dependa del recorte.
     """
+    if frame_area is None:
+        frame_area = float(image.shape[0] * image.shape[1])
     if face_mesh is None:
         # Fallback to Haar cascade if available
         if cascade is not None:
             try:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                # Try multiple parameter sets to improve recall on varied camera images
-                params = [
-                    (1.1, 5, (60, 60)),
-                    (1.05, 4, (48, 48)),
-                    (1.03, 3, (32, 32)),
-                ]
-                detected = None
-                for scaleFactor, minNeighbors, minSize in params:
-                    faces = cascade.detectMultiScale(gray, scaleFactor=scaleFactor, minNeighbors=minNeighbors, minSize=minSize)
-                    print(f"[compute_attention_score] Haar try sf={scaleFactor} mn={minNeighbors} ms={minSize} -> found={len(faces)}")
-                    if len(faces) > 0:
-                        detected = faces[0]
-                        used_params = (scaleFactor, minNeighbors, minSize)
-                        break
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=frame_buffers.get("gray", image.shape[:2]))
+                detected, used_params = haar_detector.detect(gray, session_key)
                 if detected is not None:
                     x, y, w2, h2 = detected
                     bbox = [int(x), int(y), int(x + w2), int(y + h2)]
-                    area = (w2 * h2) / float(image.shape[0] * image.shape[1])
+                    area = (w2 * h2) / frame_area
                     
                     # IMPROVED SCORING: face_area + eye_detection + confidence
                     # Base score: larger face area = more attention (closer to camera)
@@ -169,7 +1029,7 @@ def compute_attention_score(image: np.ndarray) -> Dict[str, Any]:
                     if eye_cascade is not None:
                         try:
                             face_roi = gray[int(y):int(y+h2), int(x):int(x+w2)]
-                            eyes = eye_cascade.detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=5, minSize=(15, 15))
+                            eyes = haar_cascades()[1].detectMultiScale(face_roi, scaleFactor=1.1, minNeighbors=5, minSize=(15, 15))
                             # If we detect 2 eyes, full bonus; 1 eye = 0.5; 0 eyes = 0
                             if len(eyes) >= 2:
                                 eye_score = 0.3
@@ -191,7 +1051,10 @@ def compute_attention_score(image: np.ndarray) -> Dict[str, Any]:
                     # Composite score: 70% face area + 20% eye detection + 10% confidence
                     score = float(np.clip(0.7 * face_area_score + 0.2 * eye_score + 0.1 * confidence_score, 0.0, 1.0))
                     
-                    print(f"[compute_attention_score] ✅ Haar detected bbox={bbox} area={area:.4f} face_s={face_area_score:.2f} eye_s={eye_score:.2f} conf={confidence_score:.2f} → score={score:.2f}")
+                    frame_log.log(
+                        "haar_detected", bbox=bbox, area=round(area, 4), face_s=round(face_area_score, 2),
+                        eye_s=eye_score, conf=round(confidence_score, 2), score=round(score, 2),
+                    )
                     return {
                         "value": score,
                         "label": "attention_score",
@@ -207,21 +1070,30 @@ def compute_attention_score(image: np.ndarray) -> Dict[str, Any]:
                         },
                     }
             except Exception as e:
-                print(f"[compute_attention_score] ⚠️ Haar detection error: {e}")
+                frame_log.error("haar_error", error=str(e))
         # If no face detected or no cascade available, log image stats
         img_stats = {"shape": image.shape, "min": int(image.min()), "max": int(image.max()), "mean": int(image.mean())}
-        print(f"[compute_attention_score] ⚠️  NO DETECTADO: {img_stats} face_mesh={face_mesh is not None} cascade={cascade is not None}")
+        if log_miss:
+            frame_log.log("no_face", image_stats=img_stats, face_mesh=face_mesh is not None, cascade=cascade is not None)
         return {"value": None, "label": "no_face", "data": {"face": False, "image_stats": img_stats}}
 
     h, w, _ = image.shape
-    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    result = face_mesh.process(rgb)
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=frame_buffers.get("rgb", image.shape))
+    result = face_mesh.process(rgb, session_key)
 
     if not result.multi_face_landmarks:
         return {"value": None, "label": "no_face", "data": {"face": False}}
 
     face = result.multi_face_landmarks[0]
     landmarks = [(lm.x * w, lm.y * h, lm.z) for lm in face.landmark]
+    return score_landmarks(landmarks, w, h)
+
+
+def score_landmarks(landmarks, w: float, h: float) -> Dict[str, Any]:
+    """
+    EAR, iris y gaze a partir de los 478 landmarks de Face Mesh + Iris en pixeles
+    (x, y, z). Lo usa score_face y /analyze/landmarks cuando el mesh corre en el cliente.
+    """
     xs = [p[0] for p in landmarks]
     ys = [p[1] for p in landmarks]
     x0, x1 = max(min(xs), 0), min(max(xs), w)
@@ -288,12 +1160,15 @@ def compute_attention_score(image: np.ndarray) -> Dict[str, Any]:
     }
 
 
+def combine_temporal(score: float, eyes: float, gaze: float) -> float:
+    return min(max(0.6 * score + 0.2 * eyes + 0.2 * gaze, 0.0), 1.0)
+
+
 def aggregate_temporal_score(session_id: int, frame_result: Dict[str, Any]) -> Dict[str, Any]:
     """
     Placeholder para CNN-LSTM: agregamos características de la ventana reciente
     y calculamos un score temporal. Sustituir por inferencia real de modelo secuencial.
     """
-    seq = session_sequences[session_id]
     score_val = frame_result.get("value")
     
     # Extract features - handle both MediaPipe and Haar fallback data
@@ -302,53 +1177,812 @@ def aggregate_temporal_score(session_id: int, frame_result: Dict[str, Any]) -> D
     gaze_center = data.get("gaze_center", data.get("confidence", 0))  # Haar uses confidence
     ear = data.get("ear", 0)
     
-    seq.append(
+    summary = session_store.push_features(
+        session_id,
         {
             "score": score_val,
             "eyes_open": eyes_open,
             "gaze_center": gaze_center,
             "ear": ear,
-        }
+        },
     )
-    scores = [x["score"] for x in seq if x.get("score") is not None]
-    eyes = [x["eyes_open"] for x in seq]
-    gaze = [x["gaze_center"] for x in seq]
-
-    temporal_score = float(np.mean(scores)) if scores else 0.0
-    eyes_score = float(np.mean(eyes)) if eyes else 0.0
-    gaze_score = float(np.mean(gaze)) if gaze else 0.0
+    temporal_score = summary["score_mean"] or 0.0
+    eyes_score = summary["eyes_mean"]
+    gaze_score = summary["gaze_mean"]
 
-    combined = float(np.clip(0.6 * temporal_score + 0.2 * eyes_score + 0.2 * gaze_score, 0, 1))
+    # medias exponenciales por horizonte de tiempo ("2s", "8s", "60s"), sin costo extra por frame
+    ema = {}
+    for horizon, means in summary["ema"].items():
+        ema_score = means["score"] or 0.0
+        ema[f"{horizon:g}s"] = {
+            "score": ema_score,
+            "eyes": means["eyes"],
+            "gaze": means["gaze"],
+            "combined": combine_temporal(ema_score, means["eyes"], means["gaze"]),
+        }
 
     return {
-        "value": combined,
+        "value": combine_temporal(temporal_score, eyes_score, gaze_score),
         "label": "attention_sequence_score",
         "data": {
-            "sequence_len": len(seq),
+            "sequence_len": summary["sequence_len"],
             "frame_score": score_val,
             "temporal_mean": temporal_score,
             "eyes_mean": eyes_score,
             "gaze_mean": gaze_score,
+            "ema": ema,
         },
     }
 
 
-async def post_event_to_backend(payload: AttentionEventPayload, test_name: str = "D2R") -> None:
-    if not BACKEND_TOKEN:
+def extract_model_crop(image: np.ndarray, bbox) -> Optional[np.ndarray]:
+    """Recorta el rostro (con margen del 10%) y lo redimensiona a MODEL_IMG_SIZE como RGB uint8."""
+    try:
+        if bbox:
+            x0, y0, x1, y1 = map(int, bbox)
+            x0 = max(x0 - int(0.1 * (x1 - x0)), 0)
+            y0 = max(y0 - int(0.1 * (y1 - y0)), 0)
+            x1 = min(x1 + int(0.1 * (x1 - x0)), image.shape[1])
+            y1 = min(y1 + int(0.1 * (y1 - y0)), image.shape[0])
+            crop = image[y0:y1, x0:x1]
+        else:
+            crop = image
+        crop = cv2.resize(
+            crop, (MODEL_IMG_SIZE, MODEL_IMG_SIZE), dst=frame_buffers.get("model_crop", (MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3))
+        )
+        # array nuevo: el crop RGB se guarda en el buffer de la sesion
+        return cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)  # H,W,C uint8, tal como lo recibe el modelo
+    except Exception as e:
+        frame_log.error("model_crop_error", error=str(e))
+        return None
+
+
+def normalize_crops(crops: np.ndarray) -> np.ndarray:
+    """uint8 (..., H, W, C) -> float32 (..., C, H, W) en [0, 1], para modelos sin preprocesado en el grafo."""
+    arr = crops.astype(np.float32) * (1.0 / 255.0)
+    return np.moveaxis(arr, -1, -3)
+
+
+def crops_input(session, crops: np.ndarray) -> np.ndarray:
+    """
+    Entrada de imagen para `session`: los modelos exportados con el preprocesado en el
+    grafo reciben los crops uint8 N,H,W,C tal cual; los anteriores, float32 N,C,H,W.
+    """
+    if session.get_inputs()[0].type == "tensor(uint8)":
+        return crops
+    return normalize_crops(crops)
+
+
+def warmup_models(bundle: ModelBundle) -> None:
+    """Primera inferencia con entradas dummy antes de publicar una version (asigna memoria y kernels)."""
+    crops = np.zeros((1, MODEL_IMG_SIZE, MODEL_IMG_SIZE, 3), dtype=np.uint8)
+    if bundle.split:
+        emb = bundle.encoder.run(None, {"frame": crops_input(bundle.encoder, crops)})[0]
+        bundle.head.run(None, {"embeddings": np.repeat(emb[:, None, :], SEQUENCE_LENGTH, axis=1)})
+    if bundle.full is not None:
+        bundle.full.run(None, {"frames": crops_input(bundle.full, np.repeat(crops[:, None], SEQUENCE_LENGTH, axis=1))})
+
+
+# Cargar modelo ONNX (opcional, fallback si no existe). Cada proceso del pool
+# carga su copia y sigue la version activa del registro.
+model_registry = ModelRegistry(
+    MODEL_PATH,
+    ENCODER_MODEL_PATH,
+    HEAD_MODEL_PATH,
+    MODEL_VERSIONS_DIR,
+    create_ort_session,
+    warmup_models,
+    keep=MODEL_KEEP_VERSIONS,
+    poll_s=MODEL_POLL_S,
+    stable_s=MODEL_STABLE_S,
+    watch=MODEL_WATCH,
+)
+
+
+def encode_frame(crop: np.ndarray, bundle: Optional[ModelBundle] = None) -> Optional[np.ndarray]:
+    """Embedding de un crop H,W,C uint8 con el encoder partido; None si falla."""
+    encoder = (bundle or model_registry.active).encoder
+    if encoder is None:
+        return None
+    try:
+        out = encoder.run(None, {"frame": crops_input(encoder, crop[None, ...])})
+        return np.asarray(out[0][0], dtype=np.float32)
+    except Exception as e:
+        frame_log.error("encoder_error", error=str(e))
+        return None
+
+
+class FrameChangeGate:
+    """
+    Detector de cambio por sesion: compara una miniatura en gris del frame con la
+    del ultimo frame analizado. Si la diferencia media es menor que `threshold` se
+    reutilizan landmarks, score y entrada del modelo del frame anterior, como mucho
+    `max_reuse` veces seguidas (y solo si la entrada del modelo es de la misma version).
+    Es estado del detector del proceso duenio de la sesion y se libera con ella
+    (on_evict); sin afinidad de sesion (modo process, SESSION_STORE shm/redis) queda
+    desactivado.
+    """
+
+    THUMB_SIZE = (32, 24)
+
+    def __init__(self, threshold: float, max_reuse: int):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self._last: Dict[int, list] = {}  # session -> [miniatura, resultado, model_input, reusos seguidos, version]
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0 and self.max_reuse > 0
+
+    def thumbnail(self, image: np.ndarray) -> np.ndarray:
+        small = cv2.resize(
+            image, self.THUMB_SIZE, dst=frame_buffers.get("thumb", (*self.THUMB_SIZE[::-1], 3)), interpolation=cv2.INTER_AREA
+        )
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)  # la miniatura gris si se guarda por sesion
+
+    def check(self, session_key: Optional[int], thumb: np.ndarray, version: Optional[str] = None):
+        """Devuelve (resultado, model_input) reutilizables o None si hay que analizar el frame."""
+        entry = self._last.get(session_key) if session_key is not None else None
+        if entry is None or entry[3] >= self.max_reuse or entry[4] != version:
+            return None
+        diff = float(cv2.absdiff(thumb, entry[0]).mean())
+        if diff >= self.threshold:
+            return None
+        entry[3] += 1
+        result = copy.deepcopy(entry[1])
+        data = result.setdefault("data", {})
+        data["reused"] = True
+        data["frame_diff"] = round(diff, 3)
+        return result, entry[2]
+
+    def remember(
+        self,
+        session_key: Optional[int],
+        thumb: np.ndarray,
+        result: Dict[str, Any],
+        model_input,
+        version: Optional[str] = None,
+    ) -> None:
+        if session_key is None:
+            return
+        with self._lock:
+            self._last[session_key] = [thumb, copy.deepcopy(result), model_input, 0, version]
+
+    def forget(self, session_key: Optional[int]) -> None:
+        with self._lock:
+            self._last.pop(session_key, None)
+
+
+# sin afinidad de sesion el frame previo puede haberse analizado en otro proceso: gate desactivado
+frame_change_gate = FrameChangeGate(FRAME_REUSE_THRESHOLD if STICKY_SESSIONS else 0.0, FRAME_REUSE_MAX)
+# Ultimo score del modelo por sesion (version, score), para no reejecutar ONNX sobre frames reutilizados
+last_model_scores: Dict[int, Tuple[Optional[str], float]] = {}
+
+
+def image_dimensions(content: bytes) -> Optional[tuple]:
+    """(ancho, alto) leyendo solo la cabecera JPEG (marcador SOF) o PNG (IHDR)."""
+    if content[:8] == b"\x89PNG\r\n\x1a\n" and len(content) >= 24:
+        return int.from_bytes(content[16:20], "big"), int.from_bytes(content[20:24], "big")
+    if content[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(content):
+        if content[i] != 0xFF:
+            i += 1
+            continue
+        marker = content[i + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+            i += 1 if marker == 0xFF else 2
+            continue
+        length = int.from_bytes(content[i + 2 : i + 4], "big")
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h = int.from_bytes(content[i + 5 : i + 7], "big")
+            w = int.from_bytes(content[i + 7 : i + 9], "big")
+            return w, h
+        i += 2 + length
+    return None
+
+
+_REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def choose_decode_scale(dims: Optional[tuple], session_key: Optional[int] = None) -> int:
+    """
+    Mayor reduccion (1/2/4/8) que deja al menos DECODE_MIN_WIDTH px para el detector y,
+    si se conoce el tamaño del rostro de la sesion, al menos MODEL_CROP_MIN_SIDE px de
+    rostro para que el crop del modelo no se amplie demasiado al llevarlo a MODEL_IMG_SIZE.
+    """
+    if not DECODE_REDUCED or dims is None:
+        return 1
+    width = dims[0]
+    face_fraction = face_roi_tracker.face_width_fraction(session_key) if sequence_model_loaded() else None
+    scale = 1
+    for candidate in (2, 4, 8):
+        if width / candidate < DECODE_MIN_WIDTH:
+            break
+        if face_fraction is not None and face_fraction * width / candidate < MODEL_CROP_MIN_SIDE:
+            break
+        scale = candidate
+    return scale
+
+
+def decode_frame(content: bytes, session_key: Optional[int] = None):
+    """
+    Decodifica el frame a escala reducida cuando alcanza para detector y modelo; devuelve
+    (imagen, escala). cv2.imdecode no acepta un destino preasignado desde Python, por eso
+    la reutilizacion de buffers empieza en las conversiones posteriores (FrameBuffers).
+    """
+    np_arr = np.frombuffer(content, np.uint8)
+    scale = choose_decode_scale(image_dimensions(content), session_key)
+    image = cv2.imdecode(np_arr, _REDUCED_DECODE_FLAGS[scale])
+    if image is None and scale > 1:
+        scale = 1
+        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+    return image, scale
+
+
+def analyze_image(content: bytes, session_key: Optional[int] = None):
+    """
+    Trabajo CPU-bound de un frame: decode + score por frame + entrada del modelo.
+    Se ejecuta dentro de `cpu_pool` (thread o proceso), por eso recibe bytes
+    y devuelve solo datos serializables. La entrada del modelo es el embedding
+    del frame si el modelo esta partido, o el crop uint8 si no, y va etiquetada
+    con la version del modelo que la produjo (los buffers se vacian al cambiarla).
+    Devuelve (resultado, entrada del modelo, version, tiempos por etapa en segundos);
+    resultado None si no decodifica.
+    """
+    initialize_runtime()  # no-op si el proceso ya esta inicializado
+    local_sessions.touch(session_key)
+    bundle = model_registry.active  # una sola version por frame aunque haya un swap en curso
+    timings: Dict[str, float] = {}
+    t0 = time.perf_counter()
+    image, scale = decode_frame(content, session_key)
+    t1 = time.perf_counter()
+    timings["decode"] = t1 - t0
+    if image is None:
+        return None, None, bundle.version, timings
+    thumb = None
+    if frame_change_gate.enabled:
+        thumb = frame_change_gate.thumbnail(image)
+        reused = frame_change_gate.check(session_key, thumb, bundle.version)
+        t2 = time.perf_counter()
+        timings["change_gate"] = t2 - t1
+        t1 = t2
+        if reused is not None:
+            return reused[0], reused[1], bundle.version, timings
+    result = compute_attention_score(image, session_key)
+    t2 = time.perf_counter()
+    timings["facemesh" if face_mesh is not None else "haar"] = t2 - t1
+    model_input = None
+    data = result.get("data", {})
+    if data.get("face", False):
+        model_input = extract_model_crop(image, data.get("bbox"))
+        t3 = time.perf_counter()
+        timings["preprocess"] = t3 - t2
+        if model_input is not None and bundle.split:
+            model_input = encode_frame(model_input, bundle)
+            timings["encoder"] = time.perf_counter() - t3
+    if scale > 1:
+        # coordenadas reportadas siempre en pixeles del frame original
+        if data.get("bbox"):
+            data["bbox"] = [v * scale for v in data["bbox"]]
+        if data.get("roi"):
+            data["roi"] = [v * scale for v in data["roi"]]
+        data["decode_scale"] = scale
+    if thumb is not None:
+        frame_change_gate.remember(session_key, thumb, result, model_input, bundle.version)
+    return result, model_input, bundle.version, timings
+
+
+def run_sequence_model(seqs: List[List[np.ndarray]], version: Optional[str] = None) -> Optional[List[float]]:
+    """
+    Inferencia CNN-LSTM para varias secuencias (una por sesion) en una sola llamada ONNX.
+    Cada secuencia es una lista de T embeddings (modelo partido) o T crops H,W,C
+    uint8 (modelo completo); devuelve un score por secuencia. Con `version`, None si
+    la version activa ya es otra (embeddings de un encoder con la cabeza de otro).
+    """
+    bundle = model_registry.active
+    if not bundle.loaded or (version is not None and bundle.version != version):
+        return None
+    try:
+        arr = np.stack([np.stack(seq, axis=0) for seq in seqs], axis=0)  # B,T,E o B,T,H,W,C
+        if bundle.split:
+            ort_out = bundle.head.run(None, {"embeddings": arr})
+        else:
+            ort_out = bundle.full.run(None, {"frames": crops_input(bundle.full, arr), "mask": None})
+        if ort_out:
+            scores = np.clip(np.ravel(ort_out[0])[: len(seqs)], 0.0, 1.0)
+            frame_log.log("model_batch", batch=len(seqs), scores=np.round(scores, 4).tolist())
+            return [float(x) for x in scores]
+    except Exception as e:
+        frame_log.error("model_error", error=str(e))
+    return None
+
+
+def model_supports_batching() -> bool:
+    """El modelo exportado con eje `batch` dinamico acepta B>1; los exportados con B=1 fijo no."""
+    bundle = model_registry.active
+    session = bundle.head if bundle.split else bundle.full
+    if session is None:
+        return False
+    batch_dim = session.get_inputs()[0].shape[0]
+    return not isinstance(batch_dim, int) or batch_dim > 1
+
+
+WARMUP_IMAGE = Path(__file__).with_name("test_image_sent.jpg")
+_runtime_lock = Lock()
+_runtime_ready = False
+
+
+def warmup_pipeline() -> None:
+    """Recorre decode, detectores y crop con frames sinteticos para que el primer frame real no pague la inicializacion perezosa."""
+    if WARMUP_IMAGE.exists():
+        content = WARMUP_IMAGE.read_bytes()
+    else:
+        noise = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        content = cv2.imencode(".jpg", noise)[1].tobytes()
+    image, _ = decode_frame(content)
+    if image is None:
         return
+    if face_mesh is not None:
+        face_mesh.warmup(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    result = score_face(image, session_key=None, log_miss=False)
+    haar_detector.forget(None)
+    bbox = result.get("data", {}).get("bbox") or [0, 0, image.shape[1], image.shape[0]]
+    crop = extract_model_crop(image, bbox)
+    if crop is not None and split_model_loaded():
+        encode_frame(crop)
+
+
+def initialize_runtime(detectors: bool = True) -> Dict[str, float]:
+    """
+    Inicializa detectores y modelo en paralelo y hace el warm-up; idempotente por proceso.
+    Devuelve la duracion de cada fase en ms. `detectors=False` se usa en el proceso
+    principal en modo process: ahi solo hace falta el modelo (los frames se analizan en los workers).
+    """
+    global _runtime_ready
+    timings: Dict[str, float] = {}
+    if _runtime_ready:
+        return timings
+    with _runtime_lock:
+        if _runtime_ready:
+            return timings
+
+        def timed(fn):
+            start = time.perf_counter()
+            fn()
+            return round((time.perf_counter() - start) * 1000, 1)
+
+        phases = [("model", model_registry.load_initial)]
+        if detectors:
+            phases += [("facemesh", init_face_mesh), ("haar", init_haar_cascades)]
+        with ThreadPoolExecutor(max_workers=len(phases), thread_name_prefix="ml-init") as executor:
+            futures = [(name, executor.submit(timed, fn)) for name, fn in phases]
+            for name, future in futures:
+                timings[name] = future.result()
+        if detectors:
+            timings["warmup"] = timed(warmup_pipeline)
+        model_registry.start()
+        _runtime_ready = True
+    return timings
+
+
+def _init_pool_worker() -> None:
+    initialize_runtime(detectors=True)
+
+
+def _pool_worker_ready(delay_s: float) -> int:
+    # la pausa reparte las tareas de calentamiento entre todos los procesos del pool
+    time.sleep(delay_s)
+    return os.getpid()
+
+
+class InferenceBatcher:
+    """
+    Micro-batching entre sesiones: junta secuencias listas durante hasta
+    `max_wait_ms` (o hasta `max_batch`) y las ejecuta en una sola llamada
+    ONNX dentro de `cpu_pool`. Cada llamador recibe solo su score. La inferencia
+    corre despues de la admision del frame (que ya ocupo su turno del pool): si el
+    pool esta lleno el frame se responde con su score por frame (model_score None)
+    en vez de un 429 para un frame ya analizado.
+    """
+
+    def __init__(self, max_batch: int, max_wait_ms: float):
+        self.max_batch = max(max_batch, 1)
+        self.max_wait = max(max_wait_ms, 0.0) / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batches: set = set()  # referencias a los batches en curso (el loop solo guarda weakrefs)
+        self.batches_run = 0
+        self.sequences_run = 0
+        self.skipped = 0
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # los batches en curso terminan (el pool se apaga despues); lo que quedo en cola no corre
+        await asyncio.gather(*self._batches, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_result(None)
+
+    async def _run_model(self, seqs: List[List[np.ndarray]], version: Optional[str]) -> Optional[List[float]]:
+        try:
+            return await cpu_pool.run(run_sequence_model, seqs, version)
+        except HTTPException:
+            # pool lleno: los frames ya se analizaron, quedan con su score por frame
+            self.skipped += len(seqs)
+            return None
+
+    async def infer(self, seq: List[np.ndarray], version: Optional[str] = None) -> Optional[float]:
+        # el soporte de batch depende de la version activa del modelo (puede cambiar en caliente)
+        if self._task is None or self.max_batch == 1 or not model_supports_batching():
+            scores = await self._run_model([seq], version)
+            return scores[0] if scores else None
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((seq, version, future))
+        return await future
+
+    async def _collect_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # el batch corre en el pool mientras se sigue juntando el siguiente;
+            # durante un swap cada version va en su propia llamada
+            versions: Dict[Optional[str], list] = {}
+            for seq, version, future in batch:
+                versions.setdefault(version, []).append((seq, future))
+            for version, group in versions.items():
+                task = asyncio.create_task(self._run_batch(group, version))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch, version: Optional[str] = None) -> None:
+        seqs = [seq for seq, _ in batch]
+        try:
+            scores = await self._run_model(seqs, version)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if scores is not None:
+            self.batches_run += 1
+            self.sequences_run += len(batch)
+        for i, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(scores[i] if scores else None)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "max_batch": self.max_batch if model_supports_batching() else 1,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "batches_run": self.batches_run,
+            "avg_batch_size": (self.sequences_run / self.batches_run) if self.batches_run else 0.0,
+            "skipped": self.skipped,
+        }
+
+
+inference_batcher = InferenceBatcher(INFER_MAX_BATCH, INFER_MAX_WAIT_MS)
+
+
+def sequence_model_due(buffered: int, spinning: int) -> bool:
+    return sequence_model_loaded() and buffered >= SEQUENCE_LENGTH and int(spinning) == 0
+
+
+def reusable_model_score(session_key: int, version: Optional[str]) -> Optional[float]:
+    last = last_model_scores.get(session_key)
+    return last[1] if last is not None and last[0] == version else None
+
+
+async def score_sequence(
+    session_key: int, model_input, model_version: Optional[str], reused: bool, spinning: int
+) -> Optional[float]:
+    """
+    Agrega la entrada al buffer de la sesion y, con la ventana completa, corre el CNN-LSTM
+    (micro-batch). La ventana solo se lee del store cuando de verdad se va a inferir.
+    """
+    if model_input is None:
+        return None
+    local_sessions.touch(session_key)  # last_model_scores vive en este proceso aunque el analisis corra en otro
+    buffered = await call_session_store(session_store.push_model_input, session_key, model_input, model_version)
+    if not sequence_model_due(buffered, spinning):
+        return None
+    last_score = reusable_model_score(session_key, model_version) if reused else None
+    if last_score is not None:
+        MODEL_RUNS_TOTAL.inc(source="reused")
+        return last_score
+    window = await call_session_store(session_store.model_window, session_key)
+    if len(window) < SEQUENCE_LENGTH:
+        return None  # la sesion se expulso entre el push y la lectura
+    infer_start = time.perf_counter()
+    model_score = await inference_batcher.infer(window[-SEQUENCE_LENGTH:], model_version)
+    STAGE_SECONDS.observe(time.perf_counter() - infer_start, stage="inference")
+    if model_score is not None:
+        last_model_scores[session_key] = (model_version, model_score)
+        MODEL_RUNS_TOTAL.inc(source="onnx")
+    return model_score
+
+
+def analyze_session_frame(content: bytes, session_key: int, spinning: int = 0) -> Dict[str, Any]:
+    """
+    Pipeline completo de un frame dentro de un worker sharded: analisis, agregacion
+    temporal y CNN-LSTM con el estado local de la sesion. Devuelve solo datos chicos
+    (el buffer del modelo nunca sale del proceso).
+    """
+    result, model_input, model_version, timings = analyze_image(content, session_key)
+    reply = {"result": result, "temporal": None, "model_score": None, "model_source": None, "timings": timings}
+    if result is None:
+        return reply
+    t0 = time.perf_counter()
+    reply["temporal"] = aggregate_temporal_score(session_key, result)
+    timings["temporal"] = time.perf_counter() - t0
+    if model_input is None:
+        return reply
+    buffered = session_store.push_model_input(session_key, model_input, model_version)
+    if not sequence_model_due(buffered, spinning):
+        return reply
+    last_score = reusable_model_score(session_key, model_version) if result.get("data", {}).get("reused") else None
+    if last_score is not None:
+        reply["model_score"], reply["model_source"] = last_score, "reused"
+        return reply
+    t1 = time.perf_counter()
+    scores = run_sequence_model([session_store.model_window(session_key)[-SEQUENCE_LENGTH:]], model_version)
+    timings["inference"] = time.perf_counter() - t1
+    if scores:
+        reply["model_score"] = scores[0]
+        last_model_scores[session_key] = (model_version, scores[0])
+        reply["model_source"] = "onnx"
+    return reply
+
+
+def backend_endpoint_for(payload: AttentionEventPayload, test_name: str = "D2R") -> str:
     normalized_test = (test_name or "").upper()
     is_d2r = normalized_test == "D2R" or (normalized_test == "" and payload.d2r_session_id is not None)
     if is_d2r and not payload.d2r_session_id:
         raise HTTPException(status_code=400, detail="d2r_session_id requerido")
     if not is_d2r and not payload.session_id:
         raise HTTPException(status_code=400, detail="session_id requerido")
-    endpoint = "/api/d2r-attention-events/" if is_d2r else "/api/attention-events/"
+    return "/api/d2r-attention-events/" if is_d2r else "/api/attention-events/"
+
+
+async def post_json_to_backend(endpoint: str, body: Any) -> httpx.Response:
     url = f"{BACKEND_URL}{endpoint}"
-    headers = {"Authorization": f"Bearer {BACKEND_TOKEN}"}
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.post(url, json=payload.model_dump())
-        if resp.status_code >= 400:
-            raise HTTPException(status_code=502, detail="Backend event post failed")
+    client = backend_client
+    if client is None:
+        # fuera del ciclo de vida de la app (scripts/tests): cliente efimero
+        async with create_backend_client() as client:
+            return await client.post(url, json=body)
+    return await client.post(url, json=body)
+
+
+async def post_event_to_backend(payload: AttentionEventPayload, test_name: str = "D2R") -> None:
+    if not BACKEND_TOKEN:
+        return
+    endpoint = backend_endpoint_for(payload, test_name)
+    start = time.perf_counter()
+    try:
+        resp = await post_json_to_backend(endpoint, payload.model_dump(mode="json"))
+    except httpx.HTTPError:
+        FORWARD_FAILURES_TOTAL.inc(reason="http_error")
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="backend_post")
+    if resp.status_code >= 400:
+        FORWARD_FAILURES_TOTAL.inc(reason=f"status_{resp.status_code}")
+        raise HTTPException(status_code=502, detail="Backend event post failed")
+
+
+class EventOutbox:
+    """
+    Outbox en memoria para eventos de atencion: analyze_frame encola y responde
+    sin esperar al backend. Una tarea de fondo vacia la cola en lotes (al llegar
+    a `batch_size` o cada `flush_interval_ms`) usando el endpoint bulk. Solo se
+    reintentan los errores transitorios: transporte, 429 y 5xx. Tras un lote con
+    reintentos el siguiente envio espera un backoff exponencial (desde
+    `flush_interval_ms` hasta `backoff_max_ms`), y un evento se descarta cuando lleva
+    `max_retry_s` segundos fallando, asi un corte breve del backend no pierde eventos.
+    Un 4xx se descarta por evento, usando los rechazos por item del bulk, sin
+    arrastrar al resto del lote. Si se supera `max_events` se descartan los eventos
+    mas viejos, para acotar la memoria si el backend esta caido.
+    """
+
+    def __init__(
+        self,
+        batch_size: int,
+        flush_interval_ms: float,
+        max_events: int,
+        max_retry_s: float,
+        backoff_max_ms: float = 30000.0,
+        clock=time.monotonic,
+    ):
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = max(flush_interval_ms, 1.0) / 1000.0
+        self.max_events = max(max_events, self.batch_size)
+        self.max_retry_s = max(max_retry_s, 0.0)
+        self.backoff_max = max(backoff_max_ms / 1000.0, self.flush_interval)
+        self.backoff = 0.0  # espera antes del proximo envio; 0 mientras el backend responde
+        self.clock = clock
+        self._events: deque = deque()  # (endpoint, body, intentos, momento del primer fallo)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # ultimo intento de vaciar lo pendiente antes de cerrar el cliente
+        while self._events and await self.flush_once():
+            pass
+
+    def put(self, payload: AttentionEventPayload, test_name: str = "D2R") -> bool:
+        if not BACKEND_TOKEN:
+            return False
+        endpoint = backend_endpoint_for(payload, test_name)
+        if len(self._events) >= self.max_events:
+            self._events.popleft()
+            self.dropped += 1
+            FORWARD_FAILURES_TOTAL.inc(reason="outbox_full")
+        self._events.append((endpoint, payload.model_dump(mode="json"), 0, None))
+        if self._wakeup is not None and len(self._events) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _flush_loop(self) -> None:
+        while True:
+            if self.backoff:
+                # backend con errores: ni el tick ni un lote lleno adelantan el reintento
+                await asyncio.sleep(self.backoff)
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            # si un lote falla se reintenta despues del backoff, no en bucle
+            while self._events and await self.flush_once():
+                pass
+
+    async def _send(self, endpoint: str, body: Any) -> Tuple[int, Any]:
+        """POST al backend; devuelve (status, cuerpo JSON o None). Status 0 = error de transporte."""
+        start = time.perf_counter()
+        try:
+            resp = await post_json_to_backend(endpoint, body)
+        except httpx.HTTPError:
+            return 0, None
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="backend_post")
+        try:
+            return resp.status_code, resp.json()
+        except ValueError:
+            return resp.status_code, None
+
+    @staticmethod
+    def _outcome(status_code: int) -> str:
+        """2xx/3xx enviado; transporte, 408, 429 y 5xx se reintentan; el resto de 4xx no se va a aceptar nunca."""
+        if 200 <= status_code < 400:
+            return "sent"
+        if status_code in (0, 408, 429) or status_code >= 500:
+            return "retry"
+        return "rejected"
+
+    async def _send_one(self, endpoint: str, body: Any) -> Tuple[str, Any]:
+        status_code, data = await self._send(endpoint, body)
+        return self._outcome(status_code), data
+
+    async def _send_group(self, endpoint: str, bodies: List[Any]) -> List[Tuple[str, Any]]:
+        """Un POST /bulk/ con resultado por evento: los rechazos por item del backend descartan solo esos eventos."""
+        status_code, data = await self._send(f"{endpoint}bulk/", bodies)
+        outcome = self._outcome(status_code)
+        if outcome == "sent":
+            results = [("sent", None)] * len(bodies)
+            rejected = data.get("rejected") if isinstance(data, dict) else None
+            for item in rejected or []:
+                index = item.get("index")
+                if isinstance(index, int) and 0 <= index < len(bodies):
+                    results[index] = (self._outcome(int(item.get("status") or 400)), item.get("detail"))
+            return results
+        if outcome == "rejected" and len(bodies) > 1:
+            # el backend rechazo el lote entero (p. ej. version sin rechazos por item):
+            # se envian de a uno para descartar solo los invalidos
+            return list(await asyncio.gather(*[self._send_one(endpoint, body) for body in bodies]))
+        return [(outcome, data)] * len(bodies)
+
+    async def flush_once(self) -> bool:
+        """Envia un lote; devuelve False si algun evento quedo pendiente de reintento."""
+        batch = [self._events.popleft() for _ in range(min(self.batch_size, len(self._events)))]
+        if not batch:
+            return True
+        if OUTBOX_BULK:
+            # un POST /bulk/ por endpoint, con resultado por evento
+            groups: Dict[str, List[int]] = defaultdict(list)
+            for i, (endpoint, _, _, _) in enumerate(batch):
+                groups[endpoint].append(i)
+            endpoints = list(groups)
+            group_results = await asyncio.gather(*[
+                self._send_group(endpoint, [batch[i][1] for i in groups[endpoint]]) for endpoint in endpoints
+            ])
+            results: List[Tuple[str, Any]] = [("retry", None)] * len(batch)
+            for endpoint, outcomes in zip(endpoints, group_results):
+                for i, outcome in zip(groups[endpoint], outcomes):
+                    results[i] = outcome
+        else:
+            results = await asyncio.gather(*[self._send_one(endpoint, body) for endpoint, body, _, _ in batch])
+        now = self.clock()
+        retry = []
+        for (endpoint, body, attempts, failing_since), (outcome, detail) in zip(batch, results):
+            if outcome == "sent":
+                self.sent += 1
+            elif outcome == "rejected":
+                # 4xx: reintentar no cambia la respuesta; se descarta solo este evento
+                self.rejected += 1
+                FORWARD_FAILURES_TOTAL.inc(reason="rejected")
+                frame_log.error("outbox_rejected", endpoint=endpoint, detail=detail)
+            elif failing_since is None or now - failing_since < self.max_retry_s:
+                retry.append((endpoint, body, attempts + 1, now if failing_since is None else failing_since))
+            else:
+                self.failed += 1
+                FORWARD_FAILURES_TOTAL.inc(reason="retries_exhausted")
+                frame_log.error(
+                    "outbox_failed", endpoint=endpoint, attempts=attempts + 1, failing_s=round(now - failing_since, 1)
+                )
+        self._events.extendleft(reversed(retry))
+        if retry:
+            self.backoff = min(self.backoff * 2 if self.backoff else self.flush_interval, self.backoff_max)
+        else:
+            self.backoff = 0.0
+        return not retry
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._events),
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "backoff_s": self.backoff,
+        }
+
+
+event_outbox = EventOutbox(
+    OUTBOX_BATCH_SIZE, OUTBOX_FLUSH_MS, OUTBOX_MAX_EVENTS, OUTBOX_MAX_RETRY_S, OUTBOX_RETRY_BACKOFF_MAX_MS
+)
 
 
 @app.get("/health")
@@ -356,16 +1990,102 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/ready")
+async def ready():
+    """Readiness para el balanceador: 503 hasta que detectores, modelo y workers esten calientes."""
+    return JSONResponse(startup_state, status_code=200 if startup_state["ready"] else 503)
+
+
 @app.get("/debug/status")
 async def debug_status():
     return {
         "mediapipe_initialized": face_mesh is not None,
+        "face_mesh_pool": face_mesh.status() if face_mesh is not None else None,
         "haar_cascade_loaded": cascade is not None,
-        "onnx_model_loaded": ort_session is not None,
+        "onnx_model_loaded": sequence_model_loaded(),
+        "onnx_split_model": split_model_loaded(),
+        "onnx_variant": ONNX_VARIANT,
+        "model_registry": model_registry.status(),
         "sequence_length": SEQUENCE_LENGTH,
+        "cpu_pool": cpu_pool.status(),
+        "admission": frame_admission.status(),
+        "startup": startup_state,
+        "inference_batcher": inference_batcher.status(),
+        "event_outbox": event_outbox.status(),
+        "sessions": await sessions_status(),
+        "shard_engine": shard_engine.status() if shard_engine is not None else None,
+    }
+
+
+def require_backend_token(authorization: Optional[str] = Header(None)) -> None:
+    """
+    Endpoints de operacion: solo con el token de servicio del backend (`Authorization:
+    Bearer <BACKEND_TOKEN>`, el mismo que envia el outbox). 401 sin token, 403 si no
+    coincide; sin BACKEND_TOKEN configurado quedan deshabilitados.
+    """
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Token de servicio requerido", headers={"WWW-Authenticate": "Bearer"})
+    scheme, _, token = authorization.partition(" ")
+    valid = bool(BACKEND_TOKEN) and hmac.compare_digest(token.strip().encode(), BACKEND_TOKEN.encode())
+    if scheme.lower() != "bearer" or not valid:
+        raise HTTPException(status_code=403, detail="Token de servicio invalido")
+
+
+@app.get("/models")
+async def list_models():
+    return model_registry.status()
+
+
+@app.post("/models/activate/{version}", dependencies=[Depends(require_backend_token)])
+async def activate_model(version: str):
+    """Activa una version registrada (warm-up incluido); los workers del pool la siguen via ACTIVE."""
+    try:
+        await asyncio.to_thread(model_registry.activate, version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Version desconocida: {version}")
+    except Exception as e:
+        raise HTTPException(status_code=409, detail=f"No se pudo activar {version}: {e}")
+    return model_registry.status()
+
+
+@app.post("/models/rollback", dependencies=[Depends(require_backend_token)])
+async def rollback_model():
+    try:
+        await asyncio.to_thread(model_registry.rollback)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]) if e.args else "Sin version anterior")
+    except Exception as e:
+        raise HTTPException(status_code=409, detail=f"Rollback fallido: {e}")
+    return model_registry.status()
+
+
+async def sessions_status() -> Dict[str, Any]:
+    """Estado del session store; en modo sharded, la suma de los stores de cada worker."""
+    if shard_engine is None:
+        return await call_session_store(session_store.status)
+    replies = [r for r in await shard_engine.broadcast("status") if isinstance(r, dict)]
+    return {
+        "backend": "sharded",
+        "active_sessions": sum(r["sessions"].get("active_sessions", 0) for r in replies),
+        "buffer_mb": round(sum(r["sessions"].get("buffer_mb", 0.0) for r in replies), 2),
+        "workers": replies,
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    sessions = await sessions_status()
+    ACTIVE_SESSIONS.set(sessions.get("active_sessions", 0))
+    SESSION_BUFFER_BYTES.set(float(sessions.get("buffer_mb", 0.0)) * 1024 * 1024)
+    CPU_POOL_IN_FLIGHT.set(cpu_pool.status().get("in_flight", 0))
+    ADMISSION_IN_FLIGHT.set(frame_admission.in_flight)
+    ADMISSION_EXPECTED_WAIT.set(frame_admission.expected_wait())
+    for name, queued in zip(PRIORITY_NAMES, frame_admission.queued):
+        ADMISSION_QUEUED.set(queued, priority=name)
+    OUTBOX_PENDING.set(event_outbox.status().get("pending", 0))
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/events")
 async def receive_event(payload: AttentionEventPayload):
     """
@@ -377,6 +2097,56 @@ async def receive_event(payload: AttentionEventPayload):
     return {"ok": True, "forwarded": bool(BACKEND_TOKEN)}
 
 
+async def emit_attention_event(
+    session_key: int,
+    d2r_session_id: Optional[int],
+    user_id: int,
+    test_name: str,
+    context: Dict[str, Any],
+    result: Dict[str, Any],
+    temporal: Dict[str, Any],
+    model_score: Optional[float],
+    reused: bool = False,
+) -> None:
+    """Arma el evento de atencion de un frame y lo encola en el outbox (o lo envia directo)."""
+    label = "attention_model" if model_score is not None else (
+        temporal.get("label", "attention_sequence_score") if result["value"] is not None else "no_face"
+    )
+    value = model_score if model_score is not None else float(temporal.get("value", 0.0))
+
+    normalized_test = (test_name or "").upper()
+    is_d2r = normalized_test == "D2R" or (normalized_test == "" and d2r_session_id is not None)
+    event_test_name = test_name or ("D2R" if is_d2r else "COURSE")
+    payload = AttentionEventPayload(
+        d2r_session_id=session_key if is_d2r else None,
+        session_id=None if is_d2r else session_key,
+        user_id=user_id,
+        value=value,
+        label=label,
+        data={
+            "context": {"test": event_test_name, **context},
+            "state": "no_face" if not result.get("data", {}).get("face", False) else "ok",
+            "temporal": temporal.get("data", {}),
+            "frame": result.get("data", {}),
+            "score_model": model_score,
+            "score_baseline": result.get("value"),
+            "reused": reused,
+        },
+    )
+    if OUTBOX_ENABLED:
+        event_outbox.put(payload, test_name=event_test_name)
+    else:
+        await post_event_to_backend(payload, test_name=event_test_name)
+
+
+@app.post("/sessions/{session_key}/end", dependencies=[Depends(require_backend_token)])
+async def end_session(session_key: int):
+    """Libera el estado temporal (ventana, buffer del modelo, afinidad FaceMesh) de una sesion terminada."""
+    if shard_engine is not None:
+        return {"ok": True, "released": await call_shard(session_key, "end", b"", session_key)}
+    return {"ok": True, "released": await call_session_store(session_store.end_session, session_key)}
+
+
 @app.post("/analyze/frame")
 async def analyze_frame(
     file: UploadFile = File(...),
@@ -395,23 +2165,58 @@ async def analyze_frame(
     if not d2r_session_id and not session_id:
         raise HTTPException(status_code=422, detail="session_id o d2r_session_id requerido")
     session_key = d2r_session_id if d2r_session_id is not None else session_id
-
     content = await file.read()
-    np_arr = np.frombuffer(content, np.uint8)
-    image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-    if image is None:
-        raise HTTPException(status_code=400, detail="No se pudo decodificar la imagen")
+    body = await process_frame(content, session_key, d2r_session_id, user_id, test_name, phase, time_left, spinning)
+    return JSONResponse(body)
 
-    result = compute_attention_score(image)
-    temporal = aggregate_temporal_score(session_key, result)
 
-    # LOG DETALLADO para debugging
+async def process_frame(
+    content: bytes,
+    session_key: int,
+    d2r_session_id: Optional[int],
+    user_id: int,
+    test_name: str,
+    phase: int = 0,
+    time_left: float = 0,
+    spinning: int = 0,
+) -> Dict[str, Any]:
+    """Analiza un frame ya recibido (HTTP o WebSocket) y devuelve el cuerpo de la respuesta."""
+    if not startup_state["ready"]:
+        FRAMES_REJECTED_TOTAL.inc(reason="not_ready")
+        raise HTTPException(status_code=503, detail="ML service inicializando, reintente", headers={"Retry-After": "1"})
+    started = time.perf_counter()
+    priority = frame_priority(test_name, d2r_session_id, time_left)
+    async with frame_admission.admit(session_key, priority):
+        admitted = time.perf_counter()
+        if shard_engine is not None:
+            # el worker duenio de la sesion hace todo el pipeline, incluido temporal y modelo
+            shard_reply = await call_shard(session_key, "frame", content, session_key, int(spinning))
+            result, timings = shard_reply["result"], shard_reply["timings"]
+        else:
+            result, model_input, model_version, timings = await cpu_pool.run(analyze_image, content, session_key)
+        frame_admission.observe(sum(timings.values()))
+    after_pool = time.perf_counter()
+    STAGE_SECONDS.observe(admitted - started, stage="admission")
+    ADMISSION_WAIT_SECONDS.observe(admitted - started, priority=PRIORITY_NAMES[priority[0]])
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    # espera en la cola del pool o del worker (+ IPC en modo process/sharded)
+    STAGE_SECONDS.observe(max(after_pool - admitted - sum(timings.values()), 0.0), stage="cpu_queue")
+    if result is None:
+        FRAMES_REJECTED_TOTAL.inc(reason="decode")
+        raise HTTPException(status_code=400, detail="No se pudo decodificar la imagen")
+    reused = bool(result.get("data", {}).get("reused", False))
     has_face = result.get("data", {}).get("face", False)
-    frame_score = result.get("value")
-    temporal_score = temporal.get("value")
-    frame_score_str = f"{frame_score:.2f}" if frame_score is not None else "None"
-    temporal_score_str = f"{temporal_score:.2f}" if temporal_score is not None else "None"
-    print(f"[analyze/frame] session={session_key}, face={has_face}, frame_score={frame_score_str}, temporal={temporal_score_str}")
+
+    if shard_engine is not None:
+        temporal, model_score = shard_reply["temporal"], shard_reply["model_score"]
+        if shard_reply["model_source"]:
+            MODEL_RUNS_TOTAL.inc(source=shard_reply["model_source"])
+    else:
+        temporal = await call_session_store(aggregate_temporal_score, session_key, result)
+        STAGE_SECONDS.observe(time.perf_counter() - after_pool, stage="temporal")
+        # buffer de frames para modelo CNN-LSTM
+        model_score = await score_sequence(session_key, model_input, model_version, reused, spinning)
 
     # Opcional: guardar frame para dataset (no es video, solo imágenes sueltas)
     frame_path = None
@@ -430,69 +2235,319 @@ async def analyze_frame(
     if frame_path:
         result.setdefault("data", {})["frame_path"] = frame_path
 
-    # buffer de frames para modelo CNN-LSTM
-    model_score = None
-    if result.get("data", {}).get("face", False):
-        bbox = result["data"].get("bbox")
-        try:
-            if bbox:
-                x0, y0, x1, y1 = map(int, bbox)
-                x0 = max(x0 - int(0.1 * (x1 - x0)), 0)
-                y0 = max(y0 - int(0.1 * (y1 - y0)), 0)
-                x1 = min(x1 + int(0.1 * (x1 - x0)), image.shape[1])
-                y1 = min(y1 + int(0.1 * (y1 - y0)), image.shape[0])
-                crop = image[y0:y1, x0:x1]
-            else:
-                crop = image
-            crop = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
-            crop = cv2.resize(crop, (MODEL_IMG_SIZE, MODEL_IMG_SIZE))
-            crop = crop.astype("float32") / 255.0
-            crop = np.transpose(crop, (2, 0, 1))  # C,H,W
-            session_frame_buffers[session_key].append(crop)
-        except Exception as e:
-            print(f"[analyze/frame] Error procesando frame para modelo: {e}")
+    forward_start = time.perf_counter()
+    await emit_attention_event(
+        session_key,
+        d2r_session_id,
+        user_id,
+        test_name,
+        {"phase": phase, "spinning": int(spinning), "time_left": time_left},
+        result,
+        temporal,
+        model_score,
+        reused=reused,
+    )
+    finished = time.perf_counter()
+    STAGE_SECONDS.observe(finished - forward_start, stage="forward")
+    STAGE_SECONDS.observe(finished - started, stage="total")
+    FRAMES_TOTAL.inc(kind="image", face=str(bool(has_face)).lower())
+    if reused:
+        FRAMES_REUSED_TOTAL.inc()
+    frame_log.log(
+        "frame",
+        session=session_key,
+        face=has_face,
+        frame_score=result.get("value"),
+        temporal=temporal.get("value"),
+        model_score=model_score,
+        reused=reused,
+        ms=round((finished - started) * 1000, 2),
+        stages={k: round(v * 1000, 2) for k, v in timings.items()},
+    )
+    return {"ok": True, "score": temporal, "frame_score": result, "reused": reused}
 
-        if ort_session and len(session_frame_buffers[session_key]) >= SEQUENCE_LENGTH and int(spinning) == 0:
-            try:
-                seq = list(session_frame_buffers[session_key])[-SEQUENCE_LENGTH:]
-                arr = np.stack(seq, axis=0)[None, ...]  # 1,T,C,H,W
-                ort_out = ort_session.run(None, {"frames": arr, "mask": None})
-                if ort_out:
-                    model_score = float(np.clip(np.ravel(ort_out[0])[0], 0.0, 1.0))
-                    print(f"[analyze/frame] Modelo CNN-LSTM calculado: {model_score:.4f}")
-            except Exception as e:
-                print(f"[analyze/frame] Error ejecutando modelo CNN-LSTM: {e}")
-                model_score = None
 
-    label = "attention_model" if model_score is not None else (
-        temporal.get("label", "attention_sequence_score") if result["value"] is not None else "no_face"
+LANDMARK_COUNT = 478
+LANDMARK_DTYPES = {"float16": np.float16, "float32": np.float32}
+
+
+@app.post("/analyze/landmarks")
+async def analyze_landmarks(
+    file: UploadFile = File(...),
+    d2r_session_id: Optional[int] = Form(None),
+    session_id: Optional[int] = Form(None),
+    user_id: int = Form(...),
+    width: int = Form(640),
+    height: int = Form(480),
+    dtype: str = Form("float16"),
+    phase: int = Form(0),
+    time_left: float = Form(0),
+    spinning: int = Form(0),
+    test_name: str = Form("D2R"),
+):
+    """
+    Variante de /analyze/frame para clientes que corren MediaPipe Face Mesh en el
+    navegador: recibe los 478 landmarks normalizados (x, y, z) como vector binario
+    little-endian (float16 por defecto, ~2.8 KB) y aplica el mismo calculo de
+    EAR/iris/gaze y agregacion temporal, sin subir ni decodificar la imagen.
+    Un archivo vacio indica que el cliente no detecto rostro.
+    """
+    if not d2r_session_id and not session_id:
+        raise HTTPException(status_code=422, detail="session_id o d2r_session_id requerido")
+    if dtype not in LANDMARK_DTYPES:
+        raise HTTPException(status_code=422, detail=f"dtype debe ser uno de {sorted(LANDMARK_DTYPES)}")
+    if width <= 0 or height <= 0:
+        raise HTTPException(status_code=422, detail="width y height deben ser positivos")
+    session_key = d2r_session_id if d2r_session_id is not None else session_id
+    content = await file.read()
+    body = await process_landmarks(
+        content, session_key, d2r_session_id, user_id, test_name, width, height, dtype, phase, time_left, spinning
     )
-    value = model_score if model_score is not None else float(temporal.get("value", 0.0))
+    return JSONResponse(body)
 
-    normalized_test = (test_name or "").upper()
-    is_d2r = normalized_test == "D2R" or (normalized_test == "" and d2r_session_id is not None)
-    payload = AttentionEventPayload(
-        d2r_session_id=session_key if is_d2r else None,
-        session_id=None if is_d2r else session_key,
-        user_id=user_id,
-        value=value,
-        label=label,
-        data={
-            "context": {
-                "test": test_name or ("D2R" if is_d2r else "COURSE"),
-                "phase": phase,
-                "spinning": int(spinning),
-                "time_left": time_left,
-            },
-            "state": "no_face" if not result.get("data", {}).get("face", False) else "ok",
-            "temporal": temporal.get("data", {}),
-            "frame": result.get("data", {}),
-            "score_model": model_score,
-            "score_baseline": result.get("value"),
-        },
+
+def score_landmark_bytes(content: bytes, width: int, height: int, dtype: str) -> Dict[str, Any]:
+    """Valida el vector binario de landmarks y aplica score_landmarks; vacio = sin rostro."""
+    item_dtype = np.dtype(LANDMARK_DTYPES[dtype]).newbyteorder("<")
+    if not content:
+        return {"value": None, "label": "no_face", "data": {"face": False, "method": "client_landmarks"}}
+    if len(content) != LANDMARK_COUNT * 3 * item_dtype.itemsize:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Se esperaban {LANDMARK_COUNT}x3 valores {dtype} ({LANDMARK_COUNT * 3 * item_dtype.itemsize} bytes)",
+        )
+    points = np.frombuffer(content, dtype=item_dtype).reshape(LANDMARK_COUNT, 3).astype(np.float32)
+    if not np.isfinite(points).all():
+        raise HTTPException(status_code=400, detail="Landmarks con valores no finitos")
+    points[:, 0] *= width
+    points[:, 1] *= height
+    result = score_landmarks(points.tolist(), width, height)
+    result["data"]["method"] = "client_landmarks"
+    return result
+
+
+async def process_landmarks(
+    content: bytes,
+    session_key: int,
+    d2r_session_id: Optional[int],
+    user_id: int,
+    test_name: str,
+    width: int = 640,
+    height: int = 480,
+    dtype: str = "float16",
+    phase: int = 0,
+    time_left: float = 0,
+    spinning: int = 0,
+) -> Dict[str, Any]:
+    """Puntua un vector de landmarks ya recibido (HTTP o WebSocket) y devuelve el cuerpo de la respuesta."""
+    started = time.perf_counter()
+    if shard_engine is not None:
+        shard_reply = await call_shard(session_key, "landmarks", content, session_key, width, height, dtype)
+        result, temporal = shard_reply["result"], shard_reply["temporal"]
+        for stage, seconds in shard_reply["timings"].items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+    else:
+        result = score_landmark_bytes(content, width, height, dtype)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="landmarks")
+        temporal = await call_session_store(aggregate_temporal_score, session_key, result)
+    await emit_attention_event(
+        session_key,
+        d2r_session_id,
+        user_id,
+        test_name,
+        {"phase": phase, "spinning": int(spinning), "time_left": time_left},
+        result,
+        temporal,
+        None,
+    )
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage="total_landmarks")
+    FRAMES_TOTAL.inc(kind="landmarks", face=str(bool(result["data"]["face"])).lower())
+    frame_log.log("landmarks", session=session_key, face=result["data"]["face"], frame_score=result.get("value"))
+    return {"ok": True, "score": temporal, "frame_score": result, "reused": False}
+
+
+def _shard_handle(op: str, content: memoryview, *args):
+    """Operaciones que atiende un worker sharded sobre sus propias sesiones."""
+    if op == "frame":
+        return analyze_session_frame(content, *args)
+    if op == "landmarks":
+        session_key, width, height, dtype = args
+        t0 = time.perf_counter()
+        result = score_landmark_bytes(content, width, height, dtype)
+        t1 = time.perf_counter()
+        temporal = aggregate_temporal_score(session_key, result)
+        return {"result": result, "temporal": temporal, "timings": {"landmarks": t1 - t0, "temporal": time.perf_counter() - t1}}
+    if op == "end":
+        return session_store.end_session(args[0])
+    if op == "status":
+        return {"pid": os.getpid(), "model_version": model_registry.active.version, "sessions": session_store.status()}
+    raise ValueError(f"Operacion desconocida: {op}")
+
+
+def _shard_worker_main(index: int, requests, replies, shm_name: str, slot_bytes: int) -> None:
+    initialize_runtime(detectors=True)
+    serve_shard(
+        requests,
+        replies,
+        shm_name,
+        slot_bytes,
+        _shard_handle,
+        on_idle=evict_idle_sessions,
+        idle_interval_s=max(min(SESSION_IDLE_TTL_S / 4, 60.0), 1.0),
     )
-    await post_event_to_backend(payload, test_name=(test_name or ("D2R" if is_d2r else "COURSE")))
-    return JSONResponse({"ok": True, "score": temporal, "frame_score": result})
+
+
+shard_engine: Optional[ShardedEngine] = None
+if ML_WORKER_MODE == "sharded":
+    shard_engine = ShardedEngine(ML_WORKERS, _shard_worker_main, slots=SHARD_SLOTS, slot_bytes=SHARD_SLOT_BYTES)
+
+
+async def call_shard(session_key: int, op: str, payload: bytes = b"", *args):
+    """Llamada al worker duenio de la sesion, con los errores del motor como HTTPException."""
+    try:
+        return await shard_engine.call(session_key, op, payload, *args)
+    except ShardError as e:
+        if e.status_code in (429, 503):
+            FRAMES_REJECTED_TOTAL.inc(reason="saturated" if e.status_code == 429 else "worker_unavailable")
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=headers)
+
+
+# Cabecera binaria de cada mensaje del WebSocket (12 bytes, little-endian):
+# tipo (0 = imagen JPEG/PNG, 1 = landmarks), flags (bit 0 = spinning), phase, time_left, seq
+WS_FRAME_HEADER = struct.Struct("<BBHfI")
+WS_KIND_IMAGE = 0
+WS_KIND_LANDMARKS = 1
+
+
+async def authenticate_stream_user(token: str) -> Optional[Dict[str, Any]]:
+    """Valida el token del alumno contra /api/me/ del backend; devuelve el usuario o None."""
+    if not token:
+        return None
+    if not token.lower().startswith("bearer "):
+        token = f"Bearer {token}"
+    url = f"{BACKEND_URL}/api/me/"
+    try:
+        if backend_client is None:
+            async with create_backend_client() as client:
+                res = await client.get(url, headers={"Authorization": token})
+        else:
+            res = await backend_client.get(url, headers={"Authorization": token})
+    except httpx.HTTPError as e:
+        frame_log.error("ws_auth_error", error=str(e))
+        return None
+    if res.status_code != 200:
+        return None
+    user = res.json()
+    if user.get("role") != "student":
+        return None
+    return user
+
+
+class StreamHello(BaseModel):
+    """Primer mensaje de /ws/stream; user_id solo se usa con WS_AUTH_REQUIRED=0."""
+
+    token: str = ""
+    session_id: Optional[int] = None
+    d2r_session_id: Optional[int] = None
+    user_id: Optional[int] = None
+    test_name: str = "D2R"
+    width: int = Field(640, gt=0)
+    height: int = Field(480, gt=0)
+    dtype: str = "float16"
+
+    @model_validator(mode="after")
+    def ensure_session_and_dtype(self):
+        if not self.session_id and not self.d2r_session_id:
+            raise ValueError("session_id o d2r_session_id requerido")
+        if self.dtype not in LANDMARK_DTYPES:
+            raise ValueError(f"dtype invalido (valores: {', '.join(LANDMARK_DTYPES)})")
+        return self
+
+
+async def reject_stream(websocket: WebSocket, detail: str, errors: Optional[List[Dict[str, str]]] = None) -> None:
+    body: Dict[str, Any] = {"ok": False, "status": 400, "detail": detail}
+    if errors:
+        body["errors"] = errors
+    await websocket.send_json(body)
+    await websocket.close(code=1008)
+
+
+@app.websocket("/ws/stream")
+async def stream_frames(websocket: WebSocket):
+    """
+    Canal persistente para un alumno: el primer mensaje (texto JSON) autentica y fija
+    la sesion ({"token", "session_id" | "d2r_session_id", "test_name", "width", "height",
+    "dtype"}); despues cada mensaje binario es WS_FRAME_HEADER + payload (imagen o
+    landmarks) y el resultado se devuelve como JSON por el mismo socket, con el `seq`
+    de la cabecera. Evita el request HTTP, el multipart y el proxy por frame.
+    """
+    await websocket.accept()
+    try:
+        raw_hello = await websocket.receive_text()
+    except (WebSocketDisconnect, KeyError):
+        await websocket.close(code=1003)
+        return
+    try:
+        hello = StreamHello.model_validate_json(raw_hello)
+    except ValidationError as e:
+        errors = [{"field": ".".join(str(p) for p in err["loc"]), "msg": err["msg"]} for err in e.errors()]
+        await reject_stream(websocket, "Mensaje inicial invalido", errors)
+        return
+
+    d2r_session_id = hello.d2r_session_id or None
+    session_key = d2r_session_id if d2r_session_id is not None else hello.session_id
+
+    if WS_AUTH_REQUIRED:
+        user = await authenticate_stream_user(hello.token)
+        if user is None:
+            await websocket.send_json({"ok": False, "detail": "Token inválido"})
+            await websocket.close(code=1008)
+            return
+        user_id = int(user["id"])
+    elif hello.user_id is not None:
+        user_id = hello.user_id
+    else:
+        await reject_stream(websocket, "user_id requerido")
+        return
+
+    test_name, width, height, dtype = hello.test_name, hello.width, hello.height, hello.dtype
+
+    await websocket.send_json({"ok": True, "type": "ready", "user_id": user_id, "session_key": session_key})
+    try:
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                break
+            message = received.get("bytes")  # None si el cliente mando texto
+            if message is None or len(message) < WS_FRAME_HEADER.size or len(message) > WS_MAX_MESSAGE_BYTES:
+                await websocket.send_json({"ok": False, "status": 400, "detail": "Mensaje invalido"})
+                continue
+            kind, flags, phase, time_left, seq = WS_FRAME_HEADER.unpack_from(message)
+            content = message[WS_FRAME_HEADER.size :]
+            spinning = flags & 1
+            try:
+                if kind == WS_KIND_IMAGE:
+                    body = await process_frame(
+                        content, session_key, d2r_session_id, user_id, test_name, phase, time_left, spinning
+                    )
+                elif kind == WS_KIND_LANDMARKS:
+                    body = await process_landmarks(
+                        content, session_key, d2r_session_id, user_id, test_name,
+                        width, height, dtype, phase, time_left, spinning,
+                    )
+                else:
+                    raise HTTPException(status_code=400, detail=f"Tipo de mensaje desconocido: {kind}")
+            except HTTPException as e:
+                body = {"ok": False, "status": e.status_code, "detail": e.detail}
+            except Exception as e:
+                # un frame que falla no cierra el canal del alumno
+                frame_log.error("ws_frame_error", session=session_key, seq=seq, error=repr(e))
+                body = {"ok": False, "status": 500, "detail": "Error procesando el frame"}
+            body["seq"] = seq
+            await websocket.send_text(json.dumps(body, default=float))
+    except WebSocketDisconnect:
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+"""
+Registro de versiones del modelo ONNX con recarga en caliente.
+
+Cada version es un directorio `<versions_dir>/<version>/` con los mismos nombres de
+archivo que MODEL_PATH / ENCODER_MODEL_PATH / HEAD_MODEL_PATH (mas sus `.data` y
+variantes opt/int8). `<versions_dir>/ACTIVE` guarda la version activa y todos los
+procesos (uvicorn y workers del pool) la siguen: cuando cambia, cada uno carga la
+version, la calienta con una entrada dummy y recien entonces la publica con una
+sola asignacion, asi los frames en curso terminan con la version anterior.
+
+Un solo proceso (el que toma el flock de `<versions_dir>/.manager.lock`) administra
+el registro: detecta cuando el entrenamiento reescribe los modelos base, copia los
+archivos a una version nueva, la activa si el warm-up pasa y conserva las ultimas
+`keep` versiones para poder volver atras.
+"""
+import fcntl
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+from optimize_onnx import VARIANTS, variant_path
+
+ACTIVE_FILE = "ACTIVE"
+META_FILE = "meta.json"
+
+
+class ModelBundle:
+    """Sesiones de una version: modelo completo y/o encoder + cabeza."""
+
+    __slots__ = ("version", "full", "encoder", "head", "files", "loaded_at")
+
+    def __init__(self, version: Optional[str], full=None, encoder=None, head=None, files: Optional[Dict[str, str]] = None):
+        self.version = version
+        self.full = full
+        self.encoder = encoder
+        self.head = head
+        self.files = files or {}
+        self.loaded_at = time.time()
+
+    @property
+    def split(self) -> bool:
+        return self.encoder is not None and self.head is not None
+
+    @property
+    def loaded(self) -> bool:
+        return self.split or self.full is not None
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        model_path: str,
+        encoder_path: str,
+        head_path: str,
+        versions_dir: str,
+        session_factory: Callable[[str], object],
+        warmup: Callable[[ModelBundle], None],
+        keep: int = 3,
+        poll_s: float = 10.0,
+        stable_s: float = 5.0,
+        watch: bool = True,
+    ):
+        self.base_paths = {"full": Path(model_path), "encoder": Path(encoder_path), "head": Path(head_path)}
+        self.versions_dir = Path(versions_dir)
+        self.session_factory = session_factory
+        self.warmup = warmup
+        self.keep = max(keep, 1)
+        self.poll_s = poll_s
+        self.stable_s = stable_s
+        self.watch = watch
+        self._active = ModelBundle(None)
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._thread_pid: Optional[int] = None
+        self._manager_fd: Optional[int] = None
+        self._pending_signature: Optional[float] = None
+        self.failed: Dict[str, str] = {}  # version -> error de carga/warm-up
+
+    # --- lectura -----------------------------------------------------------------
+
+    @property
+    def active(self) -> ModelBundle:
+        """Bundle activo; leerlo una vez por llamada para usar siempre la misma version."""
+        return self._active
+
+    def versions(self) -> List[str]:
+        if not self.versions_dir.is_dir():
+            return []
+        return sorted(
+            p.name for p in self.versions_dir.iterdir() if p.is_dir() and not p.name.startswith(".")
+        )
+
+    def active_marker(self) -> Optional[str]:
+        try:
+            return (self.versions_dir / ACTIVE_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    # --- carga -------------------------------------------------------------------
+
+    def _files_for(self, version: Optional[str]) -> Dict[str, Path]:
+        if version is None:
+            return dict(self.base_paths)
+        root = self.versions_dir / version
+        return {name: root / path.name for name, path in self.base_paths.items()}
+
+    def _load(self, version: Optional[str]) -> ModelBundle:
+        files = self._files_for(version)
+        sessions = {}
+        for name, path in files.items():
+            sessions[name] = self.session_factory(path.as_posix()) if path.exists() else None
+        if sessions["encoder"] is None or sessions["head"] is None:
+            sessions["encoder"] = sessions["head"] = None
+        bundle = ModelBundle(
+            version,
+            sessions["full"],
+            sessions["encoder"],
+            sessions["head"],
+            {name: path.name for name, path in files.items() if sessions[name] is not None},
+        )
+        if bundle.loaded:
+            self.warmup(bundle)
+        return bundle
+
+    def activate(self, version: str, publish: bool = True) -> ModelBundle:
+        """Carga y calienta `version`, la publica en este proceso y (si `publish`) en ACTIVE."""
+        if version not in self.versions():
+            raise KeyError(version)
+        with self._lock:
+            if self._active.version != version:
+                try:
+                    bundle = self._load(version)
+                except Exception as e:
+                    self.failed[version] = str(e)
+                    raise
+                if not bundle.loaded:
+                    self.failed[version] = "sin modelos cargables"
+                    raise RuntimeError(f"La version {version} no tiene modelos cargables")
+                self._active = bundle
+                self.failed.pop(version, None)
+            if publish:
+                self._write_active(version)
+            return self._active
+
+    def rollback(self) -> ModelBundle:
+        """Activa la version anterior a la activa."""
+        versions = self.versions()
+        current = self._active.version
+        older = [v for v in versions if current is None or v < current]
+        if not older:
+            raise KeyError("No hay una version anterior")
+        return self.activate(older[-1])
+
+    def load_initial(self) -> ModelBundle:
+        """Version de ACTIVE, o la ultima registrada, o los archivos base si aun no hay versiones."""
+        self._try_become_manager()
+        new_version = None
+        if self.is_manager:
+            try:
+                # el entrenamiento pudo reescribir los modelos con el servicio apagado
+                new_version = self._snapshot_if_changed(force_stable=True)
+            except OSError as e:
+                print(f"[models] No se pudo registrar la version inicial: {e}")
+        marker = self.active_marker()
+        target = new_version or marker or (self.versions()[-1] if self.versions() else None)
+        try:
+            if target is not None:
+                return self.activate(target, publish=self.is_manager and (new_version is not None or marker is None))
+            with self._lock:
+                self._active = self._load(None)
+        except Exception as e:
+            print(f"[models] No se pudo cargar el modelo inicial: {e}")
+        return self._active
+
+    # --- administracion (un solo proceso) ----------------------------------------
+
+    @property
+    def is_manager(self) -> bool:
+        return self._manager_fd is not None
+
+    def _try_become_manager(self) -> None:
+        if self._manager_fd is not None or not self.watch:
+            return
+        if not self.versions_dir.is_dir() and self._source_signature() is None:
+            return  # sin modelos todavia: no crear directorios vacios
+        try:
+            self.versions_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.versions_dir / ".manager.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._manager_fd = fd
+        except OSError:
+            os.close(fd)
+
+    def _source_files(self) -> List[Path]:
+        files = []
+        for path in self.base_paths.values():
+            candidates = [path] + [variant_path(path, v) for v in VARIANTS if v != "fp32"]
+            for candidate in candidates:
+                for f in (candidate, candidate.with_name(candidate.name + ".data")):
+                    if f.exists():
+                        files.append(f)
+            report = path.with_name(f"{path.stem}.variants.json")
+            if report.exists():
+                files.append(report)
+        return files
+
+    def _source_signature(self) -> Optional[float]:
+        files = self._source_files()
+        if not self.base_paths["full"].exists() and not self.base_paths["encoder"].exists():
+            return None
+        return max((f.stat().st_mtime for f in files), default=None)
+
+    def _latest_recorded_signature(self) -> Optional[float]:
+        for version in reversed(self.versions()):
+            try:
+                return json.loads((self.versions_dir / version / META_FILE).read_text())["source_mtime"]
+            except (FileNotFoundError, KeyError, ValueError):
+                continue
+        return None
+
+    def _snapshot_if_changed(self, force_stable: bool = False) -> Optional[str]:
+        """Copia los modelos base a una version nueva si cambiaron y dejaron de escribirse."""
+        signature = self._source_signature()
+        if signature is None or signature == self._latest_recorded_signature():
+            self._pending_signature = None
+            return None
+        stable = time.time() - signature >= self.stable_s and (force_stable or self._pending_signature == signature)
+        self._pending_signature = signature
+        if not stable:
+            return None
+        version = time.strftime("%Y%m%dT%H%M%S", time.localtime(signature))
+        target = self.versions_dir / version
+        if target.exists():
+            return None
+        tmp = self.versions_dir / f".tmp-{version}-{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for f in self._source_files():
+            shutil.copy2(f, tmp / f.name)
+        (tmp / META_FILE).write_text(json.dumps({"source_mtime": signature, "created": time.time()}))
+        os.rename(tmp, target)  # atomico: los demas procesos nunca ven una version a medias
+        print(f"[models] Nueva version registrada: {version}")
+        return version
+
+    def _write_active(self, version: str) -> None:
+        tmp = self.versions_dir / f".{ACTIVE_FILE}.{os.getpid()}"
+        tmp.write_text(version)
+        os.replace(tmp, self.versions_dir / ACTIVE_FILE)
+
+    def _prune(self) -> None:
+        active = {self._active.version, self.active_marker()}
+        versions = self.versions()
+        for version in versions[: max(len(versions) - self.keep, 0)]:
+            if version not in active:
+                shutil.rmtree(self.versions_dir / version, ignore_errors=True)
+                self.failed.pop(version, None)
+
+    # --- vigilancia --------------------------------------------------------------
+
+    def poll_once(self) -> None:
+        self._try_become_manager()
+        if self.is_manager:
+            new_version = self._snapshot_if_changed()
+            if new_version is not None:
+                try:
+                    self.activate(new_version)
+                    print(f"[models] Version activa: {new_version}")
+                except Exception as e:
+                    print(f"[models] Version {new_version} descartada: {e}")
+            self._prune()
+        marker = self.active_marker()
+        if marker and marker != self._active.version and marker not in self.failed:
+            try:
+                self.activate(marker, publish=False)
+            except Exception as e:
+                print(f"[models] No se pudo activar {marker}: {e}")
+
+    def _watch_loop(self) -> None:
+        while True:
+            time.sleep(self.poll_s)
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"[models] Error vigilando modelos: {e}")
+
+    def start(self) -> None:
+        """Hilo de vigilancia en este proceso (idempotente; se reinicia tras un fork/spawn)."""
+        if not self.watch or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        self._thread_pid = os.getpid()
+        self._thread = Thread(target=self._watch_loop, daemon=True)
+        self._thread.start()
+
+    def status(self) -> Dict[str, object]:
+        bundle = self._active
+        return {
+            "active_version": bundle.version,
+            "active_files": bundle.files,
+            "split": bundle.split,
+            "loaded_at": bundle.loaded_at if bundle.loaded else None,
+            "versions": self.versions(),
+            "keep": self.keep,
+            "manager": self.is_manager,
+            "failed": dict(self.failed),
+        }
@@ -0,0 +1,222 @@
+"""
+Variantes optimizadas de los modelos ONNX exportados por el entrenamiento.
+
+- <stem>.opt.onnx: grafo optimizado offline por ONNX Runtime (fusiones, constant folding).
+- <stem>.int8.onnx: cuantizado a INT8 (estatico QDQ con datos de calibracion, o dinamico).
+
+Cada variante se valida contra las salidas fp32 sobre un conjunto reservado; la INT8
+se descarta si el error absoluto maximo supera la tolerancia. El resultado queda en
+<stem>.variants.json y ml_service elige la variante con ONNX_VARIANT.
+
+Ejecutar sobre un modelo ya exportado (sin datos reales usa entradas aleatorias):
+    python ml/optimize_onnx.py checkpoints/cnn_lstm.onnx --samples 8
+"""
+import argparse
+import json
+import tempfile
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+
+try:
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+except ImportError:  # onnxruntime sin el paquete de cuantizacion
+    CalibrationDataReader = object
+    quantize_dynamic = quantize_static = quant_pre_process = None
+
+VARIANTS = ("fp32", "opt", "int8")
+GRAPH_OPT_LEVELS = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+DEFAULT_TOLERANCE = 0.02  # error absoluto maximo aceptado sobre scores en [0, 1]
+
+
+def variant_path(model_path, variant: str) -> Path:
+    """cnn_lstm.onnx -> cnn_lstm.int8.onnx; "fp32" devuelve el modelo original."""
+    model_path = Path(model_path)
+    if variant == "fp32":
+        return model_path
+    return model_path.with_name(f"{model_path.stem}.{variant}{model_path.suffix}")
+
+
+def session_options(intra_op_threads: int = 0, inter_op_threads: int = 0, level: str = "all") -> ort.SessionOptions:
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = GRAPH_OPT_LEVELS.get(level, ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    if intra_op_threads > 0:
+        opts.intra_op_num_threads = intra_op_threads
+    if inter_op_threads > 0:
+        opts.inter_op_num_threads = inter_op_threads
+    return opts
+
+
+def optimize_graph(src: Path, dst: Path, level: str = "extended") -> Path:
+    """
+    Guarda el grafo ya optimizado por ORT. Se usa "extended" por defecto porque
+    "all" agrega fusiones dependientes del hardware donde se genera.
+    """
+    opts = session_options(level=level)
+    opts.optimized_model_filepath = Path(dst).as_posix()
+    ort.InferenceSession(Path(src).as_posix(), opts, providers=["CPUExecutionProvider"])
+    return Path(dst)
+
+
+class _FeedsReader(CalibrationDataReader):
+    def __init__(self, feeds: List[Dict[str, np.ndarray]]):
+        self._feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self._feeds, None)
+
+
+def quantize_model(src: Path, dst: Path, calibration_feeds: Optional[List[Dict[str, np.ndarray]]] = None) -> str:
+    """INT8 estatico (QDQ, por canal) si hay datos de calibracion; si no, dinamico. Devuelve el modo usado."""
+    if quantize_dynamic is None:
+        raise RuntimeError("onnxruntime.quantization no disponible")
+    src, dst = Path(src), Path(dst)
+    with tempfile.TemporaryDirectory() as tmp:
+        prepared = Path(tmp) / "prepared.onnx"
+        try:
+            quant_pre_process(src.as_posix(), prepared.as_posix(), skip_symbolic_shape=True)
+        except Exception:
+            prepared = src
+        if calibration_feeds:
+            quantize_static(
+                prepared.as_posix(),
+                dst.as_posix(),
+                _FeedsReader(calibration_feeds),
+                quant_format=QuantFormat.QDQ,
+                per_channel=True,
+                activation_type=QuantType.QInt8,
+                weight_type=QuantType.QInt8,
+            )
+            return "static"
+        quantize_dynamic(prepared.as_posix(), dst.as_posix(), weight_type=QuantType.QInt8)
+        return "dynamic"
+
+
+def run_model(path: Path, feeds: Iterable[Dict[str, np.ndarray]]) -> List[np.ndarray]:
+    session = ort.InferenceSession(Path(path).as_posix(), providers=["CPUExecutionProvider"])
+    names = {i.name for i in session.get_inputs()}
+    return [session.run(None, {k: v for k, v in feed.items() if k in names})[0] for feed in feeds]
+
+
+def compare_outputs(reference: List[np.ndarray], candidate: List[np.ndarray]) -> Dict[str, float]:
+    diffs = np.concatenate([np.abs(np.ravel(a) - np.ravel(b)) for a, b in zip(reference, candidate)])
+    return {"max_abs_err": float(diffs.max()), "mean_abs_err": float(diffs.mean())}
+
+
+def build_variants(
+    model_path,
+    validation_feeds: List[Dict[str, np.ndarray]],
+    calibration_feeds: Optional[List[Dict[str, np.ndarray]]] = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> Dict[str, dict]:
+    """Genera .opt e .int8 junto a `model_path`, los valida contra fp32 y escribe <stem>.variants.json."""
+    model_path = Path(model_path)
+    reference = run_model(model_path, validation_feeds)
+    report: Dict[str, dict] = {"fp32": {"path": model_path.name, "accepted": True}}
+
+    opt_path = variant_path(model_path, "opt")
+    try:
+        optimize_graph(model_path, opt_path)
+        errors = compare_outputs(reference, run_model(opt_path, validation_feeds))
+        accepted = errors["max_abs_err"] <= 1e-3
+        report["opt"] = {"path": opt_path.name, "accepted": accepted, **errors}
+    except Exception as e:
+        report["opt"] = {"path": opt_path.name, "accepted": False, "error": str(e)}
+        accepted = False
+    if not accepted:
+        opt_path.unlink(missing_ok=True)
+
+    int8_path = variant_path(model_path, "int8")
+    try:
+        mode = quantize_model(model_path, int8_path, calibration_feeds)
+        errors = compare_outputs(reference, run_model(int8_path, validation_feeds))
+        accepted = errors["max_abs_err"] <= tolerance
+        report["int8"] = {"path": int8_path.name, "mode": mode, "accepted": accepted, "tolerance": tolerance, **errors}
+    except Exception as e:
+        report["int8"] = {"path": int8_path.name, "accepted": False, "error": str(e)}
+        accepted = False
+    if not accepted:
+        int8_path.unlink(missing_ok=True)
+
+    model_path.with_name(f"{model_path.stem}.variants.json").write_text(json.dumps(report, indent=2))
+    for name, info in report.items():
+        status = "ok" if info.get("accepted") else "descartada"
+        detail = f"max_abs_err={info['max_abs_err']:.5f}" if "max_abs_err" in info else info.get("error", "")
+        print(f"[optimize_onnx] {model_path.name} {name}: {status} {detail}")
+    return report
+
+
+def build_all_variants(
+    model_path,
+    frame_batches: List[np.ndarray],
+    calibration_batches: Optional[List[np.ndarray]] = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+) -> Dict[str, Dict[str, dict]]:
+    """
+    Variantes del modelo completo y, si existen, de *_encoder / *_head. `frame_batches`
+    son secuencias reservadas en el formato de entrada del modelo ((B, T, H, W, C) uint8
+    con el preprocesado en el grafo, o (B, T, C, H, W) float32 en modelos anteriores); las
+    entradas del encoder y de la cabeza se derivan de ellas (la cabeza recibe los
+    embeddings del encoder fp32).
+    """
+    model_path = Path(model_path)
+    calibration_batches = calibration_batches or frame_batches
+    reports = {
+        model_path.name: build_variants(
+            model_path,
+            [{"frames": b} for b in frame_batches],
+            [{"frames": b} for b in calibration_batches],
+            tolerance,
+        )
+    }
+
+    encoder_path = model_path.with_name(f"{model_path.stem}_encoder{model_path.suffix}")
+    head_path = model_path.with_name(f"{model_path.stem}_head{model_path.suffix}")
+    if encoder_path.exists() and head_path.exists():
+        def frames_of(batches):
+            return [{"frame": b.reshape((-1,) + b.shape[2:])} for b in batches]
+
+        def embeddings_of(batches):
+            embeddings = run_model(encoder_path, frames_of(batches))
+            return [{"embeddings": e.reshape(b.shape[0], b.shape[1], -1)} for e, b in zip(embeddings, batches)]
+
+        reports[encoder_path.name] = build_variants(
+            encoder_path, frames_of(frame_batches), frames_of(calibration_batches), tolerance
+        )
+        reports[head_path.name] = build_variants(
+            head_path, embeddings_of(frame_batches), embeddings_of(calibration_batches), tolerance
+        )
+    return reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="Modelo completo exportado (p. ej. checkpoints/cnn_lstm.onnx)")
+    parser.add_argument("--samples", type=int, default=8, help="Secuencias aleatorias de validacion")
+    parser.add_argument("--seq-len", type=int, default=16)
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    input_type = ort.InferenceSession(args.model, providers=["CPUExecutionProvider"]).get_inputs()[0].type
+    if input_type == "tensor(uint8)":  # preprocesado dentro del grafo: crops RGB uint8
+        shape = (1, args.seq_len, args.img_size, args.img_size, 3)
+        batches = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(args.samples)]
+    else:
+        shape = (1, args.seq_len, 3, args.img_size, args.img_size)
+        batches = [rng.random(shape, dtype=np.float32) for _ in range(args.samples)]
+    print("[optimize_onnx] Sin datos reservados: se valida con entradas aleatorias")
+    build_all_variants(args.model, batches, tolerance=args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,556 @@
+"""
+Backends de estado temporal por sesion para ml_service.
+
+- memory: dicts del proceso (un solo worker de uvicorn).
+- shm: ring buffers en memoria compartida, para varios workers en el mismo host.
+- redis: listas en Redis (o cualquier servidor que hable el protocolo), para varias replicas.
+
+Todos exponen la misma interfaz: push_features, push_model_input, model_window,
+end_session, evict_idle y status. `remote=True` indica que las llamadas hacen I/O y el
+servicio debe ejecutarlas fuera del event loop. Las features de cada sesion se
+agregan con TemporalAggregator (ventana y EMAs en O(1) por frame). LocalSessionSweeper
+libera el estado que cada proceso guarda por su cuenta para sesiones que ya no ve.
+"""
+import os
+import time
+import zlib
+import fcntl
+from array import array
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from multiprocessing import shared_memory, resource_tracker
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+from temporal_aggregator import TemporalAggregator
+
+
+class SessionStateStore:
+    """Interfaz comun de los backends de estado por sesion."""
+
+    remote = False
+
+    def __init__(
+        self,
+        maxlen: int,
+        on_evict: Optional[Callable[[int], None]] = None,
+        horizons: Iterable[float] = (),
+    ):
+        self.maxlen = maxlen
+        self.on_evict = on_evict
+        self.horizons = tuple(horizons)
+        self.evicted = 0
+
+    def push_features(self, session_key: int, features: Dict[str, Any]) -> Dict[str, Any]:
+        """Agrega las features del frame y devuelve el resumen temporal (TemporalAggregator.summary)."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _push(aggregator: TemporalAggregator, features: Dict[str, Any]) -> Dict[str, Any]:
+        aggregator.push(features.get("score"), features.get("eyes_open"), features.get("gaze_center"))
+        return aggregator.summary()
+
+    def push_model_input(self, session_key: int, model_input: np.ndarray, version: Optional[str] = None) -> int:
+        """
+        Agrega la entrada del modelo (crop uint8 o embedding) y devuelve cuantas hay en el
+        buffer. `version` es la del modelo que produjo la entrada: si cambia, o cambian la
+        forma o el dtype de la entrada, el buffer se vacia antes de agregarla para no
+        mezclar embeddings de encoders distintos.
+        """
+        raise NotImplementedError
+
+    def model_window(self, session_key: int) -> List[np.ndarray]:
+        """Buffer de entradas del modelo de la sesion, de la mas vieja a la mas nueva."""
+        raise NotImplementedError
+
+    def end_session(self, session_key: int) -> bool:
+        raise NotImplementedError
+
+    def evict_idle(self) -> int:
+        return 0
+
+    def status(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def _released(self, session_key: int) -> None:
+        if self.on_evict is not None:
+            self.on_evict(session_key)
+
+
+class _SessionState:
+    __slots__ = ("temporal", "frames", "frames_bytes", "frames_tag", "last_seen")
+
+    def __init__(self, maxlen: int, horizons: Iterable[float]):
+        self.temporal = TemporalAggregator(maxlen, horizons)
+        self.frames: deque = deque(maxlen=maxlen)
+        self.frames_bytes = 0
+        self.frames_tag: Optional[tuple] = None  # (version, dtype, shape) de las entradas del buffer
+        self.last_seen = time.monotonic()
+
+
+class InProcessSessionStore(SessionStateStore):
+    """
+    Estado en dicts del proceso, en orden LRU: se expulsan las sesiones tras
+    `idle_ttl_s` sin frames, o las menos recientes cuando los buffers superan
+    `memory_budget_mb`.
+    """
+
+    def __init__(self, maxlen: int, idle_ttl_s: float, memory_budget_mb: float, on_evict=None, horizons=()):
+        super().__init__(maxlen, on_evict, horizons)
+        self.idle_ttl_s = idle_ttl_s
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self._sessions: "OrderedDict[int, _SessionState]" = OrderedDict()
+        self._lock = Lock()
+        self.total_bytes = 0
+
+    def _touch(self, session_key: int) -> _SessionState:
+        state = self._sessions.get(session_key)
+        if state is None:
+            state = _SessionState(self.maxlen, self.horizons)
+            self._sessions[session_key] = state
+        else:
+            self._sessions.move_to_end(session_key)
+        state.last_seen = time.monotonic()
+        return state
+
+    def push_features(self, session_key: int, features: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            state = self._touch(session_key)
+            return self._push(state.temporal, features)
+
+    def push_model_input(self, session_key: int, model_input: np.ndarray, version: Optional[str] = None) -> int:
+        tag = (version, model_input.dtype.str, model_input.shape)
+        with self._lock:
+            state = self._touch(session_key)
+            if state.frames_tag != tag:
+                state.frames.clear()
+                self.total_bytes -= state.frames_bytes
+                state.frames_bytes = 0
+                state.frames_tag = tag
+            if len(state.frames) == state.frames.maxlen:
+                dropped = state.frames[0].nbytes
+                state.frames_bytes -= dropped
+                self.total_bytes -= dropped
+            state.frames.append(model_input)
+            state.frames_bytes += model_input.nbytes
+            self.total_bytes += model_input.nbytes
+            buffered = len(state.frames)
+            self._enforce_budget(keep=session_key)
+            return buffered
+
+    def model_window(self, session_key: int) -> List[np.ndarray]:
+        with self._lock:
+            state = self._sessions.get(session_key)
+            return list(state.frames) if state is not None else []
+
+    def end_session(self, session_key: int) -> bool:
+        with self._lock:
+            return self._drop(session_key)
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_ttl_s
+        evicted = 0
+        with self._lock:
+            while self._sessions:
+                key, state = next(iter(self._sessions.items()))
+                if state.last_seen > cutoff:
+                    break
+                self._drop(key)
+                evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def _enforce_budget(self, keep: int) -> None:
+        while self.total_bytes > self.memory_budget and len(self._sessions) > 1:
+            key = next(iter(self._sessions))
+            if key == keep:
+                break
+            self._drop(key)
+            self.evicted += 1
+
+    def _drop(self, session_key: int) -> bool:
+        state = self._sessions.pop(session_key, None)
+        if state is None:
+            return False
+        self.total_bytes -= state.frames_bytes
+        self._released(session_key)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "active_sessions": len(self._sessions),
+            "buffer_mb": round(self.total_bytes / (1024 * 1024), 2),
+            "budget_mb": round(self.memory_budget / (1024 * 1024), 2),
+            "evicted": self.evicted,
+        }
+
+
+_DTYPES = [np.dtype(np.uint8), np.dtype(np.float32), np.dtype(np.float16)]
+
+
+class SharedMemorySessionStore(SessionStateStore):
+    """
+    Ring buffers en un segmento de memoria compartida con `slots` sesiones fijas,
+    para que varios workers de uvicorn en el mismo host vean el mismo estado.
+    Cada slot guarda el estado del TemporalAggregator (float64) y hasta
+    `maxlen` entradas del modelo de hasta `frame_bytes` bytes. Si no quedan
+    slots libres se reutiliza el menos reciente. La exclusion entre procesos
+    usa flock sobre un archivo de lock.
+    """
+
+    # key, last_seen, version del modelo (crc32 + 1, 0 = sin version), (reservado),
+    # frames_len, frames_head, dtype, ndim, shape[3]
+    _HEADER_FIELDS = 11
+    _LAYOUT = [2, 6, 7, 8, 9, 10]  # campos que describen las filas del ring
+
+    def __init__(
+        self,
+        maxlen: int,
+        idle_ttl_s: float,
+        slots: int,
+        frame_bytes: int,
+        name: str = "visionclass_sessions",
+        on_evict=None,
+        horizons=(),
+    ):
+        super().__init__(maxlen, on_evict, horizons)
+        self.idle_ttl_s = idle_ttl_s
+        self.slots = slots
+        self.frame_bytes = frame_bytes
+        self.name = name
+        self._thread_lock = Lock()
+        self._lock_path = os.path.join("/tmp", f"{name}.lock")
+        self._lock_fd = os.open(self._lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+
+        header_bytes = slots * self._HEADER_FIELDS * 8
+        temporal_size = TemporalAggregator.state_size(maxlen, len(self.horizons))
+        features_bytes = slots * temporal_size * 8
+        frames_bytes = slots * maxlen * frame_bytes
+        size = header_bytes + features_bytes + frames_bytes
+        with self._locked():
+            try:
+                self._shm = shared_memory.SharedMemory(name=name)
+                created = False
+            except FileNotFoundError:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                created = True
+            # el segmento sobrevive a los workers (como un servidor de estado):
+            # no dejamos que el resource_tracker lo borre cuando sale un proceso
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            if self._shm.size < size:
+                raise RuntimeError(
+                    f"Segmento {name} de {self._shm.size} bytes no coincide con la configuracion "
+                    f"({size} bytes); borrar /dev/shm/{name} tras cambiar SESSION_*, TEMPORAL_EMA_S o MODEL_IMG_SIZE"
+                )
+            buf = self._shm.buf
+            self._header = np.ndarray((slots, self._HEADER_FIELDS), dtype=np.float64, buffer=buf)
+            temporal = np.ndarray((slots, temporal_size), dtype=np.float64, buffer=buf, offset=header_bytes)
+            # un agregador por slot que opera directamente sobre la memoria compartida
+            self._temporal = [TemporalAggregator(maxlen, self.horizons, temporal[i]) for i in range(slots)]
+            self._frames = np.ndarray(
+                (slots, maxlen, frame_bytes), dtype=np.uint8, buffer=buf, offset=header_bytes + features_bytes
+            )
+            if created:
+                self._header[:] = 0
+                self._header[:, 0] = -1
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _slot_for(self, session_key: int, create: bool = True) -> Optional[int]:
+        keys = self._header[:, 0]
+        found = np.flatnonzero(keys == session_key)
+        if found.size:
+            return int(found[0])
+        if not create:
+            return None
+        free = np.flatnonzero(keys == -1)
+        if free.size:
+            slot = int(free[0])
+        else:
+            slot = int(np.argmin(self._header[:, 1]))
+            self._release_slot(slot)
+            self.evicted += 1
+        self._header[slot] = 0
+        self._header[slot, 0] = session_key
+        self._temporal[slot].reset()
+        return slot
+
+    def _release_slot(self, slot: int) -> None:
+        key = int(self._header[slot, 0])
+        self._header[slot] = 0
+        self._header[slot, 0] = -1
+        if key != -1:
+            self._released(key)
+
+    def push_features(self, session_key: int, features: Dict[str, Any]) -> Dict[str, Any]:
+        with self._locked():
+            slot = self._slot_for(session_key)
+            self._header[slot, 1] = time.time()
+            return self._push(self._temporal[slot], features)
+
+    @staticmethod
+    def _version_tag(version: Optional[str]) -> float:
+        return float(zlib.crc32(version.encode()) + 1) if version is not None else 0.0
+
+    def push_model_input(self, session_key: int, model_input: np.ndarray, version: Optional[str] = None) -> int:
+        model_input = np.ascontiguousarray(model_input)
+        if model_input.nbytes > self.frame_bytes or model_input.ndim > 3:
+            raise ValueError(f"Entrada de {model_input.nbytes} bytes no cabe en el slot ({self.frame_bytes})")
+        shape = np.zeros(3)
+        shape[: model_input.ndim] = model_input.shape
+        # version, dtype, ndim y forma de las filas del ring: si otro worker (u otra
+        # version del modelo) escribio entradas distintas, no se reinterpretan
+        layout = np.array([self._version_tag(version), _DTYPES.index(model_input.dtype), model_input.ndim, *shape])
+        with self._locked():
+            slot = self._slot_for(session_key)
+            header = self._header[slot]
+            header[1] = time.time()
+            if not np.array_equal(header[self._LAYOUT], layout):
+                header[self._LAYOUT] = layout
+                header[4] = header[5] = 0
+            length, head = int(header[4]), int(header[5])
+            self._frames[slot, head, : model_input.nbytes] = model_input.view(np.uint8).ravel()
+            header[5] = (head + 1) % self.maxlen
+            header[4] = min(length + 1, self.maxlen)
+            return int(header[4])
+
+    def model_window(self, session_key: int) -> List[np.ndarray]:
+        with self._locked():
+            slot = self._slot_for(session_key, create=False)
+            if slot is None or not self._header[slot, 4]:
+                return []
+            header = self._header[slot]
+            dtype = _DTYPES[int(header[6])]
+            shape = tuple(int(d) for d in header[8 : 8 + int(header[7])])
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            raw = self._frames[slot, self._ring_order(int(header[4]), int(header[5])), :nbytes].copy()
+        return [row.view(dtype).reshape(shape) for row in raw]
+
+    def _ring_order(self, length: int, head: int) -> List[int]:
+        start = (head - length) % self.maxlen
+        return [(start + i) % self.maxlen for i in range(length)]
+
+    def end_session(self, session_key: int) -> bool:
+        with self._locked():
+            slot = self._slot_for(session_key, create=False)
+            if slot is None:
+                return False
+            self._release_slot(slot)
+            return True
+
+    def evict_idle(self) -> int:
+        cutoff = time.time() - self.idle_ttl_s
+        with self._locked():
+            idle = np.flatnonzero((self._header[:, 0] != -1) & (self._header[:, 1] < cutoff))
+            for slot in idle:
+                self._release_slot(int(slot))
+        self.evicted += int(idle.size)
+        return int(idle.size)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "backend": "shm",
+            "name": self.name,
+            "slots": self.slots,
+            "active_sessions": int(np.count_nonzero(self._header[:, 0] != -1)),
+            "segment_mb": round(self._shm.size / (1024 * 1024), 2),
+            "evicted": self.evicted,
+        }
+
+
+class RedisSessionStore(SessionStateStore):
+    """
+    Estado en Redis con expiracion `idle_ttl_s`: `<prefix>:<session>:temporal` guarda
+    el estado serializado del TemporalAggregator y `:frames` es una lista recortada a
+    `maxlen` (`:frames_tag` guarda version del modelo, dtype y forma de sus items: si
+    cambian la lista se vacia); asi varias replicas comparten la ventana de cada sesion y la
+    expulsion por inactividad la hace el propio servidor. Las lecturas-escrituras usan
+    WATCH/MULTI (se reintentan si otra replica toco la sesion en el medio) y la ventana
+    solo se lee con model_window, cuando toca inferir.
+    Acepta cualquier cliente compatible con redis-py (p. ej. uno local de pruebas).
+    """
+
+    remote = True
+
+    def __init__(
+        self,
+        maxlen: int,
+        idle_ttl_s: float,
+        url: str = "",
+        client=None,
+        prefix: str = "vc:session",
+        on_evict=None,
+        horizons=(),
+    ):
+        super().__init__(maxlen, on_evict, horizons)
+        if client is None:
+            if redis is None:
+                raise RuntimeError("Backend redis requiere el paquete `redis`")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.ttl = max(int(idle_ttl_s), 1)
+
+    def _key(self, session_key: int, kind: str) -> str:
+        return f"{self.prefix}:{session_key}:{kind}"
+
+    def push_features(self, session_key: int, features: Dict[str, Any]) -> Dict[str, Any]:
+        key = self._key(session_key, "temporal")
+
+        def update(pipe) -> Dict[str, Any]:
+            aggregator = TemporalAggregator(self.maxlen, self.horizons)
+            raw = pipe.get(key)
+            if raw is not None and len(raw) == len(aggregator.state) * 8:
+                aggregator.state = array("d", raw)
+            summary = self._push(aggregator, features)
+            pipe.multi()
+            pipe.set(key, aggregator.state.tobytes(), ex=self.ttl)
+            return summary
+
+        return self.client.transaction(update, key, value_from_callable=True)
+
+    def push_model_input(self, session_key: int, model_input: np.ndarray, version: Optional[str] = None) -> int:
+        model_input = np.ascontiguousarray(model_input)
+        shape = ",".join(str(d) for d in model_input.shape)
+        header = f"{model_input.dtype.str};{shape};".encode()
+        tag = f"{version or ''};".encode() + header
+        frames_key, tag_key = self._key(session_key, "frames"), self._key(session_key, "frames_tag")
+
+        def push(pipe) -> None:
+            current = pipe.get(tag_key)
+            pipe.multi()
+            if current != tag:
+                pipe.delete(frames_key)
+            pipe.rpush(frames_key, header + model_input.tobytes())
+            pipe.ltrim(frames_key, -self.maxlen, -1)
+            pipe.expire(frames_key, self.ttl)
+            pipe.set(tag_key, tag, ex=self.ttl)
+            pipe.llen(frames_key)
+
+        return int(self.client.transaction(push, tag_key)[-1])
+
+    def model_window(self, session_key: int) -> List[np.ndarray]:
+        return [self._decode(item) for item in self.client.lrange(self._key(session_key, "frames"), 0, -1)]
+
+    @staticmethod
+    def _decode(item: bytes) -> np.ndarray:
+        dtype, shape, raw = item.split(b";", 2)
+        dims = tuple(int(d) for d in shape.decode().split(",") if d)
+        return np.frombuffer(raw, dtype=np.dtype(dtype.decode())).reshape(dims)
+
+    def end_session(self, session_key: int) -> bool:
+        removed = self.client.delete(
+            self._key(session_key, "temporal"), self._key(session_key, "frames"), self._key(session_key, "frames_tag")
+        )
+        self._released(session_key)
+        return bool(removed)
+
+    def status(self) -> Dict[str, Any]:
+        return {"backend": "redis", "prefix": self.prefix, "ttl_s": self.ttl}
+
+
+class LocalSessionSweeper:
+    """
+    Sesiones vistas por este proceso. El estado de detector por sesion (FaceMesh, ROI,
+    Haar, gate, ultimo score del modelo) vive en cada proceso, pero on_evict solo corre
+    en el proceso que expulsa la sesion del store, y nunca cuando redis la expira por
+    TTL. Cada proceso llama a `release` para las sesiones que no ve hace `idle_ttl_s`:
+    `touch` registra cada frame y barre como mucho cada `sweep_every_s`; `sweep`
+    tambien se puede llamar desde un loop periodico.
+    """
+
+    def __init__(
+        self,
+        idle_ttl_s: float,
+        release: Callable[[int], None],
+        sweep_every_s: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.idle_ttl_s = idle_ttl_s
+        self.release = release
+        self.sweep_every_s = sweep_every_s if sweep_every_s is not None else max(min(idle_ttl_s / 4, 60.0), 1.0)
+        self.clock = clock
+        self.released = 0
+        self._last_seen: Dict[int, float] = {}
+        self._next_sweep = clock() + self.sweep_every_s
+        self._lock = Lock()
+
+    def touch(self, session_key: Optional[int]) -> None:
+        if session_key is None:
+            return
+        now = self.clock()
+        with self._lock:
+            self._last_seen[session_key] = now
+            due = now >= self._next_sweep
+        if due:
+            self.sweep()
+
+    def forget(self, session_key: int) -> None:
+        with self._lock:
+            self._last_seen.pop(session_key, None)
+
+    def sweep(self) -> int:
+        now = self.clock()
+        cutoff = now - self.idle_ttl_s
+        with self._lock:
+            self._next_sweep = now + self.sweep_every_s
+            idle = [key for key, seen in self._last_seen.items() if seen <= cutoff]
+            for key in idle:
+                del self._last_seen[key]
+        for key in idle:
+            self.release(key)
+        self.released += len(idle)
+        return len(idle)
+
+    def __len__(self) -> int:
+        return len(self._last_seen)
+
+
+def create_session_store(
+    backend: str,
+    maxlen: int,
+    idle_ttl_s: float,
+    memory_budget_mb: float,
+    frame_bytes: int,
+    on_evict=None,
+    horizons: Iterable[float] = (),
+) -> SessionStateStore:
+    """Construye el backend configurado en SESSION_STORE (memory|shm|redis)."""
+    backend = (backend or "memory").lower()
+    if backend == "shm":
+        slots = int(os.environ.get("SESSION_SHM_SLOTS", "0")) or max(
+            int(memory_budget_mb * 1024 * 1024 // max(maxlen * frame_bytes, 1)), 1
+        )
+        return SharedMemorySessionStore(
+            maxlen,
+            idle_ttl_s,
+            slots=slots,
+            frame_bytes=frame_bytes,
+            name=os.environ.get("SESSION_SHM_NAME", "visionclass_sessions"),
+            on_evict=on_evict,
+            horizons=horizons,
+        )
+    if backend == "redis":
+        return RedisSessionStore(
+            maxlen,
+            idle_ttl_s,
+            url=os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0"),
+            on_evict=on_evict,
+            horizons=horizons,
+        )
+    return InProcessSessionStore(maxlen, idle_ttl_s, memory_budget_mb, on_evict=on_evict, horizons=horizons)
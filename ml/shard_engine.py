@@ -0,0 +1,337 @@
+"""
+Motor multi-proceso con sesiones particionadas (ML_WORKER_MODE=sharded).
+
+Cada worker es un proceso propio con sus detectores, sesion ONNX y estado temporal;
+las sesiones se asignan a un worker por hashing consistente de `session_key`, asi el
+estado de una sesion vive siempre en el mismo proceso y no hay que compartirlo.
+
+Los bytes del frame viajan por memoria compartida: cada worker tiene un segmento con
+`slots` ranuras de `slot_bytes`; el proceso principal copia el frame a una ranura libre
+y por el pipe solo manda (id, operacion, ranura, largo, argumentos). El worker lee la
+ranura sin copiarla, responde un dict chico y recien entonces la ranura se libera.
+
+Si un worker muere, sus sesiones pasan a los demas (solo esas se remapean) mientras
+se reinicia, y vuelve al anillo cuando termina de inicializarse.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+from threading import Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class ShardError(Exception):
+    """Error de una llamada al motor, con el status HTTP que corresponde."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class ConsistentHashRing:
+    """
+    Anillo con `replicas` nodos virtuales por worker (mas nodos = reparto mas parejo;
+    con 512 la carga por worker queda en ~±10%). Quitar un worker solo remapea sus sesiones.
+    """
+
+    def __init__(self, nodes=(), replicas: int = 512):
+        self.replicas = replicas
+        self._nodes = set()
+        self._points: List[int] = []
+        self._owners: List[int] = []
+        for node in nodes:
+            self.add(node)
+
+    def _rebuild(self) -> None:
+        ring = sorted((_hash(f"worker-{node}-{r}"), node) for node in self._nodes for r in range(self.replicas))
+        self._points = [p for p, _ in ring]
+        self._owners = [o for _, o in ring]
+
+    def add(self, node: int) -> None:
+        if node not in self._nodes:
+            self._nodes.add(node)
+            self._rebuild()
+
+    def remove(self, node: int) -> None:
+        if node in self._nodes:
+            self._nodes.discard(node)
+            self._rebuild()
+
+    def node_for(self, key) -> Optional[int]:
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(str(key))) % len(self._points)
+        return self._owners[i]
+
+    @property
+    def nodes(self) -> List[int]:
+        return sorted(self._nodes)
+
+
+class _Shard:
+    """Lado principal de un worker: proceso, pipes, segmento y llamadas pendientes."""
+
+    __slots__ = ("index", "process", "requests", "replies", "shm", "free_slots", "pending", "ready", "pid", "restarts")
+
+    def __init__(self, index: int, shm: shared_memory.SharedMemory, slots: int):
+        self.index = index
+        self.shm = shm
+        self.free_slots = list(range(slots))
+        self.pending: Dict[int, Tuple[asyncio.Future, int]] = {}
+        self.process = None
+        self.requests = None
+        self.replies = None
+        self.ready: Optional[asyncio.Future] = None
+        self.pid: Optional[int] = None
+        self.restarts = 0
+
+
+class ShardedEngine:
+    def __init__(
+        self,
+        workers: int,
+        target: Callable,
+        slots: int,
+        slot_bytes: int,
+        restart_delay_s: float = 1.0,
+    ):
+        """`target(index, requests, replies, shm_name, slot_bytes)` es el main del worker (ver serve_shard)."""
+        self.workers = max(workers, 1)
+        self.target = target
+        self.slots = max(slots, 1)
+        self.slot_bytes = slot_bytes
+        self.restart_delay_s = restart_delay_s
+        self.ring = ConsistentHashRing()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._shards: List[_Shard] = []
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping = False
+
+    # --- ciclo de vida ------------------------------------------------------------
+
+    async def start(self, timeout_s: float = 300.0) -> int:
+        """Arranca los workers y espera a que terminen de inicializarse; devuelve cuantos quedaron listos."""
+        if self._shards:
+            return len(self.ring.nodes)
+        self._loop = asyncio.get_running_loop()
+        for index in range(self.workers):
+            shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_bytes)
+            shard = _Shard(index, shm, self.slots)
+            self._shards.append(shard)
+            self._spawn(shard)
+        try:
+            await asyncio.wait_for(asyncio.gather(*[s.ready for s in self._shards]), timeout_s)
+        except asyncio.TimeoutError:
+            pass
+        return len(self.ring.nodes)
+
+    def _spawn(self, shard: _Shard) -> None:
+        req_recv, req_send = self._ctx.Pipe(duplex=False)
+        rep_recv, rep_send = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=self.target,
+            args=(shard.index, req_recv, rep_send, shard.shm.name, self.slot_bytes),
+            name=f"ml-shard-{shard.index}",
+            daemon=True,
+        )
+        process.start()
+        req_recv.close()
+        rep_send.close()
+        shard.process, shard.requests, shard.replies = process, req_send, rep_recv
+        shard.ready = self._loop.create_future()
+        Thread(target=self._read_replies, args=(shard, rep_recv), name=f"ml-shard-reader-{shard.index}", daemon=True).start()
+
+    def _read_replies(self, shard: _Shard, conn) -> None:
+        """Hilo lector: pasa cada respuesta del worker al event loop."""
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                self._loop.call_soon_threadsafe(self._on_message, shard, conn, message)
+            except RuntimeError:  # event loop cerrado (shutdown)
+                return
+        try:
+            self._loop.call_soon_threadsafe(self._on_exit, shard, conn)
+        except RuntimeError:
+            pass
+
+    def _on_message(self, shard: _Shard, conn, message) -> None:
+        if conn is not shard.replies:
+            return  # respuesta de un proceso anterior ya reemplazado
+        if message[0] == "ready":
+            shard.pid = message[1]
+            self.ring.add(shard.index)
+            if not shard.ready.done():
+                shard.ready.set_result(shard.pid)
+            return
+        req_id, ok, payload = message
+        future, slot = shard.pending.pop(req_id, (None, -1))
+        if slot >= 0:
+            shard.free_slots.append(slot)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(payload)
+        else:
+            status_code, detail = payload
+            future.set_exception(ShardError(status_code, detail))
+
+    def _on_exit(self, shard: _Shard, conn) -> None:
+        if conn is not shard.replies:
+            return
+        self.ring.remove(shard.index)
+        for future, slot in shard.pending.values():
+            if slot >= 0:
+                shard.free_slots.append(slot)
+            if not future.done():
+                future.set_exception(ShardError(503, "Worker de ML reiniciado, reintente", retry_after=1))
+        shard.pending.clear()
+        if not shard.ready.done():
+            shard.ready.set_result(None)
+        if self._stopping:
+            return
+        shard.restarts += 1
+        print(f"[shards] Worker {shard.index} (pid {shard.pid}) termino; reiniciando")
+        self._loop.call_later(self.restart_delay_s, self._respawn, shard)
+
+    def _respawn(self, shard: _Shard) -> None:
+        if not self._stopping:
+            self._spawn(shard)
+
+    def shutdown(self, timeout_s: float = 5.0) -> None:
+        self._stopping = True
+        for shard in self._shards:
+            try:
+                shard.requests.send(None)
+            except (OSError, AttributeError):
+                pass
+        deadline = time.monotonic() + timeout_s
+        for shard in self._shards:
+            if shard.process is not None:
+                shard.process.join(max(deadline - time.monotonic(), 0.1))
+                if shard.process.is_alive():
+                    shard.process.terminate()
+            shard.shm.close()
+            shard.shm.unlink()
+        self._shards.clear()
+
+    # --- llamadas -----------------------------------------------------------------
+
+    def shard_for(self, session_key) -> Optional[int]:
+        return self.ring.node_for(session_key)
+
+    async def call(self, session_key, op: str, payload: bytes = b"", *args) -> Any:
+        """Ejecuta `op` en el worker dueño de la sesion; `payload` viaja por memoria compartida."""
+        index = self.ring.node_for(session_key)
+        if index is None:
+            raise ShardError(503, "Sin workers de ML disponibles, reintente", retry_after=1)
+        return await self.call_shard(index, op, payload, *args)
+
+    async def call_shard(self, index: int, op: str, payload: bytes = b"", *args) -> Any:
+        shard = self._shards[index]
+        slot = -1
+        if payload:
+            if len(payload) > self.slot_bytes:
+                raise ShardError(413, f"Frame de {len(payload)} bytes supera el maximo ({self.slot_bytes})")
+            if not shard.free_slots:
+                raise ShardError(429, "ML service saturado, reintente", retry_after=1)
+            slot = shard.free_slots.pop()
+            offset = slot * self.slot_bytes
+            shard.shm.buf[offset : offset + len(payload)] = payload
+        req_id = next(self._ids)
+        future = self._loop.create_future()
+        shard.pending[req_id] = (future, slot)
+        try:
+            shard.requests.send((req_id, op, slot, len(payload), args))
+        except (OSError, ValueError):
+            shard.pending.pop(req_id, None)
+            if slot >= 0:
+                shard.free_slots.append(slot)
+            raise ShardError(503, "Worker de ML no disponible, reintente", retry_after=1)
+        return await future
+
+    async def broadcast(self, op: str, *args) -> List[Any]:
+        """Ejecuta `op` en todos los workers vivos (p. ej. status)."""
+        return await asyncio.gather(
+            *[self.call_shard(index, op, b"", *args) for index in self.ring.nodes], return_exceptions=True
+        )
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "alive": len(self.ring.nodes),
+            "slots": self.slots,
+            "slot_bytes": self.slot_bytes,
+            "shards": [
+                {
+                    "index": s.index,
+                    "pid": s.pid,
+                    "ready": s.index in self.ring.nodes,
+                    "pending": len(s.pending),
+                    "free_slots": len(s.free_slots),
+                    "restarts": s.restarts,
+                }
+                for s in self._shards
+            ],
+        }
+
+
+def serve_shard(
+    requests,
+    replies,
+    shm_name: str,
+    slot_bytes: int,
+    handler: Callable[..., Any],
+    on_idle: Optional[Callable[[], Any]] = None,
+    idle_interval_s: float = 60.0,
+) -> None:
+    """
+    Bucle del worker: atiende las llamadas en orden con `handler(op, contenido, *args)`,
+    donde `contenido` es un memoryview sobre la ranura (valido solo durante la llamada).
+    Los errores con `status_code` (p. ej. HTTPException) se devuelven con ese status.
+    """
+    # el worker comparte el resource_tracker del proceso principal (spawn), que es el que
+    # hace unlink del segmento al apagar: no hay que desregistrarlo aca
+    shm = shared_memory.SharedMemory(name=shm_name)
+    replies.send(("ready", os.getpid()))
+    next_idle = time.monotonic() + idle_interval_s
+    while True:
+        if on_idle is not None and time.monotonic() >= next_idle:
+            on_idle()
+            next_idle = time.monotonic() + idle_interval_s
+        if not requests.poll(max(next_idle - time.monotonic(), 0.0) if on_idle is not None else None):
+            continue
+        try:
+            message = requests.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        req_id, op, slot, length, args = message
+        content = shm.buf[slot * slot_bytes : slot * slot_bytes + length] if slot >= 0 else memoryview(b"")
+        try:
+            reply = (req_id, True, handler(op, content, *args))
+        except Exception as e:
+            detail = getattr(e, "detail", None) or f"{type(e).__name__}: {e}"
+            reply = (req_id, False, (getattr(e, "status_code", 500), str(detail)))
+        finally:
+            try:
+                content.release()
+            except BufferError:  # el handler retuvo una vista; se libera al recolectarla
+                pass
+        replies.send(reply)
+    shm.close()
@@ -0,0 +1,133 @@
+"""
+Agregador temporal por sesion con costo O(1) por frame.
+
+- Ventana: ring buffer de `capacity` frames (score, eyes_open, gaze_center) con
+  sumas y conteos acumulados que se actualizan al entrar y salir cada frame.
+- EMAs por tiempo: medias moviles exponenciales con constantes de tiempo en
+  segundos (p. ej. 2, 8, 60) que cubren horizontes mas largos que la ventana
+  sin guardar frames; se ponderan por el tiempo real entre frames.
+
+Todo el estado es un vector plano de float64 (un array('d') propio o un
+memoryview sobre memoria compartida), asi el mismo codigo sirve para los
+backends memory, shm y redis de session_state.
+"""
+import math
+import time
+from array import array
+from typing import Any, Dict, Iterable, Optional
+
+# encabezado: largo, cabeza, suma de scores, frames con score, suma eyes, suma gaze, ultimo ts
+_LENGTH, _HEAD, _SUM_SCORE, _N_SCORE, _SUM_EYES, _SUM_GAZE, _LAST_TS = range(7)
+_HEADER = 7
+_RING_FIELDS = 3  # score (NaN = sin score), eyes_open, gaze_center
+_EMA_FIELDS = 5  # score, peso del score, eyes_open, gaze_center, peso
+
+
+class TemporalAggregator:
+    __slots__ = ("capacity", "horizons", "state", "_ema_offset")
+
+    def __init__(self, capacity: int, horizons: Iterable[float] = (), state=None):
+        self.capacity = max(int(capacity), 1)
+        self.horizons = tuple(float(h) for h in horizons if float(h) > 0)
+        size = self.state_size(self.capacity, len(self.horizons))
+        if state is None:
+            state = array("d", bytes(8 * size))
+        elif len(state) < size:
+            raise ValueError(f"Estado de {len(state)} valores, se esperaban {size}")
+        self.state = state
+        self._ema_offset = _HEADER + self.capacity * _RING_FIELDS
+
+    @staticmethod
+    def state_size(capacity: int, n_horizons: int) -> int:
+        """Cantidad de float64 que ocupa el estado de una sesion."""
+        return _HEADER + max(int(capacity), 1) * _RING_FIELDS + n_horizons * _EMA_FIELDS
+
+    def reset(self) -> None:
+        s = self.state
+        for i in range(len(s)):
+            s[i] = 0.0
+
+    def push(self, score: Optional[float], eyes_open: float, gaze_center: float, ts: Optional[float] = None) -> None:
+        s = self.state
+        ts = time.time() if ts is None else ts
+        value = math.nan if score is None else float(score)
+        eyes_open = float(eyes_open or 0.0)
+        gaze_center = float(gaze_center or 0.0)
+
+        length, head = int(s[_LENGTH]), int(s[_HEAD])
+        slot = _HEADER + head * _RING_FIELDS
+        if length == self.capacity:
+            old = s[slot]
+            if not math.isnan(old):
+                s[_SUM_SCORE] -= old
+                s[_N_SCORE] -= 1
+            s[_SUM_EYES] -= s[slot + 1]
+            s[_SUM_GAZE] -= s[slot + 2]
+        else:
+            length += 1
+        s[slot] = value
+        s[slot + 1] = eyes_open
+        s[slot + 2] = gaze_center
+        if score is not None:
+            s[_SUM_SCORE] += value
+            s[_N_SCORE] += 1
+        s[_SUM_EYES] += eyes_open
+        s[_SUM_GAZE] += gaze_center
+        head = (head + 1) % self.capacity
+        s[_LENGTH] = length
+        s[_HEAD] = head
+        if head == 0:
+            # una vez por vuelta se recalculan las sumas para no acumular error de redondeo
+            self._resum(length)
+
+        last_ts = s[_LAST_TS]
+        dt = max(ts - last_ts, 0.0) if last_ts > 0 else math.inf
+        offset = self._ema_offset
+        for horizon in self.horizons:
+            alpha = 1.0 - math.exp(-dt / horizon)
+            keep = 1.0 - alpha
+            if score is not None:
+                s[offset] = s[offset] * keep + alpha * value
+                s[offset + 1] = s[offset + 1] * keep + alpha
+            else:
+                s[offset] *= keep
+                s[offset + 1] *= keep
+            s[offset + 2] = s[offset + 2] * keep + alpha * eyes_open
+            s[offset + 3] = s[offset + 3] * keep + alpha * gaze_center
+            s[offset + 4] = s[offset + 4] * keep + alpha
+            offset += _EMA_FIELDS
+        s[_LAST_TS] = ts
+
+    def _resum(self, length: int) -> None:
+        s = self.state
+        sum_score = n_score = sum_eyes = sum_gaze = 0.0
+        for slot in range(_HEADER, _HEADER + length * _RING_FIELDS, _RING_FIELDS):
+            if not math.isnan(s[slot]):
+                sum_score += s[slot]
+                n_score += 1
+            sum_eyes += s[slot + 1]
+            sum_gaze += s[slot + 2]
+        s[_SUM_SCORE], s[_N_SCORE], s[_SUM_EYES], s[_SUM_GAZE] = sum_score, n_score, sum_eyes, sum_gaze
+
+    def summary(self) -> Dict[str, Any]:
+        """Medias de la ventana y de cada EMA (None si todavia no hubo frames con score)."""
+        s = self.state
+        length = int(s[_LENGTH])
+        n_score = s[_N_SCORE]
+        emas = {}
+        offset = self._ema_offset
+        for horizon in self.horizons:
+            weight, score_weight = s[offset + 4], s[offset + 1]
+            emas[horizon] = {
+                "score": s[offset] / score_weight if score_weight > 0 else None,
+                "eyes": s[offset + 2] / weight if weight > 0 else 0.0,
+                "gaze": s[offset + 3] / weight if weight > 0 else 0.0,
+            }
+            offset += _EMA_FIELDS
+        return {
+            "sequence_len": length,
+            "score_mean": s[_SUM_SCORE] / n_score if n_score > 0 else None,
+            "eyes_mean": s[_SUM_EYES] / length if length else 0.0,
+            "gaze_mean": s[_SUM_GAZE] / length if length else 0.0,
+            "ema": emas,
+        }
@@ -0,0 +1,71 @@
+"""
+Pruebas de EventOutbox: backoff exponencial entre lotes fallidos y descarte por tiempo
+fallando (no por cantidad de intentos).
+
+    cd ml && python -m pytest test_event_outbox.py
+"""
+import unittest
+from unittest import mock
+
+import ml_service
+from ml_service import AttentionEventPayload, EventOutbox
+
+
+def payload(i: int) -> AttentionEventPayload:
+    return AttentionEventPayload(session_id=1, user_id=i, value=0.5)
+
+
+class EventOutboxTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ml_service, "BACKEND_TOKEN", "token")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 0.0
+        self.statuses = []  # status del backend para cada POST; vacio = 200
+        self.outbox = EventOutbox(10, 200, 100, max_retry_s=60, backoff_max_ms=2000, clock=lambda: self.now)
+        self.outbox._send = self.send
+
+    async def send(self, endpoint, body):
+        return (self.statuses.pop(0) if self.statuses else 200), {"created": len(body)}
+
+    async def test_backoff_doubles_up_to_the_cap_and_resets_on_success(self):
+        self.outbox.put(payload(1), "COURSE")
+        delays = []
+        for _ in range(6):
+            self.statuses.append(503)
+            self.assertFalse(await self.outbox.flush_once())
+            delays.append(self.outbox.backoff)
+            self.now += self.outbox.backoff
+        self.assertEqual(delays, [0.2, 0.4, 0.8, 1.6, 2.0, 2.0])
+        self.assertTrue(await self.outbox.flush_once())
+        self.assertEqual(self.outbox.backoff, 0.0)
+        self.assertEqual(self.outbox.status()["sent"], 1)
+
+    async def test_short_outage_does_not_drop_events(self):
+        # un corte de ~1 s con el flush cada 200 ms: antes se agotaban 3 intentos
+        for i in range(3):
+            self.outbox.put(payload(i), "COURSE")
+        self.statuses = [0] * 8
+        while self.now < 1.0:
+            self.assertFalse(await self.outbox.flush_once())
+            self.now += self.outbox.backoff
+        self.statuses = []
+        self.assertTrue(await self.outbox.flush_once())
+        status = self.outbox.status()
+        self.assertEqual((status["sent"], status["failed"], status["pending"]), (3, 0, 0))
+
+    async def test_events_are_dropped_after_failing_for_max_retry_s(self):
+        self.outbox.put(payload(1), "COURSE")
+        self.statuses = [503] * 100
+        attempts = 0
+        while self.outbox.status()["pending"]:
+            await self.outbox.flush_once()
+            attempts += 1
+            self.now += self.outbox.backoff
+        self.assertEqual(self.outbox.failed, 1)
+        self.assertGreaterEqual(self.now, 60)
+        self.assertLess(attempts, 40)  # con backoff, no un intento por tick de 200 ms
+
+
+if __name__ == "__main__":
+    unittest.main()
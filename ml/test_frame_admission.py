@@ -0,0 +1,263 @@
+"""
+Pruebas de FrameAdmission: ultimo frame por sesion, turnos en el pool por prioridad
+y 429 por sobrecarga (primero los frames de curso).
+
+    cd ml && python -m pytest test_frame_admission.py
+"""
+import asyncio
+import unittest
+
+from fastapi import HTTPException
+
+from ml_service import (
+    PRIORITY_COURSE,
+    PRIORITY_D2R,
+    PRIORITY_D2R_URGENT,
+    PRIORITY_URGENT_S,
+    FrameAdmission,
+    frame_priority,
+)
+
+COURSE = (PRIORITY_COURSE, 0.0)
+
+
+class FrameAdmissionTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.started = []  # frames en el orden en que entraron al pool
+        self.holds = {}
+
+    def start(self, admission, name, session, priority=COURSE):
+        """Frame que entra al pool y se queda ahi hasta `release(name)`."""
+        hold = self.holds[name] = asyncio.Event()
+
+        async def frame():
+            async with admission.admit(session, priority):
+                self.started.append(name)
+                await hold.wait()
+
+        return asyncio.create_task(frame())
+
+    def release(self, name):
+        self.holds[name].set()
+
+    @staticmethod
+    async def settle():
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def rejection(self, task) -> HTTPException:
+        with self.assertRaises(HTTPException) as ctx:
+            await task
+        return ctx.exception
+
+    def assertIdle(self, admission):
+        self.assertEqual(admission.running, 0)
+        self.assertEqual(admission.in_flight, 0)
+        self.assertEqual(admission._slots, {})
+        self.assertEqual(admission._ready, [])
+
+
+class LatestFrameWinsTests(FrameAdmissionTestCase):
+    async def test_new_frame_replaces_the_waiting_one_with_409(self):
+        admission = FrameAdmission(workers=1, max_in_flight=10, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        await self.settle()
+        b = self.start(admission, "b", session=1)
+        await self.settle()
+        c = self.start(admission, "c", session=1)
+        await self.settle()
+        self.assertEqual((await self.rejection(b)).status_code, 409)
+        self.assertEqual(admission.superseded, 1)
+        self.assertEqual(admission.in_flight, 2)  # a en proceso, c esperando
+        self.release("a")
+        self.release("c")
+        await asyncio.gather(a, c)
+        self.assertEqual(self.started, ["a", "c"])
+        self.assertIdle(admission)
+
+    async def test_one_frame_per_session_in_the_pool(self):
+        admission = FrameAdmission(workers=2, max_in_flight=10, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=1)
+        c = self.start(admission, "c", session=2)
+        await self.settle()
+        # b espera a que termine a aunque haya un worker libre; c (otra sesion) entra
+        self.assertEqual(self.started, ["a", "c"])
+        self.release("a")
+        await self.settle()
+        self.assertEqual(self.started, ["a", "c", "b"])
+        for name in ("b", "c"):
+            self.release(name)
+        await asyncio.gather(a, b, c)
+        self.assertIdle(admission)
+
+    async def test_cancelled_waiting_frame_frees_its_place(self):
+        admission = FrameAdmission(workers=1, max_in_flight=10, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2)
+        c = self.start(admission, "c", session=1)
+        await self.settle()
+        self.assertEqual(admission.in_flight, 3)
+        b.cancel()  # cliente desconectado esperando el pool
+        c.cancel()  # cliente desconectado esperando el turno de la sesion
+        await self.settle()
+        self.assertEqual(admission.in_flight, 1)
+        self.release("a")
+        await a
+        for task in (b, c):
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(self.started, ["a"])
+        self.assertIdle(admission)
+
+
+class LoadSheddingTests(FrameAdmissionTestCase):
+    async def test_429_when_max_in_flight_is_reached(self):
+        admission = FrameAdmission(workers=1, max_in_flight=2, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2)
+        await self.settle()
+        shed = await self.rejection(self.start(admission, "c", session=3))
+        self.assertEqual(shed.status_code, 429)
+        self.assertIn("Retry-After", shed.headers)
+        self.assertEqual(admission.shed[PRIORITY_COURSE], 1)
+        self.release("a")
+        self.release("b")
+        await asyncio.gather(a, b)
+        self.assertEqual(self.started, ["a", "b"])
+        self.assertIdle(admission)
+
+    async def test_429_when_expected_wait_exceeds_limit(self):
+        admission = FrameAdmission(workers=1, max_in_flight=10, max_wait_s=1.5)
+        admission.observe(1.0)  # 1 s por frame
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2)  # espera estimada 1 s: entra
+        await self.settle()
+        self.assertAlmostEqual(admission.expected_wait(), 2.0)
+        shed = await self.rejection(self.start(admission, "c", session=3))
+        self.assertEqual(shed.status_code, 429)
+        self.assertEqual(shed.headers["Retry-After"], "2")
+        self.release("a")
+        self.release("b")
+        await asyncio.gather(a, b)
+        self.assertIdle(admission)
+
+    async def test_superseding_frame_is_not_shed(self):
+        # reemplazar al frame en espera de la sesion no suma carga: no pasa por el limite
+        admission = FrameAdmission(workers=1, max_in_flight=2, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=1)
+        await self.settle()
+        c = self.start(admission, "c", session=1)
+        await self.settle()
+        self.assertEqual((await self.rejection(b)).status_code, 409)
+        self.release("a")
+        self.release("c")
+        await asyncio.gather(a, c)
+        self.assertEqual(self.started, ["a", "c"])
+        self.assertIdle(admission)
+
+
+class PriorityTests(FrameAdmissionTestCase):
+    def test_frame_priority_classes(self):
+        self.assertEqual(frame_priority("D2R", None, PRIORITY_URGENT_S), (PRIORITY_D2R_URGENT, PRIORITY_URGENT_S))
+        self.assertEqual(frame_priority("d2r", None, 30), (PRIORITY_D2R, 30.0))
+        self.assertEqual(frame_priority("", 7, -1), (PRIORITY_D2R_URGENT, 0.0))  # sin test_name pero con sesion D2R
+        self.assertEqual(frame_priority("COURSE", 7, 1), COURSE)
+        self.assertEqual(frame_priority("", None, 1), COURSE)
+
+    async def test_pool_turns_follow_priority_not_arrival(self):
+        admission = FrameAdmission(workers=1, max_in_flight=10, max_wait_s=0)
+        tasks = [self.start(admission, "running", session=1)]
+        await self.settle()
+        arrivals = [
+            ("course", 2, COURSE),
+            ("d2r_30s", 3, frame_priority("D2R", None, 30)),
+            ("course_2", 4, COURSE),
+            ("urgent", 5, frame_priority("D2R", None, 2)),
+            ("d2r_10s", 6, frame_priority("D2R", None, 10)),
+        ]
+        for name, session, priority in arrivals:
+            tasks.append(self.start(admission, name, session, priority))
+        await self.settle()
+        self.assertEqual(admission.queued, [1, 2, 2])
+        for name in ["running", "urgent", "d2r_10s", "d2r_30s", "course", "course_2"]:
+            self.release(name)
+            await self.settle()
+        await asyncio.gather(*tasks)
+        # urgente, D2R con menos time_left primero, y curso en orden de llegada
+        self.assertEqual(self.started, ["running", "urgent", "d2r_10s", "d2r_30s", "course", "course_2"])
+        self.assertIdle(admission)
+
+    async def test_course_frames_are_shed_first(self):
+        admission = FrameAdmission(workers=1, max_in_flight=4, max_wait_s=0, course_share=0.5)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2)
+        await self.settle()
+        # curso solo puede ocupar la mitad de la cola; D2R sigue entrando
+        shed = await self.rejection(self.start(admission, "c", session=3))
+        self.assertEqual(shed.status_code, 429)
+        d = self.start(admission, "d", session=4, priority=frame_priority("D2R", None, 30))
+        await self.settle()
+        self.assertEqual(admission.shed, [0, 0, 1])
+        for name in ("a", "d", "b"):
+            self.release(name)
+            await self.settle()
+        await asyncio.gather(a, b, d)
+        self.assertEqual(self.started, ["a", "d", "b"])
+        self.assertIdle(admission)
+
+    async def test_course_wait_limit_is_scaled_by_share(self):
+        admission = FrameAdmission(workers=1, max_in_flight=10, max_wait_s=2.0, course_share=0.5)
+        admission.observe(1.0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2, priority=frame_priority("D2R", None, 30))
+        await self.settle()
+        # espera estimada 2 s: supera el 1 s de curso pero no los 2 s de D2R
+        self.assertEqual((await self.rejection(self.start(admission, "c", session=3))).status_code, 429)
+        d = self.start(admission, "d", session=4, priority=frame_priority("D2R", None, 2))
+        await self.settle()
+        for name in ("a", "d", "b"):
+            self.release(name)
+            await self.settle()
+        await asyncio.gather(a, b, d)
+        self.assertEqual(self.started, ["a", "d", "b"])
+        self.assertIdle(admission)
+
+    async def test_d2r_frame_preempts_the_last_waiting_course_frame(self):
+        admission = FrameAdmission(workers=1, max_in_flight=3, max_wait_s=0)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2)
+        c = self.start(admission, "c", session=3)
+        await self.settle()
+        d = self.start(admission, "d", session=4, priority=frame_priority("D2R", None, 30))
+        await self.settle()
+        # el ultimo de curso en llegar (c) cede su lugar con 429
+        shed = await self.rejection(c)
+        self.assertEqual(shed.status_code, 429)
+        self.assertEqual(admission.preempted, 1)
+        self.assertEqual(admission.in_flight, 3)
+        for name in ("a", "d", "b"):
+            self.release(name)
+            await self.settle()
+        await asyncio.gather(a, b, d)
+        self.assertEqual(self.started, ["a", "d", "b"])
+        self.assertIdle(admission)
+
+    async def test_d2r_is_shed_when_no_course_frame_can_be_preempted(self):
+        admission = FrameAdmission(workers=1, max_in_flight=2, max_wait_s=0)
+        d2r = frame_priority("D2R", None, 30)
+        a = self.start(admission, "a", session=1)
+        b = self.start(admission, "b", session=2, priority=d2r)
+        await self.settle()
+        shed = await self.rejection(self.start(admission, "c", session=3, priority=d2r))
+        self.assertEqual(shed.status_code, 429)
+        self.assertEqual(admission.shed, [0, 1, 0])
+        self.release("a")
+        self.release("b")
+        await asyncio.gather(a, b)
+        self.assertIdle(admission)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Pruebas de HaarFaceDetector: escalera de sets 0 -> 1 -> fino, cuantas pasadas cuesta
+cada frame y vuelta a un set mas barato tras `fine_every` frames.
+
+    cd ml && python -m pytest test_haar_detector.py
+"""
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import ml_service
+from ml_service import HAAR_PARAMS, HaarFaceDetector
+
+FINE = len(HAAR_PARAMS) - 1
+FINE_EVERY = 3
+
+
+class FakeCascade:
+    """Detecta un rostro solo con los sets de `detects`; registra el set de cada pasada."""
+
+    def __init__(self, detects=()):
+        self.detects = set(detects)
+        self.passes = []
+
+    def detectMultiScale(self, image, scaleFactor, minNeighbors, minSize):
+        idx = [p[0] for p in HAAR_PARAMS].index(scaleFactor)
+        self.passes.append(idx)
+        return [(10, 10, 40, 40)] if idx in self.detects else ()
+
+
+class HaarFaceDetectorTests(unittest.TestCase):
+    def setUp(self):
+        self.cascade = FakeCascade()
+        patcher = mock.patch.object(ml_service, "haar_cascades", return_value=(self.cascade, None))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.detector = HaarFaceDetector(detect_width=320, fine_every=FINE_EVERY)
+        self.gray = np.zeros((120, 160), dtype=np.uint8)
+
+    def frame(self, session_key=1):
+        """Pasadas (indices de set) que costo un frame y el set que detecto."""
+        self.cascade.passes = []
+        detected, params = self.detector.detect(self.gray, session_key)
+        self.assertEqual(detected is None, params is None)
+        return self.cascade.passes, (HAAR_PARAMS.index(params) if params is not None else None)
+
+    def test_steps_through_every_set(self):
+        self.cascade.detects = {1}
+        self.assertEqual(self.frame(), ([0, 1], 1))
+        self.assertEqual(self.frame(), ([1], 1))  # el set que funciono queda recordado
+        self.cascade.detects = {FINE}
+        self.assertEqual(self.frame(), ([1, FINE], FINE))
+
+    def test_face_without_detection_costs_one_pass_and_fine_every_n_frames(self):
+        passes = [self.frame()[0] for _ in range(2 + 2 * FINE_EVERY)]
+        self.assertEqual(passes[0], [0, 1])
+        self.assertEqual(passes[1], [1, FINE])  # la pasada fina entra ya en el primer fallo
+        for later in passes[2:]:
+            self.assertIn(later, ([1], [1, FINE], [0, 1]))
+        fine_passes = sum(FINE in p for p in passes)
+        self.assertLessEqual(fine_passes, 1 + (len(passes) - 2) // FINE_EVERY)
+
+    def test_fine_success_does_not_stick(self):
+        self.cascade.detects = {FINE}
+        self.frame()
+        self.assertEqual(self.frame(), ([1, FINE], FINE))
+        for _ in range(FINE_EVERY - 1):
+            self.assertEqual(self.frame(), ([FINE], FINE))
+        # tras fine_every frames con el set fino se vuelve a probar uno mas barato
+        self.cascade.detects = {1, FINE}
+        self.assertEqual(self.frame(), ([1], 1))
+        for _ in range(FINE_EVERY - 1):
+            self.assertEqual(self.frame(), ([1], 1))
+        self.assertEqual(self.frame(), ([0, 1], 1))
+
+    def test_sessions_keep_their_own_set_and_forget_resets(self):
+        self.cascade.detects = {1}
+        self.frame(session_key=1)
+        self.assertEqual(self.frame(session_key=2), ([0, 1], 1))
+        self.assertEqual(self.frame(session_key=1), ([1], 1))
+        self.detector.forget(1)
+        self.assertEqual(self.frame(session_key=1), ([0, 1], 1))
+
+    def test_shared_memory_is_updated_under_the_lock(self):
+        detector = HaarFaceDetector(detect_width=320, fine_every=FINE_EVERY, per_session=False)
+        self.cascade.detects = {0, 1, FINE}
+        threads = [
+            threading.Thread(target=lambda k=k: [detector.detect(self.gray, k) for _ in range(50)]) for k in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(list(detector._memory), [None])
+        idx, _, held = detector._memory[None]
+        self.assertIn(idx, range(len(HAAR_PARAMS)))
+        self.assertGreaterEqual(held, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Pruebas de InferenceBatcher: referencias a los batches en curso, stop() y fallback al
+score por frame cuando el pool de CPU esta lleno.
+
+    cd ml && python -m pytest test_inference_batcher.py
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+import numpy as np
+from fastapi import HTTPException
+
+import ml_service
+from ml_service import InferenceBatcher
+
+SEQ = [np.zeros(4, dtype=np.float32)]
+
+
+class InferenceBatcherTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(ml_service, "model_supports_batching", return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batcher = InferenceBatcher(max_batch=4, max_wait_ms=1)
+        self.batcher.start()
+        self.addAsyncCleanup(self.batcher.stop)
+
+    def pool(self, run):
+        patcher = mock.patch.object(ml_service.cpu_pool, "run", side_effect=run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_full_pool_falls_back_to_per_frame_score(self):
+        async def full(fn, seqs, version):
+            raise HTTPException(status_code=429, detail="ML service saturado, reintente")
+
+        self.pool(full)
+        self.assertEqual(await asyncio.gather(self.batcher.infer(SEQ, "v1"), self.batcher.infer(SEQ, "v1")), [None, None])
+        self.assertEqual(self.batcher.skipped, 2)
+        self.assertEqual(self.batcher.batches_run, 0)
+        # sin batching (o con max_batch 1) el fallback es el mismo
+        self.batcher.max_batch = 1
+        self.assertIsNone(await self.batcher.infer(SEQ, "v1"))
+        self.assertEqual(self.batcher.skipped, 3)
+
+    async def test_model_errors_still_reach_the_caller(self):
+        async def broken(fn, seqs, version):
+            raise RuntimeError("onnx")
+
+        self.pool(broken)
+        with self.assertRaises(RuntimeError):
+            await self.batcher.infer(SEQ, "v1")
+
+    async def test_stop_waits_for_batches_in_flight(self):
+        release = asyncio.Event()
+
+        async def slow(fn, seqs, version):
+            await release.wait()
+            return [0.5] * len(seqs)
+
+        self.pool(slow)
+        calls = [asyncio.create_task(self.batcher.infer(SEQ, "v1")) for _ in range(3)]
+        for _ in range(50):
+            if self.batcher._batches:
+                break
+            await asyncio.sleep(0.005)
+        self.assertEqual(len(self.batcher._batches), 1)
+        stop = asyncio.create_task(self.batcher.stop())
+        await asyncio.sleep(0)
+        self.assertFalse(stop.done())
+        release.set()
+        await stop
+        self.assertEqual(await asyncio.gather(*calls), [0.5, 0.5, 0.5])
+        self.assertEqual(self.batcher._batches, set())
+        self.assertEqual(self.batcher.batches_run, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
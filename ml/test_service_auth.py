@@ -0,0 +1,65 @@
+"""
+Pruebas del token de servicio en los endpoints de operacion de ml_service (modelos y
+fin de sesion).
+
+    cd ml && python -m pytest test_service_auth.py
+"""
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import ml_service
+
+TOKEN = "service-token"
+
+
+class ServiceTokenTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ml_service, "BACKEND_TOKEN", TOKEN)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(ml_service.app)  # sin startup: el rechazo no depende del runtime
+
+    def assertRejected(self, path, headers, status):
+        with mock.patch.object(ml_service.model_registry, "activate") as activate, mock.patch.object(
+            ml_service.model_registry, "rollback"
+        ) as rollback:
+            res = self.client.post(path, headers=headers)
+        self.assertEqual(res.status_code, status, res.text)
+        activate.assert_not_called()
+        rollback.assert_not_called()
+
+    def test_model_endpoints_reject_missing_or_wrong_token(self):
+        for path in ("/models/activate/v1", "/models/rollback"):
+            with self.subTest(path=path):
+                self.assertRejected(path, {}, 401)
+                self.assertRejected(path, {"Authorization": "Bearer nope"}, 403)
+                self.assertRejected(path, {"Authorization": TOKEN}, 403)  # sin esquema Bearer
+
+    def test_model_endpoints_are_disabled_without_backend_token(self):
+        with mock.patch.object(ml_service, "BACKEND_TOKEN", ""):
+            self.assertRejected("/models/rollback", {"Authorization": "Bearer "}, 403)
+
+    def test_model_endpoints_accept_the_backend_token(self):
+        with mock.patch.object(ml_service.model_registry, "activate", side_effect=KeyError("v9")) as activate:
+            res = self.client.post("/models/activate/v9", headers={"Authorization": f"Bearer {TOKEN}"})
+        self.assertEqual(res.status_code, 404)
+        activate.assert_called_once_with("v9")
+
+    def test_end_session_rejects_missing_or_wrong_token(self):
+        with mock.patch.object(ml_service.session_store, "end_session") as end:
+            self.assertEqual(self.client.post("/sessions/7/end").status_code, 401)
+            res = self.client.post("/sessions/7/end", headers={"Authorization": "Bearer nope"})
+            self.assertEqual(res.status_code, 403)
+        end.assert_not_called()
+
+    def test_end_session_accepts_the_backend_token(self):
+        with mock.patch.object(ml_service.session_store, "end_session", return_value=True) as end:
+            res = self.client.post("/sessions/7/end", headers={"Authorization": f"Bearer {TOKEN}"})
+        self.assertEqual(res.json(), {"ok": True, "released": True})
+        end.assert_called_once_with(7)
+
+
+if __name__ == "__main__":
+    unittest.main()
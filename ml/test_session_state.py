@@ -0,0 +1,250 @@
+"""
+Pruebas de los backends de session_state: memory, shm (segmento propio por prueba)
+y redis (contra fakeredis si esta instalado), y de LocalSessionSweeper.
+
+    cd ml && python -m pytest test_session_state.py
+"""
+import multiprocessing
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import numpy as np
+
+from session_state import InProcessSessionStore, LocalSessionSweeper, RedisSessionStore, SharedMemorySessionStore
+
+try:
+    import fakeredis
+    from redis.commands.core import ListCommands
+except ImportError:
+    fakeredis = None
+
+MAXLEN = 4
+
+
+def embedding(value: float, size: int = 8) -> np.ndarray:
+    return np.full(size, value, dtype=np.float32)
+
+
+class SessionStoreContract:
+    """Comportamiento comun a todos los backends; cada subclase construye su store."""
+
+    def make_store(self, maxlen: int = MAXLEN):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+
+    def test_window_keeps_last_maxlen_inputs_in_order(self):
+        for i in range(MAXLEN + 2):
+            buffered = self.store.push_model_input(1, embedding(i), "v1")
+        self.assertEqual(buffered, MAXLEN)
+        window = self.store.model_window(1)
+        self.assertEqual([float(x[0]) for x in window], [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(window[0].dtype, np.float32)
+        self.assertEqual(window[0].shape, (8,))
+
+    def test_sessions_are_independent(self):
+        self.store.push_model_input(1, embedding(1), "v1")
+        self.store.push_model_input(2, embedding(2), "v1")
+        self.store.push_model_input(2, embedding(3), "v1")
+        self.assertEqual([float(x[0]) for x in self.store.model_window(1)], [1.0])
+        self.assertEqual([float(x[0]) for x in self.store.model_window(2)], [2.0, 3.0])
+        self.assertEqual(self.store.model_window(3), [])
+
+    def test_model_version_change_resets_window(self):
+        for i in range(3):
+            self.store.push_model_input(1, embedding(i), "v1")
+        self.assertEqual(self.store.push_model_input(1, embedding(9), "v2"), 1)
+        self.assertEqual([float(x[0]) for x in self.store.model_window(1)], [9.0])
+
+    def test_shape_or_dtype_change_resets_window(self):
+        self.store.push_model_input(1, embedding(1), "v1")
+        self.store.push_model_input(1, embedding(2), "v1")
+        crop = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+        self.assertEqual(self.store.push_model_input(1, crop, "v1"), 1)
+        window = self.store.model_window(1)
+        self.assertEqual(len(window), 1)
+        np.testing.assert_array_equal(window[0], crop)
+        self.assertEqual(self.store.push_model_input(1, embedding(3, size=4), "v1"), 1)
+        self.assertEqual(self.store.model_window(1)[0].shape, (4,))
+
+    def test_end_session_drops_state_and_notifies(self):
+        released = []
+        self.store.on_evict = released.append
+        self.store.push_model_input(1, embedding(1), "v1")
+        self.store.push_features(1, {"score": 0.5, "eyes_open": 1.0, "gaze_center": 1.0})
+        self.assertTrue(self.store.end_session(1))
+        self.assertEqual(released, [1])
+        self.assertEqual(self.store.model_window(1), [])
+        summary = self.store.push_features(1, {"score": 0.2, "eyes_open": 0.0, "gaze_center": 0.0})
+        self.assertEqual(summary["sequence_len"], 1)
+
+    def test_push_features_accumulates(self):
+        for score in (0.2, 0.4, None):
+            summary = self.store.push_features(1, {"score": score, "eyes_open": 1.0, "gaze_center": 0.5})
+        self.assertEqual(summary["sequence_len"], 3)
+        self.assertAlmostEqual(summary["score_mean"], 0.3)
+        self.assertAlmostEqual(summary["gaze_mean"], 0.5)
+
+
+class InProcessSessionStoreTests(SessionStoreContract, unittest.TestCase):
+    def make_store(self, maxlen: int = MAXLEN):
+        return InProcessSessionStore(maxlen, idle_ttl_s=60, memory_budget_mb=1, horizons=(2.0,))
+
+    def test_reset_releases_budget_bytes(self):
+        for i in range(3):
+            self.store.push_model_input(1, embedding(i), "v1")
+        self.store.push_model_input(1, embedding(9), "v2")
+        self.assertEqual(self.store.total_bytes, embedding(0).nbytes)
+
+
+class SharedMemorySessionStoreTests(SessionStoreContract, unittest.TestCase):
+    def make_store(self, maxlen: int = MAXLEN, name: str = None):
+        store = SharedMemorySessionStore(
+            maxlen, idle_ttl_s=60, slots=4, frame_bytes=64, name=name or f"vc_test_{uuid.uuid4().hex[:8]}", horizons=(2.0,)
+        )
+        self.addCleanup(store._shm.close)
+        if name is None:
+            self.addCleanup(store._shm.unlink)
+        return store
+
+    def test_other_worker_sees_layout_of_rows_it_did_not_write(self):
+        # otro worker (otro proceso con su propio store) sobre el mismo segmento
+        other = self.make_store(name=self.store.name)
+        crop = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+        self.store.push_model_input(1, crop, "v1")
+        window = other.model_window(1)
+        self.assertEqual(window[0].dtype, np.uint8)
+        np.testing.assert_array_equal(window[0], crop)
+        # y si escribe entradas de otro formato el ring se reinicia en vez de reinterpretarse
+        self.assertEqual(other.push_model_input(1, embedding(5), "v1"), 1)
+        self.assertEqual([float(x[0]) for x in self.store.model_window(1)], [5.0])
+
+    def test_rejects_inputs_larger_than_slot(self):
+        with self.assertRaises(ValueError):
+            self.store.push_model_input(1, np.zeros(65, dtype=np.uint8), "v1")
+
+
+@unittest.skipIf(fakeredis is None, "requiere fakeredis")
+class RedisSessionStoreTests(SessionStoreContract, unittest.TestCase):
+    def make_store(self, maxlen: int = MAXLEN, server=None):
+        self.server = server or getattr(self, "server", None) or fakeredis.FakeServer()
+        return RedisSessionStore(maxlen, idle_ttl_s=60, client=fakeredis.FakeRedis(server=self.server), horizons=(2.0,))
+
+    def test_push_does_not_read_the_window(self):
+        with mock.patch.object(ListCommands, "lrange", side_effect=AssertionError("LRANGE en el push")):
+            for i in range(MAXLEN + 1):
+                self.store.push_model_input(1, embedding(i), "v1")
+        self.assertEqual(len(self.store.model_window(1)), MAXLEN)
+
+    def test_concurrent_replicas_do_not_lose_temporal_updates(self):
+        replicas = [self.make_store(maxlen=1000, server=self.server) for _ in range(4)]
+        features = {"score": 1.0, "eyes_open": 1.0, "gaze_center": 1.0}
+
+        def run(store):
+            for _ in range(50):
+                store.push_features(7, features)
+
+        threads = [threading.Thread(target=run, args=(store,)) for store in replicas]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(replicas[0].push_features(7, features)["sequence_len"], 201)
+
+
+def _worker_with_detector_state(shm_name, ready, ended, out):
+    """Otro worker: guarda estado de detector de la sesion 1 y solo lo libera su barrido."""
+    store = SharedMemorySessionStore(MAXLEN, idle_ttl_s=60, slots=4, frame_bytes=64, name=shm_name, horizons=(2.0,))
+    detector_state, released = {}, []
+
+    def release(key):
+        detector_state.pop(key, None)
+        released.append(key)
+
+    sweeper = LocalSessionSweeper(0.2, release, sweep_every_s=0)
+    store.on_evict = release
+    store.push_model_input(1, embedding(1), "v1")
+    detector_state[1] = "face mesh"
+    sweeper.touch(1)
+    ready.set()
+    ended.wait(10)
+    time.sleep(0.3)
+    sweeper.touch(2)  # el frame de otra sesion dispara el barrido
+    out.put((sorted(detector_state), released))
+    store._shm.close()
+
+
+class LocalSessionSweeperTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.released = []
+        self.sweeper = LocalSessionSweeper(60, self.released.append, sweep_every_s=10, clock=lambda: self.now)
+
+    def test_releases_only_sessions_idle_for_the_ttl(self):
+        self.sweeper.touch(1)
+        self.now += 30
+        self.sweeper.touch(2)
+        self.now += 31
+        self.assertEqual(self.sweeper.sweep(), 1)
+        self.assertEqual(self.released, [1])
+        self.assertEqual(len(self.sweeper), 1)
+
+    def test_touch_sweeps_at_most_every_interval(self):
+        self.sweeper.touch(1)
+        self.now += 61
+        self.sweeper.touch(2)  # primer barrido: libera 1
+        self.now += 5
+        self.sweeper.forget(2)
+        self.sweeper.touch(3)
+        self.assertEqual(self.released, [1])
+        self.now += 70
+        self.sweeper.touch(4)
+        self.assertEqual(self.released, [1, 3])
+
+    def test_forget_skips_sessions_already_released_by_on_evict(self):
+        self.sweeper.touch(1)
+        self.sweeper.forget(1)
+        self.now += 120
+        self.assertEqual(self.sweeper.sweep(), 0)
+        self.assertEqual(self.released, [])
+
+    @unittest.skipIf(fakeredis is None, "requiere fakeredis")
+    def test_releases_state_of_sessions_expired_by_redis(self):
+        client = fakeredis.FakeRedis()
+        store = RedisSessionStore(MAXLEN, idle_ttl_s=60, client=client, on_evict=self.released.append)
+        store.push_model_input(1, embedding(1), "v1")
+        self.sweeper.touch(1)
+        client.flushall()  # lo que hace el TTL de redis: on_evict no corre en ningun proceso
+        self.assertEqual(self.released, [])
+        self.now += 61
+        self.assertEqual(self.sweeper.sweep(), 1)
+        self.assertEqual(self.released, [1])
+
+    def test_other_process_releases_state_of_a_session_ended_here(self):
+        store = SharedMemorySessionStore(
+            MAXLEN, idle_ttl_s=60, slots=4, frame_bytes=64, name=f"vc_test_{uuid.uuid4().hex[:8]}", horizons=(2.0,)
+        )
+        self.addCleanup(store._shm.unlink)
+        self.addCleanup(store._shm.close)
+        here = []
+        store.on_evict = here.append
+        ctx = multiprocessing.get_context("spawn")
+        ready, ended, out = ctx.Event(), ctx.Event(), ctx.Queue()
+        worker = ctx.Process(target=_worker_with_detector_state, args=(store.name, ready, ended, out))
+        worker.start()
+        self.addCleanup(worker.join, 10)
+        self.assertTrue(ready.wait(30))
+        self.assertTrue(store.end_session(1))
+        ended.set()
+        remaining, released = out.get(timeout=30)
+        self.assertEqual(here, [1])  # on_evict solo corrio en este proceso
+        self.assertEqual(released, [1])  # el otro libero su estado con el barrido
+        self.assertEqual(remaining, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
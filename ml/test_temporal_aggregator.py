@@ -0,0 +1,139 @@
+"""
+Pruebas de TemporalAggregator contra un recalculo ingenuo desde la lista completa de frames.
+
+    cd ml && python -m pytest test_temporal_aggregator.py
+"""
+import math
+import random
+import unittest
+from array import array
+
+import numpy as np
+
+from temporal_aggregator import TemporalAggregator
+
+HORIZONS = (2.0, 8.0, 60.0)
+
+
+def naive_summary(frames, capacity, horizons):
+    """Medias de la ventana y EMAs recalculadas desde cero; frames = [(score, eyes, gaze, ts)]."""
+    window = frames[-capacity:]
+    scores = [f[0] for f in window if f[0] is not None]
+    summary = {
+        "sequence_len": len(window),
+        "score_mean": sum(scores) / len(scores) if scores else None,
+        "eyes_mean": sum(f[1] for f in window) / len(window) if window else 0.0,
+        "gaze_mean": sum(f[2] for f in window) / len(window) if window else 0.0,
+        "ema": {},
+    }
+    for horizon in horizons:
+        # peso de cada frame: su alpha por lo que decayo con los frames posteriores
+        alphas = []
+        for i, frame in enumerate(frames):
+            dt = max(frame[3] - frames[i - 1][3], 0.0) if i else math.inf
+            alphas.append(1.0 - math.exp(-dt / horizon))
+        weights = []
+        for i, alpha in enumerate(alphas):
+            weight = alpha
+            for later in alphas[i + 1 :]:
+                weight *= 1.0 - later
+            weights.append(weight)
+        total = sum(weights)
+        score_weight = sum(w for w, f in zip(weights, frames) if f[0] is not None)
+        summary["ema"][horizon] = {
+            "score": sum(w * f[0] for w, f in zip(weights, frames) if f[0] is not None) / score_weight
+            if score_weight > 0
+            else None,
+            "eyes": sum(w * f[1] for w, f in zip(weights, frames)) / total if total > 0 else 0.0,
+            "gaze": sum(w * f[2] for w, f in zip(weights, frames)) / total if total > 0 else 0.0,
+        }
+    return summary
+
+
+def random_frames(rng, count):
+    frames, ts = [], 1000.0
+    for _ in range(count):
+        ts += rng.choice([0.0, 0.05, 0.5, 1.0, 3.0, 30.0])
+        score = None if rng.random() < 0.25 else rng.random()
+        frames.append((score, float(rng.random() < 0.8), rng.random(), ts))
+    return frames
+
+
+class TemporalAggregatorTests(unittest.TestCase):
+    def assertSummaryEqual(self, got, expected):
+        self.assertEqual(got["sequence_len"], expected["sequence_len"])
+        for key in ("score_mean", "eyes_mean", "gaze_mean"):
+            self.assertClose(got[key], expected[key], key)
+        self.assertEqual(set(got["ema"]), set(expected["ema"]))
+        for horizon, values in expected["ema"].items():
+            for key, value in values.items():
+                self.assertClose(got["ema"][horizon][key], value, f"ema[{horizon}].{key}")
+
+    def assertClose(self, got, expected, what):
+        if expected is None:
+            self.assertIsNone(got, what)
+        else:
+            self.assertIsNotNone(got, what)
+            self.assertAlmostEqual(got, expected, places=9, msg=what)
+
+    def test_matches_naive_recompute_after_every_frame(self):
+        rng = random.Random(1234)
+        for capacity in (1, 3, 16):
+            frames = random_frames(rng, 5 * capacity + 7)  # varias vueltas del ring (y del recalculo de sumas)
+            aggregator = TemporalAggregator(capacity, HORIZONS)
+            for i, frame in enumerate(frames):
+                aggregator.push(*frame)
+                with self.subTest(capacity=capacity, frame=i):
+                    self.assertSummaryEqual(aggregator.summary(), naive_summary(frames[: i + 1], capacity, HORIZONS))
+
+    def test_empty_and_scoreless_windows(self):
+        aggregator = TemporalAggregator(4, HORIZONS)
+        self.assertSummaryEqual(aggregator.summary(), naive_summary([], 4, HORIZONS))
+        frames = [(None, 1.0, 0.5, 10.0), (None, 0.0, 0.5, 11.0)]
+        for frame in frames:
+            aggregator.push(*frame)
+        summary = aggregator.summary()
+        self.assertIsNone(summary["score_mean"])
+        self.assertIsNone(summary["ema"][2.0]["score"])
+        self.assertSummaryEqual(summary, naive_summary(frames, 4, HORIZONS))
+
+    def test_scores_leaving_the_window_stop_counting(self):
+        aggregator = TemporalAggregator(2)
+        for ts, score in enumerate((1.0, None, 0.0, 0.5)):
+            aggregator.push(score, 1.0, 1.0, ts=float(ts))
+        self.assertAlmostEqual(aggregator.summary()["score_mean"], 0.25)
+        aggregator.push(None, 1.0, 1.0, ts=5.0)
+        aggregator.push(None, 1.0, 1.0, ts=6.0)
+        self.assertIsNone(aggregator.summary()["score_mean"])
+
+    def test_state_round_trips_through_bytes_and_shared_buffers(self):
+        # como lo usan los backends redis (bytes) y shm (fila float64 de un segmento)
+        frames = random_frames(random.Random(7), 40)
+        reference = TemporalAggregator(8, HORIZONS)
+        row = np.zeros(TemporalAggregator.state_size(8, len(HORIZONS)))
+        shared = TemporalAggregator(8, HORIZONS, row)
+        raw = None
+        for frame in frames:
+            reference.push(*frame)
+            shared.push(*frame)
+            restored = TemporalAggregator(8, HORIZONS)
+            if raw is not None:
+                restored.state = array("d", raw)
+            restored.push(*frame)
+            raw = restored.state.tobytes()
+        expected = naive_summary(frames, 8, HORIZONS)
+        self.assertSummaryEqual(reference.summary(), expected)
+        self.assertSummaryEqual(shared.summary(), expected)
+        self.assertSummaryEqual(restored.summary(), expected)
+
+    def test_reset_and_state_size_validation(self):
+        aggregator = TemporalAggregator(4, HORIZONS)
+        aggregator.push(0.5, 1.0, 1.0, ts=1.0)
+        aggregator.reset()
+        self.assertEqual(aggregator.summary()["sequence_len"], 0)
+        with self.assertRaises(ValueError):
+            TemporalAggregator(4, HORIZONS, array("d", bytes(8)))
+
+
+if __name__ == "__main__":
+    unittest.main()
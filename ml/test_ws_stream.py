@@ -0,0 +1,78 @@
+"""
+Pruebas de /ws/stream: validacion del mensaje inicial y errores por mensaje sin cerrar
+el canal.
+
+    cd ml && python -m pytest test_ws_stream.py
+"""
+import json
+import unittest
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+import ml_service
+from ml_service import WS_FRAME_HEADER, WS_KIND_IMAGE
+
+HELLO = {"session_id": 7, "user_id": 3, "test_name": "COURSE"}
+
+
+def frame_message(seq: int) -> bytes:
+    return WS_FRAME_HEADER.pack(WS_KIND_IMAGE, 0, 1, 10.0, seq) + b"jpeg"
+
+
+class StreamHelloTests(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ml_service, "WS_AUTH_REQUIRED", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = TestClient(ml_service.app)  # sin startup: process_frame se reemplaza
+
+    def hello_reply(self, hello):
+        with self.client.websocket_connect("/ws/stream") as ws:
+            ws.send_text(hello if isinstance(hello, str) else json.dumps(hello))
+            return ws.receive_json()
+
+    def test_invalid_hello_fields_get_a_structured_error(self):
+        cases = [
+            ({**HELLO, "width": "abc"}, "width"),
+            ({**HELLO, "height": -1}, "height"),
+            ({**HELLO, "session_id": [1]}, "session_id"),
+            ({**HELLO, "user_id": "x"}, "user_id"),
+            ({"user_id": 3}, ""),  # sin sesion
+            ({**HELLO, "dtype": "int8"}, ""),
+            ("no es json", ""),
+            ("[1, 2]", ""),
+        ]
+        for hello, field in cases:
+            with self.subTest(hello=hello):
+                reply = self.hello_reply(hello)
+                self.assertEqual((reply["ok"], reply["status"]), (False, 400))
+                self.assertEqual(reply["detail"], "Mensaje inicial invalido")
+                self.assertIn(field, [e["field"] for e in reply["errors"]])
+
+    def test_missing_user_id_without_auth(self):
+        reply = self.hello_reply({"session_id": 7})
+        self.assertEqual(reply, {"ok": False, "status": 400, "detail": "user_id requerido"})
+
+    def test_failing_frame_keeps_the_connection_open(self):
+        process = mock.AsyncMock(side_effect=[RuntimeError("boom"), {"ok": True, "score": 0.5}])
+        with mock.patch.object(ml_service, "process_frame", process), mock.patch.object(
+            ml_service.frame_log, "error"
+        ) as log_error:
+            with self.client.websocket_connect("/ws/stream") as ws:
+                ws.send_json({**HELLO, "width": "320", "height": 240})
+                self.assertEqual(ws.receive_json()["type"], "ready")
+                ws.send_bytes(frame_message(1))
+                failed = ws.receive_json()
+                self.assertEqual((failed["ok"], failed["status"], failed["seq"]), (False, 500, 1))
+                ws.send_text("texto en vez de frame")
+                self.assertEqual(ws.receive_json()["detail"], "Mensaje invalido")
+                ws.send_bytes(frame_message(2))
+                self.assertEqual(ws.receive_json(), {"ok": True, "score": 0.5, "seq": 2})
+        log_error.assert_called_once()
+        self.assertEqual(log_error.call_args.args[0], "ws_frame_error")
+        self.assertEqual(process.await_args.args[1], 7)  # session_key
+
+
+if __name__ == "__main__":
+    unittest.main()
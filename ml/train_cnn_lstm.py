@@ -14,6 +14,9 @@ from PIL import Image
 import random
 import numpy as np
 
+from graph_preprocess import FramePreprocess, check_onnx_export, sample_frames, uint8_frames
+from optimize_onnx import build_all_variants
+
 
 class FrameSequenceDataset(Dataset):
     def __init__(self, df: pd.DataFrame, seq_len: int, transform=None):
@@ -35,7 +38,8 @@ class FrameSequenceDataset(Dataset):
             if self.transform:
                 img = self.transform(img)
             imgs.append(img)
-        x = torch.stack(imgs, dim=0)  # (T, C, H, W)
+        # (T, H, W, C) uint8: la normalizacion y el cambio de layout estan dentro del modelo
+        x = torch.stack(imgs, dim=0).permute(0, 2, 3, 1).contiguous()
         mask_tensor = torch.tensor(mask, dtype=torch.float32)
         return x, mask_tensor, torch.tensor(y, dtype=torch.float32), row["user_id"]
 
@@ -43,6 +47,7 @@ class FrameSequenceDataset(Dataset):
 class CNNLSTM(nn.Module):
     def __init__(self, embedding_dim=256, hidden_dim=128, num_layers=1):
         super().__init__()
+        self.preprocess = FramePreprocess()
         backbone = models.mobilenet_v3_small(weights=models.MobileNet_V3_Small_Weights.DEFAULT)
         backbone.classifier = nn.Identity()
         self.encoder = backbone
@@ -61,17 +66,25 @@ class CNNLSTM(nn.Module):
             nn.Sigmoid(),
         )
 
-    def forward(self, x, mask=None):
-        # x: (B, T, C, H, W)
-        b, t, c, h, w = x.shape
-        x = x.view(b * t, c, h, w)
-        feats = self.encoder(x)  # (b*t, C, H', W')
-        feats = self.proj(feats)  # (b*t, E)
-        feats = feats.view(b, t, -1)  # (b, t, E)
+    def embed(self, x):
+        # x: (N, H, W, C) uint8 -> (N, E)
+        feats = self.encoder(self.preprocess(x))  # (N, C, H', W')
+        return self.proj(feats)
+
+    def score_embeddings(self, feats):
+        # feats: (B, T, E) -> (B,)
         lstm_out, _ = self.lstm(feats)
         # many-to-one: take last hidden
         last = lstm_out[:, -1, :]
-        out = self.head(last).squeeze(1)
+        return self.head(last).squeeze(1)
+
+    def forward(self, x, mask=None):
+        # x: (B, T, H, W, C) uint8
+        b, t, h, w, c = x.shape
+        x = x.view(b * t, h, w, c)
+        feats = self.embed(x)  # (b*t, E)
+        feats = feats.view(b, t, -1)  # (b, t, E)
+        out = self.score_embeddings(feats)
         if mask is not None:
             # if all masked, zero out
             valid = mask.sum(dim=1) > 0
@@ -79,6 +92,59 @@ class CNNLSTM(nn.Module):
         return out
 
 
+class FrameEncoder(nn.Module):
+    """Grafo por frame para servir: (N, H, W, C) uint8 -> (N, E)."""
+
+    def __init__(self, model: CNNLSTM):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.embed(x)
+
+
+class SequenceHead(nn.Module):
+    """Grafo secuencial para servir: (B, T, E) -> (B,)."""
+
+    def __init__(self, model: CNNLSTM):
+        super().__init__()
+        self.model = model
+
+    def forward(self, feats):
+        return self.model.score_embeddings(feats)
+
+
+def export_split_onnx(model: CNNLSTM, ckpt_dir: Path, seq_len: int, embedding_dim: int, device) -> None:
+    """
+    Exporta encoder y cabeza por separado (cnn_lstm_encoder.onnx / cnn_lstm_head.onnx).
+    El servicio codifica cada frame una vez y guarda embeddings por sesion,
+    en lugar de re-pasar los T frames por el encoder en cada inferencia.
+    """
+    model.eval()
+    torch.onnx.export(
+        FrameEncoder(model),
+        uint8_frames(1, 224, 224, 3, device=device),
+        ckpt_dir / "cnn_lstm_encoder.onnx",
+        input_names=["frame"],
+        output_names=["embedding"],
+        opset_version=17,
+        dynamic_axes={"frame": {0: "batch"}, "embedding": {0: "batch"}},
+    )
+    torch.onnx.export(
+        SequenceHead(model),
+        torch.randn(1, seq_len, embedding_dim, device=device),
+        ckpt_dir / "cnn_lstm_head.onnx",
+        input_names=["embeddings"],
+        output_names=["score"],
+        opset_version=17,
+        dynamic_axes={"embeddings": {0: "batch", 1: "seq"}, "score": {0: "batch"}},
+    )
+    check_onnx_export(FrameEncoder(model), sample_frames(2, 224, 224, 3, device=device), ckpt_dir / "cnn_lstm_encoder.onnx")
+    check_onnx_export(
+        SequenceHead(model), torch.randn(2, seq_len, embedding_dim, device=device), ckpt_dir / "cnn_lstm_head.onnx"
+    )
+
+
 def split_by_user(df: pd.DataFrame, val_ratio=0.2, test_ratio=0.1):
     users = df["user_id"].unique().tolist()
     random.shuffle(users)
@@ -101,6 +167,15 @@ def collate_fn(batch):
     return x, m, y, users
 
 
+def holdout_batches(loader, limit: int = 8) -> List[np.ndarray]:
+    batches = []
+    for x, _, _, _ in loader:
+        batches.append(x.numpy())  # uint8, como los recibe el modelo exportado
+        if len(batches) >= limit:
+            break
+    return batches
+
+
 def train_one_epoch(model, loader, optimizer, criterion, device):
     model.train()
     total_loss = 0.0
@@ -144,6 +219,7 @@ def main():
     parser.add_argument("--batch", type=int, default=4)
     parser.add_argument("--seq-len", type=int, default=16)
     parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--no-variants", action="store_true", help="No generar variantes ONNX optimizada / INT8")
     args = parser.parse_args()
 
     df = pd.read_parquet(args.data)
@@ -158,7 +234,7 @@ def main():
           transforms.Resize((224, 224)),
           transforms.ColorJitter(brightness=0.1, contrast=0.1),
           transforms.GaussianBlur(kernel_size=3, sigma=0.5),
-          transforms.ToTensor(),
+          transforms.PILToTensor(),
         ]
     )
 
@@ -197,7 +273,7 @@ def main():
     print("Metrics:", metrics)
 
     # Export ONNX (uso many-to-one)
-    dummy = torch.randn(1, args.seq_len, 3, 224, 224, device=device)
+    dummy = uint8_frames(1, args.seq_len, 224, 224, 3, device=device)
     torch.onnx.export(
         model,
         (dummy, None),
@@ -207,6 +283,12 @@ def main():
         opset_version=17,
         dynamic_axes={"frames": {0: "batch", 1: "seq"}, "score": {0: "batch"}},
     )
+    check_onnx_export(model, sample_frames(2, args.seq_len, 224, 224, 3, device=device), ckpt_dir / "cnn_lstm.onnx")
+    export_split_onnx(model, ckpt_dir, args.seq_len, model.proj[2].out_features, device)
+
+    if not args.no_variants:
+        # calibracion INT8 con val, validacion contra fp32 con test (usuarios no vistos)
+        build_all_variants(ckpt_dir / "cnn_lstm.onnx", holdout_batches(test_loader), holdout_batches(val_loader))
 
 
 if __name__ == "__main__":
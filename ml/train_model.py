@@ -10,6 +10,9 @@ import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
 
+from graph_preprocess import FramePreprocess, check_onnx_export, sample_frames, uint8_frames
+from optimize_onnx import build_all_variants
+
 
 DATASET_PATH = os.environ.get("TRAIN_DATASET", "data/frames_dataset.parquet")
 OUTPUT_PATH = os.environ.get("MODEL_PATH", "checkpoints/cnn_lstm.onnx")
@@ -18,6 +21,12 @@ SEQ_LEN = int(os.environ.get("SEQUENCE_LENGTH", "16"))
 EPOCHS = int(os.environ.get("TRAIN_EPOCHS", "1"))
 BATCH_SIZE = int(os.environ.get("TRAIN_BATCH_SIZE", "4"))
 LR = float(os.environ.get("TRAIN_LR", "1e-4"))
+# Fraccion del dataset reservada para validar las variantes ONNX (opt / INT8)
+HOLDOUT_FRACTION = float(os.environ.get("TRAIN_HOLDOUT", "0.1"))
+# Semilla del barajado previo al split (el parquet suele venir ordenado por sesion o fecha)
+TRAIN_SEED = int(os.environ.get("TRAIN_SEED", "0"))
+BUILD_VARIANTS = os.environ.get("ONNX_VARIANTS", "1") == "1"
+VARIANT_SAMPLES = 8
 
 
 class FrameSeqDataset(Dataset):
@@ -33,10 +42,8 @@ class FrameSeqDataset(Dataset):
         img = cv2.imread(path)
         if img is None:
             img = np.zeros((self.img_size, self.img_size, 3), dtype=np.uint8)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         img = cv2.resize(img, (self.img_size, self.img_size))
-        img = img.astype(np.float32) / 255.0
-        return img
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # H,W,C uint8; se normaliza dentro del modelo
 
     def __getitem__(self, idx: int):
         row = self.df.iloc[idx]
@@ -52,15 +59,15 @@ class FrameSeqDataset(Dataset):
         if not frames:
             frames = ["" for _ in range(self.seq_len)]
 
-        seq = np.stack([self._load_frame(p) for p in frames], axis=0)  # T,H,W,C
-        seq = np.transpose(seq, (0, 3, 1, 2))  # T,C,H,W
+        seq = np.stack([self._load_frame(p) for p in frames], axis=0)  # T,H,W,C uint8
         y = float(row.get("y", 0.0))
-        return torch.tensor(seq, dtype=torch.float32), torch.tensor([y], dtype=torch.float32)
+        return torch.from_numpy(seq), torch.tensor([y], dtype=torch.float32)
 
 
 class TinyCNNLSTM(nn.Module):
     def __init__(self, img_size: int):
         super().__init__()
+        self.preprocess = FramePreprocess()
         self.cnn = nn.Sequential(
             nn.Conv2d(3, 8, kernel_size=3, stride=2, padding=1),
             nn.ReLU(inplace=True),
@@ -76,15 +83,69 @@ class TinyCNNLSTM(nn.Module):
             nn.Sigmoid(),
         )
 
-    def forward(self, x):
-        # x: B,T,C,H,W
-        b, t, c, h, w = x.shape
-        x = x.reshape(b * t, c, h, w)
-        feats = self.cnn(x).reshape(b, t, -1)  # B,T,16
+    def embed(self, x):
+        # x: N,H,W,C uint8 -> N,16
+        return self.cnn(self.preprocess(x)).reshape(x.shape[0], -1)
+
+    def score_embeddings(self, feats):
+        # feats: B,T,16 -> B,1
         out, _ = self.lstm(feats)
         last = out[:, -1, :]
         return self.head(last)
 
+    def forward(self, x):
+        # x: B,T,H,W,C uint8
+        b, t, h, w, c = x.shape
+        x = x.reshape(b * t, h, w, c)
+        feats = self.embed(x).reshape(b, t, -1)  # B,T,16
+        return self.score_embeddings(feats)
+
+
+class FrameEncoder(nn.Module):
+    def __init__(self, model: TinyCNNLSTM):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.embed(x)
+
+
+class SequenceHead(nn.Module):
+    def __init__(self, model: TinyCNNLSTM):
+        super().__init__()
+        self.model = model
+
+    def forward(self, feats):
+        return self.model.score_embeddings(feats)
+
+
+def export_split_onnx(model: TinyCNNLSTM, output_path: Path, device) -> None:
+    """Exporta encoder por frame y cabeza secuencial junto al modelo completo (*_encoder.onnx / *_head.onnx)."""
+    model.eval()
+    encoder_path = output_path.with_name(f"{output_path.stem}_encoder.onnx")
+    head_path = output_path.with_name(f"{output_path.stem}_head.onnx")
+    torch.onnx.export(
+        FrameEncoder(model),
+        uint8_frames(1, IMG_SIZE, IMG_SIZE, 3, device=device),
+        encoder_path.as_posix(),
+        input_names=["frame"],
+        output_names=["embedding"],
+        opset_version=17,
+        dynamic_axes={"frame": {0: "batch"}, "embedding": {0: "batch"}},
+    )
+    torch.onnx.export(
+        SequenceHead(model),
+        torch.zeros((1, SEQ_LEN, 16), dtype=torch.float32).to(device),
+        head_path.as_posix(),
+        input_names=["embeddings"],
+        output_names=["score"],
+        opset_version=17,
+        dynamic_axes={"embeddings": {0: "batch", 1: "seq"}, "score": {0: "batch"}},
+    )
+    check_onnx_export(FrameEncoder(model), sample_frames(2, IMG_SIZE, IMG_SIZE, 3, device=device), encoder_path)
+    check_onnx_export(SequenceHead(model), torch.randn(2, SEQ_LEN, 16, device=device), head_path)
+    print(f"Encoder/cabeza exportados a {encoder_path} y {head_path}")
+
 
 def main():
     dataset_path = Path(DATASET_PATH)
@@ -97,7 +158,10 @@ def main():
         print("Dataset vacio, no se entrena.")
         return
 
-    dataset = FrameSeqDataset(df, SEQ_LEN, IMG_SIZE)
+    df = df.sample(frac=1, random_state=TRAIN_SEED).reset_index(drop=True)
+    holdout_n = int(len(df) * HOLDOUT_FRACTION) if len(df) > 1 else 0
+    holdout_df, train_df = df.iloc[:holdout_n], df.iloc[holdout_n:]
+    dataset = FrameSeqDataset(train_df, SEQ_LEN, IMG_SIZE)
     loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -122,7 +186,7 @@ def main():
 
     output_path = Path(OUTPUT_PATH)
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    dummy = torch.zeros((1, SEQ_LEN, 3, IMG_SIZE, IMG_SIZE), dtype=torch.float32).to(device)
+    dummy = uint8_frames(1, SEQ_LEN, IMG_SIZE, IMG_SIZE, 3, device=device)
     torch.onnx.export(
         model,
         dummy,
@@ -130,8 +194,19 @@ def main():
         input_names=["frames"],
         output_names=["score"],
         opset_version=17,
+        dynamic_axes={"frames": {0: "batch"}, "score": {0: "batch"}},
     )
+    check_onnx_export(model, sample_frames(2, SEQ_LEN, IMG_SIZE, IMG_SIZE, 3, device=device), output_path)
     print(f"Modelo exportado a {output_path}")
+    export_split_onnx(model, output_path, device)
+
+    if BUILD_VARIANTS:
+        if holdout_n == 0:
+            print("Sin datos reservados (dataset muy chico): las variantes se validan con datos de entrenamiento")
+        holdout = FrameSeqDataset(holdout_df if holdout_n else train_df, SEQ_LEN, IMG_SIZE)
+        validation = [holdout[i][0].unsqueeze(0).numpy() for i in range(min(len(holdout), VARIANT_SAMPLES))]
+        calibration = [dataset[i][0].unsqueeze(0).numpy() for i in range(min(len(dataset), VARIANT_SAMPLES))]
+        build_all_variants(output_path, validation, calibration)
 
 
 if __name__ == "__main__":